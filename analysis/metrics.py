@@ -34,7 +34,8 @@ class ModelAnalyzer:
             self.train_smiles: set = pickle.load(f)
 
     @torch.no_grad()
-    def sample_and_analyze(self, n_receptors: int = 10, n_replicates: int = 10, rec_enc_batch_size: int = 64, diff_batch_size: int = 64):
+    def sample_and_analyze(self, n_receptors: int = 10, n_replicates: int = 10, rec_enc_batch_size: int = 64, diff_batch_size: int = 64, **sampling_kwargs):
+        """Samples ligands for randomly selected receptors and computes metrics. Additional keyword arguments are passed to KeypointDiffusion.sample_from_encoded_receptors."""
 
         # randomly select n_receptors from the dataset
         receptor_idxs = torch.randint(low=0, high=len(self.dataset), size=(n_receptors,))
@@ -52,7 +53,8 @@ class ModelAnalyzer:
             n_lig_atoms=n_lig_atoms, 
             rec_enc_batch_size=rec_enc_batch_size, 
             diff_batch_size=diff_batch_size,
-            use_ref_lig_com=True)
+            use_ref_lig_com=True,
+            **sampling_kwargs)
         sample_time = time.time() - sampling_start
         print(f'sampling {n_receptors=} and {n_replicates=}')
         print(f'sampling time per molecule = {sample_time/(n_receptors*n_replicates):.2f} s', flush=True)
@@ -64,8 +66,21 @@ class ModelAnalyzer:
             lig_pos.extend(rec_dict['positions'])
             lig_feat.extend(rec_dict['features'])
 
+        # samples that diverged during sampling are returned with no atoms. they are removed from the samples
+        # but counted as invalid molecules when computing validity
+        n_samples = len(lig_pos)
+        converged_idxs = [ idx for idx, pos in enumerate(lig_pos) if pos.shape[0] > 0 ]
+        lig_pos = [ lig_pos[idx] for idx in converged_idxs ]
+        lig_feat = [ lig_feat[idx] for idx in converged_idxs ]
+        n_diverged = n_samples - len(converged_idxs)
+        diverged_frac = n_diverged / n_samples if n_samples > 0 else 0.0
+
         # compute KL divergence between atom types in this sample vs. the training dataset
-        atom_type_kldiv = self.lig_type_dist.kl_divergence(lig_feat)
+        # if every sample diverged, there are no atom types to compare
+        if len(lig_feat) > 0:
+            atom_type_kldiv = self.lig_type_dist.kl_divergence(lig_feat)
+        else:
+            atom_type_kldiv = float('nan')
 
         # convert to molecules
         unprocessed_mols = []
@@ -82,8 +97,9 @@ class ModelAnalyzer:
         atom_validity = self.check_atom_valency(unprocessed_mols)
         avg_frag_frac = self.compute_avg_frag_size(unprocessed_mols)
 
-        # compute connectivity, validity, uniqueness, and novelty
-        valid_mols, validity = self.compute_validity(unprocessed_mols)
+        # compute connectivity, validity, uniqueness, and novelty. validity is computed over all samples, diverged samples count as invalid.
+        # connectivity, uniqueness and novelty are conditional on the previous metric, so diverged samples only lower validity
+        valid_mols, validity = self.compute_validity(unprocessed_mols, n_failed=n_diverged)
         connected_smiles, connectivity = self.compute_connectivity(valid_mols)
         unique_smiles, uniqueness = self.compute_uniqueness(connected_smiles)
         _, novelty = self.compute_novelty(unique_smiles)
@@ -95,7 +111,9 @@ class ModelAnalyzer:
             validity=validity,
             connectivity=connectivity, 
             uniqueness=uniqueness, 
-            novelty=novelty)
+            novelty=novelty,
+            diverged_frac=diverged_frac,
+            sample_time=sample_time)
 
         return metrics
 
@@ -116,7 +134,9 @@ class ModelAnalyzer:
 
         return connected_smiles, len(connected_smiles)/len(mols)
 
-    def compute_validity(self, mols):
+    def compute_validity(self, mols, n_failed: int = 0):
+        """Returns the valid molecules and the fraction of molecules that are valid. n_failed molecules that could not be
+        generated are counted as invalid."""
         if len(mols) == 0:
             return [], 0.0
 
@@ -129,7 +149,7 @@ class ModelAnalyzer:
                 continue
             valid_mols.append(mol)
 
-        return valid_mols, len(valid_mols)/len(mols)
+        return valid_mols, len(valid_mols)/(len(mols) + n_failed)
 
 
     def compute_uniqueness(self, smiles: List[str]):
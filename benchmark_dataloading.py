@@ -0,0 +1,127 @@
+import argparse
+import time
+from pathlib import Path
+
+import dgl
+import torch
+import yaml
+
+from data_processing.crossdocked.dataset import ProteinLigandDataset, batched_collate_fn, collate_fn, get_dataloader
+from utils import worker_memory_usage
+
+
+def parse_arguments():
+    p = argparse.ArgumentParser(description='Check that batched collation builds the same graphs as per-example graph construction and compare data loading throughput.')
+    p.add_argument('--config', type=Path, default=Path('configs/dev_config.yml'), help='config file, only the dataset and graph sections are used')
+    p.add_argument('--split', type=str, default='train')
+    p.add_argument('--batch_sizes', type=int, nargs='+', default=[8, 32, 128])
+    p.add_argument('--n_batches', type=int, default=20, help='number of batches loaded for every batch size')
+    p.add_argument('--num_workers', type=int, default=0)
+    p.add_argument('--n_check_batches', type=int, default=5, help='number of batches compared between the two collate functions')
+    p.add_argument('--memory_workers', type=int, nargs='*', default=[], help='numbers of dataloader workers to report per-worker memory usage for, e.g. 1 2 4 8')
+    p.add_argument('--seed', type=int, default=42)
+    args = p.parse_args()
+    return args
+
+
+def sorted_edges(g: dgl.DGLHeteroGraph, etype: str) -> torch.Tensor:
+    src, dst = g.edges(etype=etype)
+    order = torch.argsort(src*g.num_nodes(g.to_canonical_etype(etype)[2]) + dst)
+    return torch.stack([src[order], dst[order]])
+
+
+def check_batch(dataset: ProteinLigandDataset, idxs: list, seed: int):
+    """Builds the same batch with both collate functions and checks that the graphs are identical up to the order of edges. 
+    Fake atoms are sampled per example by one and per batch by the other, so they are added to neither."""
+    max_fake_atom_frac = dataset.max_fake_atom_frac
+    dataset.max_fake_atom_frac = 0
+    torch.manual_seed(seed)
+    g_ref, _ = collate_fn([ dataset[idx] for idx in idxs ])
+    torch.manual_seed(seed)
+    g, _ = batched_collate_fn([ dataset.get_raw_example(idx) for idx in idxs ], n_keypoints=dataset.n_keypoints, graph_cutoffs=dataset.graph_cutoffs, fixed_keypoints=dataset.fixed_keypoints)
+    dataset.max_fake_atom_frac = max_fake_atom_frac
+
+    for ntype in g_ref.ntypes:
+        assert torch.equal(g_ref.batch_num_nodes(ntype), g.batch_num_nodes(ntype)), f'number of {ntype} nodes per graph do not match'
+        for feat, ref_data in g_ref.nodes[ntype].data.items():
+            assert torch.equal(ref_data, g.nodes[ntype].data[feat]), f'{ntype} node data {feat} does not match'
+
+    for etype in g_ref.canonical_etypes:
+        assert torch.equal(g_ref.batch_num_edges(etype), g.batch_num_edges(etype)), f'number of {etype} edges per graph do not match'
+        assert torch.equal(sorted_edges(g_ref, etype), sorted_edges(g, etype)), f'{etype} edges do not match'
+
+    # same_res flags are compared in the order of the reference edges
+    ref_src, ref_dst = g_ref.edges(etype='rr')
+    edge_ids = g.edge_ids(ref_src, ref_dst, etype='rr')
+    assert torch.equal(g_ref.edges['rr'].data['same_res'], g.edges['rr'].data['same_res'][edge_ids]), 'same_res flags do not match'
+
+
+def time_dataloader(dataset: ProteinLigandDataset, batch_size: int, n_batches: int, num_workers: int, batched_collate: bool) -> float:
+    """Returns the number of examples loaded per second."""
+    dataloader = get_dataloader(dataset, batch_size=batch_size, num_workers=num_workers, batched_collate=batched_collate, shuffle=True)
+    n_examples = 0
+    start_time = time.time()
+    for batch_idx, (complex_graphs, _) in enumerate(dataloader):
+        n_examples += complex_graphs.batch_size
+        if batch_idx + 1 == n_batches:
+            break
+    return n_examples / (time.time() - start_time)
+
+
+def measure_worker_memory(dataset: ProteinLigandDataset, batch_size: int, n_batches: int, num_workers: int, batched_collate: bool) -> list:
+    """Loads n_batches batches and returns the memory usage of every worker while the workers are still running."""
+    dataloader = get_dataloader(dataset, batch_size=batch_size, num_workers=num_workers, batched_collate=batched_collate, shuffle=True)
+    batches = iter(dataloader)
+    for _ in range(n_batches):
+        if next(batches, None) is None:
+            break
+    usage = list(worker_memory_usage([ worker.pid for worker in batches._workers ]).values())
+    del batches
+    return usage
+
+
+def main():
+
+    args = parse_arguments()
+
+    with open(args.config, 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+
+    try:
+        rec_encoder_type = config['diffusion']['rec_encoder_type']
+    except KeyError:
+        rec_encoder_type = 'learned'
+
+    dataset_path = Path(config['dataset']['location'])
+    dataset = ProteinLigandDataset(name=args.split, processed_data_file=str(dataset_path / f'{args.split}.pkl'), fixed_keypoints=rec_encoder_type == 'fixed',
+                                   **config['graph'], **config['dataset'])
+
+    print(f'checking batched collation on {args.n_check_batches} batches', flush=True)
+    torch.manual_seed(args.seed)
+    for _ in range(args.n_check_batches):
+        idxs = torch.randperm(len(dataset))[:max(args.batch_sizes)].tolist()
+        check_batch(dataset, idxs, seed=args.seed)
+    print('batched collation matches per-example graph construction', flush=True)
+
+    print('batch size'.ljust(12) + 'per-example'.rjust(16) + 'batched'.rjust(16) + 'speedup'.rjust(10))
+    for batch_size in args.batch_sizes:
+        per_example = time_dataloader(dataset, batch_size, args.n_batches, args.num_workers, batched_collate=False)
+        batched = time_dataloader(dataset, batch_size, args.n_batches, args.num_workers, batched_collate=True)
+        print(f'{batch_size:<12d}{per_example:13.1f}/s{batched:13.1f}/s{batched / per_example:9.2f}x', flush=True)
+
+    # private memory of each worker should not grow with the number of workers if the data is shared between them
+    if args.memory_workers:
+        print('\nper-worker memory usage (MB)')
+        print('workers'.ljust(10) + 'mean private'.rjust(16) + 'max private'.rjust(16) + 'mean shared'.rjust(16))
+        for num_workers in args.memory_workers:
+            usage = measure_worker_memory(dataset, max(args.batch_sizes), args.n_batches, num_workers, batched_collate=False)
+            if len(usage) == 0:
+                print(f'{num_workers:<10d}no worker processes found')
+                continue
+            private = [ u['rss_anon'] for u in usage ]
+            shared = [ u['rss_file'] + u['rss_shmem'] for u in usage ]
+            print(f'{num_workers:<10d}{sum(private) / len(private):16.1f}{max(private):16.1f}{sum(shared) / len(shared):16.1f}', flush=True)
+
+
+if __name__ == "__main__":
+    main()
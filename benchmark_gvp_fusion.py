@@ -0,0 +1,167 @@
+import argparse
+import time
+from pathlib import Path
+from typing import Tuple
+
+import dgl
+import torch
+import yaml
+
+from models.dynamics_gvp import LigRecDynamicsGVP
+from models.gvp import GVP, set_edge_chunk_size, set_gvp_fusion, set_packed_edges
+from models.sampling_graphs import build_keypoint_graph
+from utils import get_batch_idxs
+
+
+def parse_arguments():
+    p = argparse.ArgumentParser(description='Check that fused GVP execution, packed message passing, and chunked message passing match the default GVP implementation and compare the speed of the GVP dynamics model with and without them.')
+    p.add_argument('config_files', type=Path, nargs='+', help='config files of GVP models, e.g. trained_models/gvp_20kp/config.yml')
+    p.add_argument('--batch_size', type=int, default=64)
+    p.add_argument('--n_lig_atoms', type=int, default=25)
+    p.add_argument('--n_iters', type=int, default=20)
+    p.add_argument('--seed', type=int, default=42)
+    p.add_argument('--atol', type=float, default=1e-5)
+    p.add_argument('--edge_chunk_size', type=int, default=1024, help='number of edges per chunk for the chunked setting')
+    args = p.parse_args()
+    return args
+
+
+def make_dynamics(config: dict) -> Tuple[LigRecDynamicsGVP, int]:
+
+    try:
+        rec_encoder_type = config['diffusion']['rec_encoder_type']
+    except KeyError:
+        rec_encoder_type = 'learned'
+
+    n_lig_feat = len(config['dataset']['lig_elements'])
+    if rec_encoder_type == 'learned':
+        n_kp_feat = config['rec_encoder_gvp']['out_scalar_size']
+    else:
+        n_kp_feat = len(config['dataset']['rec_elements'])
+
+    dynamics = LigRecDynamicsGVP(n_lig_feat, n_kp_feat, **config['graph'], **config['dynamics_gvp'])
+    return dynamics, n_kp_feat
+
+
+def make_graph(dynamics: LigRecDynamicsGVP, n_kp_feat: int, batch_size: int, n_keypoints: int, n_lig_atoms: int, device) -> dgl.DGLHeteroGraph:
+    """Builds a random batch of keypoint/ligand graphs with the same node and edge types as the graphs used during sampling."""
+
+    no_edges = ([], [])
+    template = dgl.heterograph({
+        ('rec', 'rr', 'rec'): no_edges,
+        ('rec', 'rk', 'kp'): no_edges,
+        ('kp', 'kk', 'kp'): no_edges,
+        ('kp', 'kl', 'lig'): no_edges,
+        ('lig', 'll', 'lig'): no_edges,
+        ('lig', 'lk', 'kp'): no_edges
+    })
+
+    batch_idx = torch.arange(batch_size, device=device)
+    kp_batch_idx = batch_idx.repeat_interleave(n_keypoints)
+    lig_batch_idx = batch_idx.repeat_interleave(n_lig_atoms)
+
+    kp_data = {
+        'x_0': torch.randn(kp_batch_idx.shape[0], 3, device=device)*5,
+        'h_0': torch.randn(kp_batch_idx.shape[0], n_kp_feat, device=device),
+        'v_0': torch.randn(kp_batch_idx.shape[0], dynamics.vector_size, 3, device=device),
+    }
+    lig_data = {
+        'x_0': torch.randn(lig_batch_idx.shape[0], 3, device=device)*2,
+        'h_0': torch.randn(lig_batch_idx.shape[0], dynamics.n_lig_scalars, device=device),
+    }
+
+    return build_keypoint_graph(template, kp_data, kp_batch_idx, lig_data, lig_batch_idx, batch_size=batch_size, kk_cutoff=dynamics.graph_cutoffs['kk'])
+
+
+def check_gvp_equivalence(model: torch.nn.Module, n_inputs: int, device, atol: float) -> float:
+    """Compares GVP.forward and GVP.fused_forward on random inputs for every GVP in model. Returns the maximum absolute difference."""
+    max_diff = 0.0
+    for gvp in model.modules():
+        if not isinstance(gvp, GVP):
+            continue
+
+        feats = torch.randn(n_inputs, gvp.dim_feats_in, device=device)
+        vectors = torch.randn(n_inputs, gvp.dim_vectors_in, 3, device=device)
+        ref_feats, ref_vectors = gvp((feats, vectors))
+        fused_feats, fused_vectors = gvp.fused_forward((feats, vectors))
+
+        assert torch.allclose(ref_feats, fused_feats, atol=atol), 'fused GVP scalar outputs do not match'
+        assert torch.allclose(ref_vectors, fused_vectors, atol=atol), 'fused GVP vector outputs do not match'
+        max_diff = max(max_diff, (ref_feats - fused_feats).abs().max().item(), (ref_vectors - fused_vectors).abs().max().item())
+
+    return max_diff
+
+
+def time_dynamics(dynamics: LigRecDynamicsGVP, g: dgl.DGLHeteroGraph, timestep: torch.Tensor, batch_idxs: dict, n_iters: int) -> float:
+    # warm up
+    dynamics(g, timestep, batch_idxs)
+
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(n_iters):
+        dynamics(g, timestep, batch_idxs)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.time() - start) / n_iters
+
+
+@torch.no_grad()
+def main():
+
+    args = parse_arguments()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print(f'{device=}', flush=True)
+
+    for config_file in args.config_files:
+
+        torch.manual_seed(args.seed)
+
+        with open(config_file, 'r') as f:
+            config = yaml.load(f, Loader=yaml.FullLoader)
+
+        dynamics, n_kp_feat = make_dynamics(config)
+        dynamics = dynamics.to(device)
+        dynamics.eval()
+
+        # check every GVP individually
+        max_gvp_diff = check_gvp_equivalence(dynamics, n_inputs=1000, device=device, atol=args.atol)
+
+        # check the full dynamics model
+        g = make_graph(dynamics, n_kp_feat, args.batch_size, config['graph']['n_keypoints'], args.n_lig_atoms, device)
+        batch_idxs = get_batch_idxs(g)
+        timestep = torch.rand(args.batch_size, device=device)
+
+        print(f'{config_file}', flush=True)
+        print(f'  max abs difference over GVPs: {max_gvp_diff:.2e}')
+
+        settings = {
+            'default': dict(fused=False, packed=False, edge_chunk_size=None),
+            'fused': dict(fused=True, packed=False, edge_chunk_size=None),
+            'packed': dict(fused=False, packed=True, edge_chunk_size=None),
+            'fused+packed': dict(fused=True, packed=True, edge_chunk_size=None),
+            'chunked': dict(fused=False, packed=False, edge_chunk_size=args.edge_chunk_size),
+        }
+        for setting_name, setting in settings.items():
+            set_gvp_fusion(dynamics, setting['fused'])
+            set_packed_edges(dynamics, setting['packed'])
+            set_edge_chunk_size(dynamics, setting['edge_chunk_size'])
+
+            # check the full dynamics model against the default implementation
+            eps_h, eps_x = dynamics(g, timestep, batch_idxs)
+            if setting_name == 'default':
+                ref_eps_h, ref_eps_x = eps_h, eps_x
+            max_model_diff = max((ref_eps_h - eps_h).abs().max().item(), (ref_eps_x - eps_x).abs().max().item())
+            assert torch.allclose(ref_eps_h, eps_h, atol=args.atol*10) and torch.allclose(ref_eps_x, eps_x, atol=args.atol*10), \
+                f'{setting_name} dynamics outputs do not match'
+
+            # time the dynamics model
+            forward_time = time_dynamics(dynamics, g, timestep, batch_idxs, args.n_iters)
+            if setting_name == 'default':
+                ref_time = forward_time
+
+            print(f'  {setting_name}: forward time = {forward_time*1000:.2f} ms, speedup = {ref_time/forward_time:.2f}x, max abs difference = {max_model_diff:.2e}', flush=True)
+
+
+if __name__ == "__main__":
+    main()
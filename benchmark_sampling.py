@@ -0,0 +1,93 @@
+import argparse
+from pathlib import Path
+
+import torch
+import yaml
+
+from analysis.metrics import ModelAnalyzer
+from data_processing.crossdocked.dataset import ProteinLigandDataset
+from model_setup import model_from_config
+from models.ligand_diffuser import KeypointDiffusion
+
+
+def parse_arguments():
+    p = argparse.ArgumentParser(description='Compare the speed and sample quality of different sampling settings against the default sampler.')
+    p.add_argument('model_dir', type=Path, help='directory of training result for the model')
+    p.add_argument('--split', type=str, default='val')
+    p.add_argument('--n_receptors', type=int, default=10)
+    p.add_argument('--n_replicates', type=int, default=10)
+    p.add_argument('--batch_size', type=int, default=64)
+    p.add_argument('--seed', type=int, default=42)
+    p.add_argument('--coarse_kp_ratio', type=float, default=0.25, help='fraction of keypoints kept when pooling keypoints')
+    p.add_argument('--coarse_switch_steps', type=int, nargs='*', default=[], help='switchover steps to benchmark for coarse-to-fine sampling')
+    p.add_argument('--crop_radii', type=float, nargs='*', default=[], help='keypoint crop radii to benchmark')
+    p.add_argument('--output_file', type=Path, default=None, help='if specified, benchmark results are written to this yaml file')
+    args = p.parse_args()
+    return args
+
+
+def main():
+
+    args = parse_arguments()
+
+    # load model configuration
+    with open(args.model_dir / 'config.yml', 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print(f'{device=}', flush=True)
+
+    # the fixed receptor encoder uses receptor atoms as keypoints, so we have the dataset build them directly into the graph
+    try:
+        rec_encoder_type = config['diffusion']['rec_encoder_type']
+    except KeyError:
+        rec_encoder_type = 'learned'
+
+    # create dataset
+    dataset_path = Path(config['dataset']['location'])
+    dataset = ProteinLigandDataset(name=args.split, processed_data_file=str(dataset_path / f'{args.split}.pkl'), fixed_keypoints=rec_encoder_type == 'fixed',
+                                   **config['graph'], **config['dataset'])
+
+    # create model and load weights
+    model: KeypointDiffusion = model_from_config(config).to(device)
+    model.load_state_dict(torch.load(args.model_dir / 'model.pt', map_location=device))
+    model.eval()
+
+    analyzer = ModelAnalyzer(model=model, dataset=dataset, device=device)
+
+    # construct the sampling settings to compare
+    settings = { 'default': {} }
+    for switch_step in args.coarse_switch_steps:
+        settings[f'coarse_{switch_step}'] = dict(coarse_kp_ratio=args.coarse_kp_ratio, coarse_switch_step=switch_step)
+    for crop_radius in args.crop_radii:
+        settings[f'crop_{crop_radius:g}'] = dict(crop_radius=crop_radius)
+
+    # run every setting on the same set of receptors and the same noise
+    results = {}
+    for setting_name, sampling_kwargs in settings.items():
+        torch.manual_seed(args.seed)
+        metrics = analyzer.sample_and_analyze(
+            n_receptors=args.n_receptors,
+            n_replicates=args.n_replicates,
+            rec_enc_batch_size=args.batch_size,
+            diff_batch_size=args.batch_size,
+            **sampling_kwargs)
+        results[setting_name] = { k: float(v) for k, v in metrics.items() }
+
+    # report results relative to the default sampler
+    baseline_time = results['default']['sample_time']
+    metric_names = [ k for k in results['default'] if k != 'sample_time' ]
+    print('setting'.ljust(16) + 'time (s)'.rjust(10) + 'speedup'.rjust(10) + ''.join(name.rjust(16) for name in metric_names))
+    for setting_name, metrics in results.items():
+        speedup = baseline_time / metrics['sample_time']
+        row = setting_name.ljust(16) + f'{metrics["sample_time"]:10.2f}' + f'{speedup:10.2f}'
+        row += ''.join(f'{metrics[name]:16.3f}' for name in metric_names)
+        print(row, flush=True)
+
+    if args.output_file is not None:
+        with open(args.output_file, 'w') as f:
+            yaml.dump(results, f)
+
+
+if __name__ == "__main__":
+    main()
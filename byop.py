@@ -27,8 +27,11 @@ from data_processing.pdbbind_processing import (build_initial_complex_graph,
                                                 parse_ligand,
                                                 rec_atom_featurizer)
 from model_setup import model_from_config
+from models.dense_gvp import compile_for_sampling
+from models.gvp import set_edge_chunk_size, set_gvp_fusion, set_packed_edges
 from models.ligand_diffuser import KeypointDiffusion
-from utils import copy_graph, get_rec_atom_map, write_xyz_file
+from models.quantization import load_quantized_layers, quantize_dynamics
+from utils import copy_graph, get_rec_atom_map, n_receptor_atoms, write_xyz_file
 
 
 def parse_arguments():
@@ -48,6 +51,19 @@ def parse_arguments():
     # p.add_argument('--no_minimization', action='store_true')
     p.add_argument('--ligand_only_minimization', action='store_true')
     p.add_argument('--pocket_minimization', action='store_true')
+    p.add_argument('--divergence_check', action='store_true', help='check samples for numerical divergence at every denoising step')
+    p.add_argument('--max_restarts', type=int, default=1, help='number of times a diverged sample is restarted, only used with --divergence_check')
+    p.add_argument('--max_kp_com_dist', type=float, default=30.0, help='samples with a ligand atom further than this many angstroms from the keypoint COM are considered diverged, only used with --divergence_check')
+    p.add_argument('--coarse_kp_ratio', type=float, default=None, help='if specified, early denoising steps are performed with keypoints pooled down to this fraction of the full keypoint set')
+    p.add_argument('--coarse_switch_step', type=int, default=0, help='denoising steps s >= coarse_switch_step use the pooled keypoints, only used with --coarse_kp_ratio')
+    p.add_argument('--crop_radius', type=float, default=None, help='if specified, only keypoints near the initial ligand position are used during sampling')
+    p.add_argument('--fuse_gvps', action='store_true', help='use fused execution of GVP stacks, only affects GVP models')
+    p.add_argument('--packed_edges', action='store_true', help='compute messages for all edge types in one packed buffer, only affects GVP models')
+    p.add_argument('--edge_chunk_size', type=int, default=None, help='if specified, the dynamics model computes messages for at most this many edges at a time to bound peak memory')
+    p.add_argument('--quantize', action='store_true', help='run the dynamics model with int8 quantized linear layers on CPU. layers selected by quantize_model.py are used if available')
+    p.add_argument('--compile', action='store_true', help='sample with a dense denoising step compiled by torch.compile, only supported for GVP models')
+    p.add_argument('--compile_bucket_size', type=int, default=8, help='with --compile, ligands are padded to a multiple of this many atoms so that every bucket of ligand sizes is compiled once')
+    p.add_argument('--compile_max_atoms', type=int, default=64, help='with --compile, buckets for ligands of up to this many atoms are compiled before sampling')
     
     args = p.parse_args()
 
@@ -99,7 +115,7 @@ def element_fixer(element: str):
 def process_ligand_and_pocket(rec_file: Path, lig_file: Path, output_dir: Path,
                                   rec_element_map, lig_element_map,
                                   n_keypoints: int, graph_cutoffs: dict,
-                                  pocket_cutoff: float, remove_hydrogen: bool = True, ca_only: bool = False):
+                                  pocket_cutoff: float, remove_hydrogen: bool = True, ca_only: bool = False, fixed_keypoints: bool = False):
     
     
     if rec_file.suffix == '.pdb':
@@ -193,7 +209,8 @@ def process_ligand_and_pocket(rec_file: Path, lig_file: Path, output_dir: Path,
         n_keypoints=n_keypoints,
         cutoffs=graph_cutoffs,
         lig_atom_positions=lig_coords,
-        lig_atom_features=lig_atom_features
+        lig_atom_features=lig_atom_features,
+        fixed_keypoints=fixed_keypoints
     )
 
     # save the pocket file
@@ -230,7 +247,7 @@ def main():
         config = yaml.load(f, Loader=yaml.FullLoader)
 
     # determine device
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    device = torch.device('cuda' if torch.cuda.is_available() and not args.quantize else 'cpu')
     print(f'{device=}', flush=True)
 
     # set random seeds
@@ -246,6 +263,12 @@ def main():
     except KeyError:
         ca_only = False
 
+    # the fixed receptor encoder uses receptor atoms as keypoints, so we build its keypoints directly into the graph
+    try:
+        rec_encoder_type = config['diffusion']['rec_encoder_type']
+    except KeyError:
+        rec_encoder_type = 'learned'
+
     # construct atom typing maps
     rec_element_map, lig_element_map = get_rec_atom_map(dataset_config)
     lig_decoder = { v:k for k,v in lig_element_map.items() }
@@ -257,6 +280,22 @@ def main():
     model.load_state_dict(torch.load(model_file, map_location=device))
     model.eval()
 
+    if args.quantize:
+        quantize_dynamics(model, layer_names=load_quantized_layers(model_dir))
+
+    if args.fuse_gvps:
+        set_gvp_fusion(model, True)
+    if args.packed_edges:
+        set_packed_edges(model, True)
+    if args.edge_chunk_size is not None:
+        set_edge_chunk_size(model.dynamics, args.edge_chunk_size)
+    if args.compile:
+        # compile every ligand size bucket up front and report the speedup of the compiled step over the eager dense step
+        dense_sampler = compile_for_sampling(model, bucket_size=args.compile_bucket_size)
+        step_times = dense_sampler.warmup([args.max_batch_size], max_atoms=args.compile_max_atoms, device=device)
+        for (bucket_batch_size, bucket_n_atoms), (eager_time, compiled_time) in step_times.items():
+            print(f'compiled step, {bucket_batch_size} complexes x {bucket_n_atoms} atoms: eager {eager_time*1000:.2f} ms, compiled {compiled_time*1000:.2f} ms, speedup {eager_time/compiled_time:.2f}x', flush=True)
+
     # iterate over dataset and draw samples for each pocket
     pocket_sample_start = time.time()
 
@@ -276,7 +315,8 @@ def main():
                                 graph_cutoffs=config['graph']['graph_cutoffs'],
                                 pocket_cutoff=dataset_config['pocket_cutoff'], 
                                 remove_hydrogen=dataset_config['remove_hydrogen'],
-                                ca_only=ca_only)
+                                ca_only=ca_only,
+                                fixed_keypoints=rec_encoder_type == 'fixed')
 
     # TODO: how should/could we handle fake atoms? do we need to worry about it?
     # none of the trained models actually use fake atoms, so this is not a problem for now
@@ -292,7 +332,7 @@ def main():
     ref_graph = ref_graph.to(device)
 
     # get the number of nodes in the binding pocket
-    n_rec_nodes = ref_graph.num_nodes('rec')
+    n_rec_nodes = n_receptor_atoms(ref_graph)
     n_rec_nodes = torch.tensor([n_rec_nodes], device=device)
 
     # encode the receptor
@@ -329,19 +369,28 @@ def main():
 
         # sample ligand atom positions/features
         with g_batch.local_scope():
-            batch_lig_pos, batch_lig_feat = model.sample_from_encoded_receptors(
+            batch_samples = model.sample_from_encoded_receptors(
                 g_batch,  
-                init_lig_pos=init_lig_com_batch)
-
-        # convert positions/features to rdkit molecules
-        for lig_idx, (lig_pos_i, lig_feat_i) in enumerate(zip(batch_lig_pos, batch_lig_feat)):
-
-            # convert lig atom features to atom elements
-            element_idxs = torch.argmax(lig_feat_i, dim=1).tolist()
-            atom_elements = [ lig_decoder[idx] for idx in element_idxs ]
+                init_lig_pos=init_lig_com_batch,
+                divergence_check=args.divergence_check,
+                max_kp_com_dist=args.max_kp_com_dist,
+                max_restarts=args.max_restarts,
+                coarse_kp_ratio=args.coarse_kp_ratio,
+                coarse_switch_step=args.coarse_switch_step,
+                crop_radius=args.crop_radius,
+                packed=True)
+
+        # convert element indicies of all sampled atoms at once, then slice out the atoms of each ligand
+        atom_elements = [ lig_decoder[idx] for idx in batch_samples.element_idxs.tolist() ]
+        offsets = batch_samples.offsets.tolist()
+        for start, end in zip(offsets[:-1], offsets[1:]):
+
+            # skip samples that diverged and could not be recovered
+            if start == end:
+                continue
 
             # build molecule
-            mol = build_molecule(lig_pos_i, atom_elements, add_hydrogens=False, sanitize=True, largest_frag=True, relax_iter=0)
+            mol = build_molecule(batch_samples.positions[start:end], atom_elements[start:end], add_hydrogens=False, sanitize=True, largest_frag=True, relax_iter=0)
 
             if mol is not None:
                 pocket_raw_mols.append(mol)
@@ -362,6 +411,12 @@ def main():
     # print the sampling time per molecule
     print(f'sampling time per molecule: {pocket_sample_time/len(pocket_raw_mols):.2f}')
 
+    if args.divergence_check:
+        print(f'divergence counts: {dict(model.divergence_counts)}', flush=True)
+
+    if args.crop_radius is not None:
+        print(f'complexes that fell back to all keypoints: {model.crop_fallback_count}', flush=True)
+
     # write the reference files to the pocket dir
     ref_files_dir = output_dir / 'reference_files'
     ref_files_dir.mkdir(exist_ok=True)
@@ -0,0 +1,88 @@
+import argparse
+import pickle
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from data_processing.columnar import ARRAY_COLUMNS, FEATURE_COLUMNS, POCKET_COLUMNS, RR_EDGE_COLUMNS, STRING_COLUMNS, columnar_dir, element_idxs, read_columnar, write_columnar
+from data_processing.sharded import read_shard_index, shard_example_order, sharded_dir, write_shards
+
+
+def parse_arguments():
+    p = argparse.ArgumentParser(description='Convert processed dataset pickle files to the memory-mapped columnar format read by ProteinLigandDataset, or to shards streamed by ShardedDataset.')
+    p.add_argument('data_files', type=Path, nargs='+', help='processed data files, e.g. data/bindingmoad_processed/train.pkl')
+    p.add_argument('--output_dir', type=Path, default=None, help='directory the columnar datasets are written to. defaults to the directory of each data file. '
+                   'ProteinLigandDataset only finds converted datasets automatically when they are written next to the pickle file.')
+    p.add_argument('--examples_per_shard', type=int, default=None, help='if specified, write a sharded dataset with this many examples per shard, '
+                   'to be streamed by ShardedDataset, instead of a single columnar dataset')
+    p.add_argument('--shuffle_seed', type=int, default=42, help='seed used to shuffle examples before they are split into shards')
+    args = p.parse_args()
+    return args
+
+
+def check_conversion(data: dict, output_dir: Path):
+    """Checks that every column of the columnar dataset matches the pickled data. One-hot atom features are compared as element indicies."""
+    converted = read_columnar(output_dir)
+    for key in ARRAY_COLUMNS + (RR_EDGE_COLUMNS if 'rr_cutoff' in data else []) + (POCKET_COLUMNS if 'pocket_idx' in data else []):
+        column = torch.as_tensor(data[key])
+        if key in FEATURE_COLUMNS:
+            column = element_idxs(column)
+        assert np.array_equal(np.asarray(converted[key]), column.numpy()), f'column {key} does not match the pickled data'
+    for key in STRING_COLUMNS:
+        assert list(converted[key]) == list(data.get(key, [])), f'column {key} does not match the pickled data'
+    assert converted.get('rr_cutoff') == data.get('rr_cutoff'), 'rr cutoff does not match the pickled data'
+
+
+def check_shards(data: dict, output_dir: Path, shuffle_seed: int):
+    """Checks that the positions of every example in the shards match the pickled data."""
+    index = read_shard_index(output_dir)
+    example_order = shard_example_order(index['n_examples'], shuffle_seed).tolist()
+    pocket_idx = torch.as_tensor(data['pocket_idx']) if 'pocket_idx' in data else torch.arange(index['n_examples'])
+
+    example_idxs = iter(example_order)
+    for shard in index['shards']:
+        shard_data = read_columnar(output_dir / shard['name'])
+        shard_pocket_idx = shard_data['pocket_idx'] if 'pocket_idx' in shard_data else np.arange(shard['n_examples'])
+        for shard_example_idx in range(shard['n_examples']):
+            example_idx = next(example_idxs)
+            for key, segment_key, idx, shard_idx in [('lig_pos', 'lig_segments', example_idx, shard_example_idx), 
+                                                     ('interface_points', 'ip_segments', example_idx, shard_example_idx),
+                                                     ('rec_pos', 'rec_segments', int(pocket_idx[example_idx]), int(shard_pocket_idx[shard_example_idx]))]:
+                expected = torch.as_tensor(data[key])[data[segment_key][idx]:data[segment_key][idx+1]].numpy()
+                converted = shard_data[key][shard_data[segment_key][shard_idx]:shard_data[segment_key][shard_idx+1]]
+                assert np.array_equal(np.asarray(converted), expected), f'{key} of example {example_idx} does not match the pickled data in {shard["name"]}'
+
+
+def main():
+
+    args = parse_arguments()
+
+    for data_file in args.data_files:
+        output_dir = columnar_dir(data_file)
+        if args.output_dir is not None:
+            output_dir = args.output_dir / output_dir.name
+
+        start_time = time.time()
+        with open(data_file, 'rb') as f:
+            data = pickle.load(f)
+
+        missing_keys = [ key for key in ARRAY_COLUMNS if key not in data ]
+        if missing_keys:
+            raise ValueError(f'{data_file} is missing {missing_keys}. only data files with concatenated columns and segments, as written by process_bindingmoad.py, can be converted')
+
+        if args.examples_per_shard is not None:
+            output_dir = sharded_dir(data_file) if args.output_dir is None else args.output_dir / sharded_dir(data_file).name
+            index = write_shards(data, output_dir, args.examples_per_shard, shuffle_seed=args.shuffle_seed)
+            check_shards(data, output_dir, args.shuffle_seed)
+            print(f'converted {data_file} to {len(index["shards"])} shards in {output_dir} in {time.time() - start_time:.1f} s', flush=True)
+            continue
+
+        write_columnar(data, output_dir)
+        check_conversion(data, output_dir)
+        print(f'converted {data_file} to {output_dir} in {time.time() - start_time:.1f} s', flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import json
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple, Union
+
+import numpy as np
+import torch
+
+# a columnar dataset is a directory containing one .npy file per column of the processed data. per-atom columns are stored as flat
+# arrays, and the *_segments columns give the offsets of every example into them. file path lists are stored as string tables.
+# every array is opened with memory mapping, so opening a dataset does not read it into memory and worker processes share the
+# pages of the files through the page cache.
+
+FORMAT_VERSION = 1
+METADATA_FILE = 'metadata.json'
+
+ARRAY_COLUMNS = ['lig_pos', 'lig_feat', 'rec_pos', 'rec_feat', 'rec_res_idx', 'interface_points', 'lig_segments', 'rec_segments', 'ip_segments']
+STRING_COLUMNS = ['rec_files', 'lig_files']
+
+# rr edges are only present if they were precomputed during processing. rr_edges has shape (n_edges, 2) and holds indicies 
+# of receptor atoms within each complex. the cutoff the edges were computed with is stored in the metadata.
+RR_EDGE_COLUMNS = ['rr_edges', 'rr_same_res', 'rr_segments']
+
+# pocket_idx is only present if complexes with identical pockets share one copy of the pocket. it holds the pocket 
+# index of every complex, and rec_segments and rr_segments then index pockets rather than complexes.
+POCKET_COLUMNS = ['pocket_idx']
+
+# atom features are stored as one uint8 element index per atom. processed data written before this change stored
+# one-hot features, these are converted to element indicies when they are read.
+FEATURE_COLUMNS = ['lig_feat', 'rec_feat']
+
+
+class StringTable:
+    """A list of strings stored as one array of utf-8 bytes and an array of offsets into it. The arrays can be numpy arrays or cpu tensors."""
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        self.data = data
+        self.offsets = offsets
+
+    @staticmethod
+    def encode(strings: Iterable[str]) -> Tuple[np.ndarray, np.ndarray]:
+        encoded = [ s.encode('utf-8') for s in strings ]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([ len(s) for s in encoded ])
+        data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return data, offsets
+
+    def __len__(self) -> int:
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, idx: int) -> str:
+        start, end = self.offsets[idx], self.offsets[idx+1]
+        return np.asarray(self.data[start:end]).tobytes().decode('utf-8')
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+def columnar_dir(data_file: Path) -> Path:
+    """Returns the directory that the columnar version of a processed pickle file is written to."""
+    return Path(data_file).with_suffix('.columnar')
+
+
+def write_columnar(data: Dict[str, Union[torch.Tensor, List[str]]], output_dir: Path):
+    """Writes processed data, as stored in the pickle files written by process_bindingmoad.py, to a columnar dataset directory."""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    has_rr_edges = 'rr_cutoff' in data
+    has_pocket_idx = 'pocket_idx' in data
+    for key in ARRAY_COLUMNS + (RR_EDGE_COLUMNS if has_rr_edges else []) + (POCKET_COLUMNS if has_pocket_idx else []):
+        column = data[key]
+        if key in FEATURE_COLUMNS:
+            column = element_idxs(torch.as_tensor(column))
+        if isinstance(column, torch.Tensor):
+            column = column.numpy()
+        np.save(output_dir / f'{key}.npy', np.ascontiguousarray(column))
+
+    # string columns may be missing, e.g. file paths are not recorded for the training split of bindingmoad
+    for key in STRING_COLUMNS:
+        str_data, str_offsets = StringTable.encode(data.get(key, []))
+        np.save(output_dir / f'{key}_data.npy', str_data)
+        np.save(output_dir / f'{key}_offsets.npy', str_offsets)
+
+    metadata = {
+        'format_version': FORMAT_VERSION,
+        'n_examples': int(data['lig_segments'].shape[0] - 1),
+        'deduplicated_pockets': has_pocket_idx,
+    }
+    if has_rr_edges:
+        metadata['rr_cutoff'] = data['rr_cutoff']
+    with open(output_dir / METADATA_FILE, 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+
+def read_columnar(input_dir: Path) -> Dict[str, Union[np.ndarray, StringTable]]:
+    """Opens every column of a columnar dataset directory with memory mapping."""
+    input_dir = Path(input_dir)
+    with open(input_dir / METADATA_FILE, 'r') as f:
+        metadata = json.load(f)
+    if metadata['format_version'] != FORMAT_VERSION:
+        raise ValueError(f'columnar dataset {input_dir} has format version {metadata["format_version"]}, expected {FORMAT_VERSION}')
+
+    array_columns = ARRAY_COLUMNS + (RR_EDGE_COLUMNS if 'rr_cutoff' in metadata else []) + (POCKET_COLUMNS if metadata.get('deduplicated_pockets', False) else [])
+    data = { key: np.load(input_dir / f'{key}.npy', mmap_mode='r') for key in array_columns }
+    if 'rr_cutoff' in metadata:
+        data['rr_cutoff'] = metadata['rr_cutoff']
+    for key in STRING_COLUMNS:
+        data[key] = StringTable(np.load(input_dir / f'{key}_data.npy', mmap_mode='r'), np.load(input_dir / f'{key}_offsets.npy', mmap_mode='r'))
+    return data
+
+
+def element_idxs(feat: torch.Tensor) -> torch.Tensor:
+    """Converts one-hot atom features of shape (n_atoms, n_elements) to uint8 element indicies. Element indicies are returned unchanged."""
+    if feat.dim() == 1:
+        return feat
+    return feat.int().argmax(dim=1).to(torch.uint8)
+
+
+def as_tensor(x: Union[np.ndarray, torch.Tensor]) -> torch.Tensor:
+    """Converts a slice of a column to a tensor. Slices of memory-mapped columns are copied so that the tensor does not point into the file."""
+    if isinstance(x, np.ndarray):
+        return torch.from_numpy(np.array(x))
+    return x
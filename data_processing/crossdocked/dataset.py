@@ -1,13 +1,19 @@
+from collections import deque
+from functools import partial
 from pathlib import Path
 import pickle
-from typing import Dict, List, Union
+import queue
+import threading
+from typing import Dict, List, Tuple, Union
 import math
 
 import dgl
 from dgl.dataloading import GraphDataLoader
 import torch
 
-from data_processing.pdbbind_processing import (build_initial_complex_graph,
+from data_processing.columnar import ARRAY_COLUMNS, POCKET_COLUMNS, RR_EDGE_COLUMNS, STRING_COLUMNS, StringTable, as_tensor, columnar_dir, element_idxs, read_columnar
+from data_processing.sharded import read_shard_index
+from data_processing.pdbbind_processing import (build_complex_graph_batch, build_initial_complex_graph,
                                                 get_pocket_atoms, parse_ligand,
                                                 parse_protein, get_ot_loss_weights)
 
@@ -28,17 +34,29 @@ class ProteinLigandDataset(dgl.data.DGLDataset):
         load_data: bool = True,
         use_boltzmann_ot: bool = False, 
         max_fake_atom_frac: float = 0.0,
+        fixed_keypoints: bool = False,
+        share_memory: bool = False,
         **kwargs):
 
         self.max_fake_atom_frac = max_fake_atom_frac
+        self.fixed_keypoints = fixed_keypoints # if True, graphs are built with one keypoint per receptor atom for the fixed receptor encoder
         self.n_keypoints = n_keypoints
         self.graph_cutoffs = graph_cutoffs
 
         # if load_data is false, we don't want to actually process any data
         self.load_data = load_data
 
-        # define filepath of data
+        # if True, data loaded from a pickle file is moved into shared memory so that dataloader workers do not each hold a copy of it
+        self.share_memory = share_memory
+
+        # define filepath of data. processed_data_file can be a pickle file or a columnar dataset directory written by convert_dataset.py. 
+        # if a pickle file has been converted, the columnar version next to it is used instead.
         self.data_file: Path = Path(processed_data_file)
+        self.columnar_dir: Path = None
+        if self.data_file.is_dir():
+            self.columnar_dir = self.data_file
+        elif columnar_dir(self.data_file).exists():
+            self.columnar_dir = columnar_dir(self.data_file)
 
         # TODO: remove this line, this was only for debugging
         # data_split = self.data_file.stem
@@ -67,75 +85,75 @@ class ProteinLigandDataset(dgl.data.DGLDataset):
 
     def __getitem__(self, i):
 
+        example = self.get_raw_example(i)
 
-        lig_start_idx, lig_end_idx = self.lig_segments[i:i+2]
-        rec_start_idx, rec_end_idx = self.rec_segments[i:i+2]
-        ip_start_idx, ip_end_idx = self.ip_segments[i:i+2]
+        complex_graph = build_initial_complex_graph(example['rec_pos'], example['rec_feat'], example['rec_res_idx'], n_keypoints=self.n_keypoints, cutoffs=self.graph_cutoffs, 
+                                                    lig_atom_positions=example['lig_pos'], lig_atom_features=example['lig_feat'],
+                                                    fixed_keypoints=self.fixed_keypoints, rr_edges=example.get('rr_edges'), same_res_edge=example.get('same_res_edge'))
 
-        lig_pos = self.lig_pos[lig_start_idx:lig_end_idx]
-        lig_feat = self.lig_feat[lig_start_idx:lig_end_idx]
-        rec_pos = self.rec_pos[rec_start_idx:rec_end_idx]
-        rec_feat = self.rec_feat[rec_start_idx:rec_end_idx]
-        interface_points = self.interface_points[ip_start_idx:ip_end_idx]
-        rec_res_idx = self.rec_res_idx[rec_start_idx:rec_end_idx]
+        # node features are element indicies, they are expanded to one-hot features by KeypointDiffusion.expand_element_features once the batch is on the device
+        return complex_graph, example['interface_points']
 
+    def get_raw_example(self, i, fake_atoms: bool = True) -> Dict[str, torch.Tensor]:
+        """Returns the tensors of example i without building a graph. These are batched into a graph by batched_collate_fn. 
+        Atom features are returned as uint8 element indicies. If fake_atoms is False, fake ligand atoms are not added, batched_collate_fn adds them for the whole batch."""
 
-        complex_graph = build_initial_complex_graph(rec_pos, rec_feat, rec_res_idx, n_keypoints=self.n_keypoints, cutoffs=self.graph_cutoffs, lig_atom_positions=lig_pos, lig_atom_features=lig_feat)
+        pocket_idx = self.get_pocket_idx(i)
+        lig_start_idx, lig_end_idx = self.lig_segments[i:i+2]
+        rec_start_idx, rec_end_idx = self.rec_segments[pocket_idx:pocket_idx+2]
+        ip_start_idx, ip_end_idx = self.ip_segments[i:i+2]
 
-        # complex_graph = self.data['complex_graph'][i]
-        # interface_points = self.data['interface_points'][i]
+        example = {
+            'lig_pos': as_tensor(self.lig_pos[lig_start_idx:lig_end_idx]),
+            'lig_feat': element_idxs(as_tensor(self.lig_feat[lig_start_idx:lig_end_idx])),
+            'rec_pos': as_tensor(self.rec_pos[rec_start_idx:rec_end_idx]),
+            'rec_feat': element_idxs(as_tensor(self.rec_feat[rec_start_idx:rec_end_idx])),
+            'rec_res_idx': as_tensor(self.rec_res_idx[rec_start_idx:rec_end_idx]),
+            'interface_points': as_tensor(self.interface_points[ip_start_idx:ip_end_idx]),
+        }
+
+        # use rr edges stored in the processed data if they were computed with our rr cutoff
+        if self.use_stored_rr_edges:
+            rr_start_idx, rr_end_idx = self.rr_segments[pocket_idx:pocket_idx+2]
+            example['rr_edges'] = as_tensor(self.rr_edges[rr_start_idx:rr_end_idx]).T
+            example['same_res_edge'] = as_tensor(self.rr_same_res[rr_start_idx:rr_end_idx])
 
         # add fake atoms to ligand
-        if self.max_fake_atom_frac > 0:
-
-            n_real_atoms = lig_pos.shape[0]
-
-            # add extra column for "no atom" type to the atom features
-            lig_feat = torch.concat([lig_feat, torch.zeros(n_real_atoms, 1, dtype=lig_feat.dtype)], dim=1)
-
-            n_fake_max = math.ceil(self.max_fake_atom_frac*n_real_atoms) # maximum possible number of fake atoms
-            n_fake = int(torch.randint(0, n_fake_max+1, (1,))) # sample number of fake atoms from Uniform(0, n_fake_max)
-
-            # if we have decided to add a non-zero number of fake atoms
-            if n_fake != 0:
-                max_coords, _ = lig_pos.max(dim=0, keepdim=True)
-                min_coords, _ = lig_pos.min(dim=0, keepdim=True)
-                fake_atom_positions = torch.rand(n_fake, 3)*(max_coords - min_coords) + min_coords
-
-                lig_pos = torch.concat([lig_pos, fake_atom_positions], dim=0)
-
-                fake_atom_features = torch.zeros(n_fake, lig_feat.shape[1], dtype=lig_feat.dtype)
-                fake_atom_features[:, -1] = 1
-
-                lig_feat = torch.concat([lig_feat, fake_atom_features], dim=0)
-
-                complex_graph.add_nodes(n_fake, ntype='lig')
-                complex_graph.nodes['lig'].data['x_0'] = lig_pos
-                complex_graph.nodes['lig'].data['h_0'] = lig_feat
-            else:
-                complex_graph.nodes['lig'].data['h_0'] = lig_feat
-        
-        for ntype in ['lig', 'rec']:
-            complex_graph.nodes[ntype].data['h_0'] = complex_graph.nodes[ntype].data['h_0'].float()
+        if fake_atoms and self.max_fake_atom_frac > 0:
+            n_lig_atoms = torch.tensor([ example['lig_pos'].shape[0] ])
+            example['lig_pos'], example['lig_feat'], _ = add_fake_atoms(example['lig_pos'], example['lig_feat'], n_lig_atoms, self.max_fake_atom_frac, fake_atom_idx=len(self.lig_elements))
 
-        return complex_graph, interface_points
+        return example
 
     def __len__(self):
         return self.lig_segments.shape[0] - 1
 
+    def get_pocket_idx(self, i) -> int:
+        """Returns the index of the pocket of example i. Examples whose pockets have identical atoms share one copy of the pocket in the processed data, 
+        data processed before pockets were deduplicated stores one pocket per example."""
+        if self.pocket_idx is None:
+            return i
+        return int(self.pocket_idx[i])
+
     def process(self):
+        self.rr_cutoff = None
+        self.pocket_idx = None
+
         # load data into memory
         if not self.load_data:
             self.lig_segments = torch.tensor([0])
+        elif self.columnar_dir is not None:
+            self.load_columns()
         else:
 
             with open(self.data_file, 'rb') as f:
                 data = pickle.load(f)
 
             self.lig_pos = data['lig_pos']
-            self.lig_feat = data['lig_feat']
+            # one-hot features in data processed before features were stored as element indicies are converted on load
+            self.lig_feat = element_idxs(data['lig_feat'])
             self.rec_pos = data['rec_pos']
-            self.rec_feat = data['rec_feat']
+            self.rec_feat = element_idxs(data['rec_feat'])
             self.interface_points = data['interface_points']
             self.rec_segments = data['rec_segments']
             self.lig_segments = data['lig_segments']
@@ -143,6 +161,79 @@ class ProteinLigandDataset(dgl.data.DGLDataset):
             self.rec_files = data['rec_files']
             self.lig_files = data['lig_files']
             self.rec_res_idx = data['rec_res_idx']
+            self.pocket_idx = data.get('pocket_idx')
+
+            if 'rr_cutoff' in data:
+                self.rr_cutoff = data['rr_cutoff']
+                self.rr_edges = data['rr_edges']
+                self.rr_same_res = data['rr_same_res']
+                self.rr_segments = data['rr_segments']
+
+            if self.share_memory:
+                self.move_to_shared_memory()
+
+        if self.rr_cutoff is not None and not self.use_stored_rr_edges:
+            print(f'rr edges in {self.data_file} were computed with a cutoff of {self.rr_cutoff}, they will be recomputed with a cutoff of {self.graph_cutoffs["rr"]}', flush=True)
+
+    @property
+    def use_stored_rr_edges(self) -> bool:
+        return self.rr_cutoff is not None and self.rr_cutoff == self.graph_cutoffs['rr']
+
+    def example_sizes(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Returns the number of nodes and an estimate of the number of edges in the graph of every example, computed from the segment arrays 
+        without loading any examples. 
+
+        Ligand edges are drawn during the forward pass, they are counted as if every ligand atom is connected to every other ligand atom and to every keypoint. 
+        rr edges are only counted if they are stored in the processed data."""
+        n_rec_atoms = torch.diff(as_tensor(self.rec_segments[:]))
+        if self.pocket_idx is not None:
+            n_rec_atoms = n_rec_atoms[as_tensor(self.pocket_idx[:])]
+        n_lig_atoms = torch.diff(as_tensor(self.lig_segments[:]))
+        if self.max_fake_atom_frac > 0:
+            n_lig_atoms = n_lig_atoms + torch.ceil(n_lig_atoms*self.max_fake_atom_frac).long()
+        n_kp = n_rec_atoms if self.fixed_keypoints else torch.full_like(n_rec_atoms, self.n_keypoints)
+
+        # with fixed keypoints, receptor atoms are stored as keypoints and rr edges as kk edges
+        n_rec_nodes = torch.zeros_like(n_rec_atoms) if self.fixed_keypoints else n_rec_atoms
+        n_nodes = n_rec_nodes + n_kp + n_lig_atoms
+        n_edges = n_lig_atoms*(n_lig_atoms - 1) + 2*n_kp*n_lig_atoms
+        if self.use_stored_rr_edges:
+            n_rr_edges = torch.diff(as_tensor(self.rr_segments[:]))
+            if self.pocket_idx is not None:
+                n_rr_edges = n_rr_edges[as_tensor(self.pocket_idx[:])]
+            n_edges = n_edges + n_rr_edges
+        return n_nodes, n_edges
+
+    def move_to_shared_memory(self):
+        # tensors are moved into shared memory, which forked and spawned workers attach to instead of copying. file lists are converted to 
+        # string tables because the pages of python strings are gradually copied into every forked worker as their refcounts are updated. 
+        # columnar datasets do not need this, their memory-mapped columns are already shared through the page cache.
+        for key in ARRAY_COLUMNS + RR_EDGE_COLUMNS + POCKET_COLUMNS:
+            column = getattr(self, key, None)
+            if isinstance(column, torch.Tensor):
+                column.share_memory_()
+        for key in STRING_COLUMNS:
+            str_data, str_offsets = StringTable.encode(getattr(self, key))
+            setattr(self, key, StringTable(torch.from_numpy(str_data.copy()).share_memory_(), torch.from_numpy(str_offsets).share_memory_()))
+
+    def load_columns(self):
+        # columns are memory-mapped, nothing is read from disk until examples are accessed
+        self.pocket_idx = None
+        for key, column in read_columnar(self.columnar_dir).items():
+            setattr(self, key, column)
+
+    def __getstate__(self):
+        # memory-mapped columns would be copied into the pickle when the dataset is sent to a spawned worker process, so they are reopened instead
+        state = self.__dict__.copy()
+        if self.columnar_dir is not None:
+            for key in ARRAY_COLUMNS + STRING_COLUMNS + RR_EDGE_COLUMNS + POCKET_COLUMNS:
+                state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.columnar_dir is not None and self.load_data:
+            self.load_columns()
 
     def lig_atom_idx_to_element(self, element_idxs: List[int]):
         atom_elements = [ self.lig_reverse_map[element_idx] for element_idx in element_idxs ]
@@ -163,6 +254,196 @@ class ProteinLigandDataset(dgl.data.DGLDataset):
 
         return self.rec_files[idx], self.lig_files[idx]
 
+
+def add_fake_atoms(lig_pos: torch.Tensor, lig_feat: torch.Tensor, n_lig_atoms: torch.Tensor, max_fake_atom_frac: float, fake_atom_idx: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Appends a random number of fake atoms, up to max_fake_atom_frac of the real atoms, to every ligand in a batch. lig_pos and lig_feat hold the 
+    atoms of all ligands one after another and n_lig_atoms the number of atoms in each ligand. lig_feat contains element indicies, fake atoms are 
+    given the "no atom" type fake_atom_idx. 
+
+    Returns the positions, features and number of atoms of the ligands with fake atoms placed after the real atoms of their ligand."""
+
+    batch_size = n_lig_atoms.shape[0]
+    batch_idx = torch.repeat_interleave(torch.arange(batch_size), n_lig_atoms)
+
+    # sample the number of fake atoms of every ligand from Uniform(0, n_fake_max)
+    n_fake_max = torch.ceil(n_lig_atoms.double()*max_fake_atom_frac).long()
+    n_fake = torch.floor(torch.rand(batch_size, dtype=torch.float64)*(n_fake_max + 1)).long()
+    fake_batch_idx = torch.repeat_interleave(torch.arange(batch_size), n_fake)
+
+    # place fake atoms uniformly at random in the bounding box of their ligand
+    coord_batch_idx = batch_idx[:, None].expand(-1, 3)
+    min_coords = lig_pos.new_full((batch_size, 3), math.inf).scatter_reduce(0, coord_batch_idx, lig_pos, reduce='amin')
+    max_coords = lig_pos.new_full((batch_size, 3), -math.inf).scatter_reduce(0, coord_batch_idx, lig_pos, reduce='amax')
+    fake_pos = torch.rand(fake_batch_idx.shape[0], 3)*(max_coords - min_coords)[fake_batch_idx] + min_coords[fake_batch_idx]
+
+    # compute where every real and fake atom goes in the output arrays
+    n_atoms_out = n_lig_atoms + n_fake
+    out_offsets = torch.cumsum(n_atoms_out, dim=0) - n_atoms_out
+    real_offsets = torch.cumsum(n_lig_atoms, dim=0) - n_lig_atoms
+    fake_offsets = torch.cumsum(n_fake, dim=0) - n_fake
+    real_dst = out_offsets[batch_idx] + torch.arange(batch_idx.shape[0]) - real_offsets[batch_idx]
+    fake_dst = out_offsets[fake_batch_idx] + n_lig_atoms[fake_batch_idx] + torch.arange(fake_batch_idx.shape[0]) - fake_offsets[fake_batch_idx]
+
+    n_total = batch_idx.shape[0] + fake_batch_idx.shape[0]
+    out_pos = lig_pos.new_empty((n_total, 3))
+    out_pos[real_dst] = lig_pos
+    out_pos[fake_dst] = fake_pos
+    out_feat = torch.full((n_total,), fake_atom_idx, dtype=lig_feat.dtype)
+    out_feat[real_dst] = lig_feat
+
+    return out_pos, out_feat, n_atoms_out
+
+
+class BudgetBatchSampler(torch.utils.data.Sampler):
+    """Forms batches whose total number of nodes and/or edges stays under a budget, instead of batches with a fixed number of examples.
+
+    Every epoch, the examples are shuffled and split into pools of pool_size examples. Each pool is sorted by size and packed greedily 
+    into batches, so that examples of similar size are batched together, and then the order of all batches is shuffled. 
+    n_nodes and n_edges are the number of nodes and edges of every example, e.g. from ProteinLigandDataset.example_sizes. 
+    An example that exceeds the budget on its own forms a batch by itself. Call set_epoch at the start of every epoch to reshuffle.
+    """
+
+    def __init__(self, n_nodes: torch.Tensor, n_edges: torch.Tensor = None, max_nodes: int = None, max_edges: int = None, max_batch_size: int = None, 
+                 pool_size: int = 1024, shuffle: bool = True, seed: int = 0):
+        if max_nodes is None and max_edges is None:
+            raise ValueError('at least one of max_nodes and max_edges must be specified')
+        if max_edges is not None and n_edges is None:
+            raise ValueError('n_edges must be given to use an edge budget')
+
+        self.n_nodes = n_nodes
+        self.n_edges = n_edges if n_edges is not None else torch.zeros_like(n_nodes)
+        self.max_nodes = max_nodes if max_nodes is not None else math.inf
+        self.max_edges = max_edges if max_edges is not None else math.inf
+        self.max_batch_size = max_batch_size if max_batch_size is not None else math.inf
+        self.pool_size = pool_size
+        self.shuffle = shuffle
+        self.seed = seed
+
+        self.epoch = 0
+        self.batches = None
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+        self.batches = None
+
+    def make_batches(self) -> List[List[int]]:
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        n_examples = self.n_nodes.shape[0]
+        example_idxs = torch.randperm(n_examples, generator=generator) if self.shuffle else torch.arange(n_examples)
+
+        batches = []
+        for pool in example_idxs.split(self.pool_size):
+            pool = pool[torch.argsort(self.n_nodes[pool], stable=True)]
+
+            batch, batch_nodes, batch_edges = [], 0, 0
+            for idx, n_nodes, n_edges in zip(pool.tolist(), self.n_nodes[pool].tolist(), self.n_edges[pool].tolist()):
+                over_budget = batch_nodes + n_nodes > self.max_nodes or batch_edges + n_edges > self.max_edges or len(batch) + 1 > self.max_batch_size
+                if batch and over_budget:
+                    batches.append(batch)
+                    batch, batch_nodes, batch_edges = [], 0, 0
+                batch.append(idx)
+                batch_nodes += n_nodes
+                batch_edges += n_edges
+            if batch:
+                batches.append(batch)
+
+        if self.shuffle:
+            batches = [ batches[i] for i in torch.randperm(len(batches), generator=generator).tolist() ]
+        return batches
+
+    def __iter__(self):
+        if self.batches is None:
+            self.batches = self.make_batches()
+        return iter(self.batches)
+
+    def __len__(self):
+        if self.batches is None:
+            self.batches = self.make_batches()
+        return len(self.batches)
+
+
+class ShardedDataset(torch.utils.data.IterableDataset):
+    """Streams the examples of a sharded dataset directory, as written by convert_dataset.py --examples_per_shard.
+
+    Shard i is read by the process with rank i % world_size, so every process only opens its share of the shards, and the shards of a process 
+    are split among its dataloader workers. Workers beyond the number of shards of a process receive no examples. Every epoch, each worker reads 
+    its shards in a random order, visits the examples of each shard in a random order, and yields them through a shuffle buffer of 
+    shuffle_buffer_size examples. The order only depends on seed, the rank, the worker and the epoch set with set_epoch. 
+
+    Keyword arguments are passed to the ProteinLigandDataset that opens each shard."""
+
+    def __init__(self, shard_dir: str, rank: int = 0, world_size: int = 1, shuffle: bool = True, shuffle_buffer_size: int = 1000, seed: int = 0, **dataset_kwargs):
+        self.shard_dir = Path(shard_dir)
+        self.shards = read_shard_index(self.shard_dir)['shards'][rank::world_size]
+        self.rank = rank
+        self.shuffle = shuffle
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.epoch = 0
+        self.dataset_kwargs = dataset_kwargs
+
+        # if True, raw examples without fake atoms are yielded for batched_collate_fn instead of graphs
+        self.raw_examples = False
+
+        # graph and batch construction settings, as in ProteinLigandDataset
+        self.n_keypoints = dataset_kwargs['n_keypoints']
+        self.graph_cutoffs = dataset_kwargs['graph_cutoffs']
+        self.lig_elements = dataset_kwargs['lig_elements']
+        self.fixed_keypoints = dataset_kwargs.get('fixed_keypoints', False)
+        self.max_fake_atom_frac = dataset_kwargs.get('max_fake_atom_frac', 0.0)
+
+    def __len__(self):
+        # the number of examples read by this process over all of its workers
+        return sum( shard['n_examples'] for shard in self.shards )
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def open_shard(self, shard: dict) -> ProteinLigandDataset:
+        # shards are columnar datasets, opening one only memory-maps its columns
+        return ProteinLigandDataset(name=shard['name'], processed_data_file=str(self.shard_dir / shard['name']), **self.dataset_kwargs)
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+
+        # all workers of a process agree on the shard order of the epoch, each worker then draws example orders from its own generator
+        epoch_generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        shard_order = torch.randperm(len(self.shards), generator=epoch_generator).tolist() if self.shuffle else list(range(len(self.shards)))
+        worker_generator = torch.Generator().manual_seed(hash((self.seed, self.epoch, self.rank, worker_id)) % 2**63)
+
+        buffer = []
+        for shard_idx in shard_order[worker_id::num_workers]:
+            shard = self.open_shard(self.shards[shard_idx])
+            example_order = torch.randperm(len(shard), generator=worker_generator).tolist() if self.shuffle else range(len(shard))
+            for example_idx in example_order:
+                example = shard.get_raw_example(example_idx, fake_atoms=False) if self.raw_examples else shard[example_idx]
+                if not self.shuffle:
+                    yield example
+                elif len(buffer) < self.shuffle_buffer_size:
+                    buffer.append(example)
+                else:
+                    # yield a random example from the buffer and replace it with the new one
+                    swap_idx = int(torch.randint(len(buffer), (1,), generator=worker_generator))
+                    yield buffer[swap_idx]
+                    buffer[swap_idx] = example
+
+        for buffer_idx in torch.randperm(len(buffer), generator=worker_generator).tolist():
+            yield buffer[buffer_idx]
+
+
+class RawExamples(torch.utils.data.Dataset):
+    """A view of a ProteinLigandDataset that returns the raw tensors of each example, without fake atoms, for use with batched_collate_fn."""
+
+    def __init__(self, dataset: ProteinLigandDataset):
+        self.dataset = dataset
+
+    def __getitem__(self, i):
+        return self.dataset.get_raw_example(i, fake_atoms=False)
+
+    def __len__(self):
+        return len(self.dataset)
+
         
 def collate_fn(examples: list):
 
@@ -173,7 +454,194 @@ def collate_fn(examples: list):
     complex_graphs = dgl.batch(complex_graphs)
     return complex_graphs, interface_points
 
-def get_dataloader(dataset: ProteinLigandDataset, batch_size: int, num_workers: int = 1, **kwargs) -> GraphDataLoader:
+def batched_collate_fn(examples: List[Dict[str, torch.Tensor]], n_keypoints: int, graph_cutoffs: dict, fixed_keypoints: bool = False, 
+                       max_fake_atom_frac: float = 0.0, fake_atom_idx: int = None):
+    """Builds one batched complex graph from the raw tensors of every example, as returned by ProteinLigandDataset.get_raw_example. 
+    If max_fake_atom_frac > 0, fake atoms are added to all ligands of the batch at once."""
+
+    n_rec_atoms = torch.tensor([ ex['rec_pos'].shape[0] for ex in examples ])
+    n_lig_atoms = torch.tensor([ ex['lig_pos'].shape[0] for ex in examples ])
+    lig_pos = torch.cat([ ex['lig_pos'] for ex in examples ], dim=0)
+    lig_feat = torch.cat([ ex['lig_feat'] for ex in examples ], dim=0)
+    if max_fake_atom_frac > 0:
+        lig_pos, lig_feat, n_lig_atoms = add_fake_atoms(lig_pos, lig_feat, n_lig_atoms, max_fake_atom_frac, fake_atom_idx)
+
+    # stored rr edges are indicies within each complex, they are offset into the batch when the graph is built
+    rr_edges, same_res_edge, n_rr_edges = None, None, None
+    if 'rr_edges' in examples[0]:
+        rr_edges = torch.cat([ ex['rr_edges'] for ex in examples ], dim=1)
+        same_res_edge = torch.cat([ ex['same_res_edge'] for ex in examples ], dim=0)
+        n_rr_edges = torch.tensor([ ex['rr_edges'].shape[1] for ex in examples ])
+
+    complex_graphs = build_complex_graph_batch(
+        rec_atom_positions=torch.cat([ ex['rec_pos'] for ex in examples ], dim=0),
+        rec_atom_features=torch.cat([ ex['rec_feat'] for ex in examples ], dim=0),
+        pocket_res_idx=torch.cat([ ex['rec_res_idx'] for ex in examples ], dim=0),
+        n_rec_atoms=n_rec_atoms,
+        lig_atom_positions=lig_pos,
+        lig_atom_features=lig_feat,
+        n_lig_atoms=n_lig_atoms,
+        n_keypoints=n_keypoints,
+        cutoffs=graph_cutoffs,
+        fixed_keypoints=fixed_keypoints,
+        rr_edges=rr_edges,
+        same_res_edge=same_res_edge,
+        n_rr_edges=n_rr_edges)
+
+    interface_points = tuple( ex['interface_points'] for ex in examples )
+    return complex_graphs, interface_points
+
+def get_dataloader(dataset: ProteinLigandDataset, batch_size: int, num_workers: int = 1, batched_collate: bool = False, batch_budget: dict = None, **kwargs) -> GraphDataLoader:
+    """Creates a dataloader that yields batched complex graphs and interface points.
+
+    If batched_collate is True, examples are loaded as raw tensors and each batch is built into a single graph by batched_collate_fn, 
+    instead of building a graph for every example and batching them with dgl.batch.
+
+    If batch_budget is specified, batches are formed by a BudgetBatchSampler and batch_size is ignored. batch_budget contains keyword 
+    arguments of BudgetBatchSampler, e.g. max_nodes and max_edges. The sampler is available as dataloader.batch_sampler.
+
+    ShardedDatasets are loaded by get_sharded_dataloader."""
 
-    dataloader = GraphDataLoader(dataset, batch_size=batch_size, drop_last=False, num_workers=num_workers, collate_fn=collate_fn, **kwargs)
+    if isinstance(dataset, ShardedDataset):
+        return get_sharded_dataloader(dataset, batch_size, num_workers, batched_collate, batch_budget, **kwargs)
+
+    if batch_budget is not None:
+        n_nodes, n_edges = dataset.example_sizes()
+        batch_sampler = BudgetBatchSampler(n_nodes, n_edges, shuffle=kwargs.pop('shuffle', False), **batch_budget)
+        batching_kwargs = { 'batch_sampler': batch_sampler }
+    else:
+        batching_kwargs = { 'batch_size': batch_size, 'drop_last': False }
+
+    if batched_collate:
+        batch_collate_fn = partial(batched_collate_fn, n_keypoints=dataset.n_keypoints, graph_cutoffs=dataset.graph_cutoffs, fixed_keypoints=dataset.fixed_keypoints, 
+                                   max_fake_atom_frac=dataset.max_fake_atom_frac, fake_atom_idx=len(dataset.lig_elements))
+        return GraphDataLoader(RawExamples(dataset), num_workers=num_workers, collate_fn=batch_collate_fn, **batching_kwargs, **kwargs)
+
+    dataloader = GraphDataLoader(dataset, num_workers=num_workers, collate_fn=collate_fn, **batching_kwargs, **kwargs)
     return dataloader
+
+def get_sharded_dataloader(dataset: ShardedDataset, batch_size: int, num_workers: int = 1, batched_collate: bool = False, batch_budget: dict = None, **kwargs) -> GraphDataLoader:
+    # sharded datasets shuffle examples themselves, and example sizes are not known up front so batches cannot be formed under a budget
+    if batch_budget is not None:
+        raise ValueError('batch budgets are not supported for sharded datasets')
+    kwargs.pop('shuffle', None)
+
+    dataset.raw_examples = batched_collate
+    if batched_collate:
+        batch_collate_fn = partial(batched_collate_fn, n_keypoints=dataset.n_keypoints, graph_cutoffs=dataset.graph_cutoffs, fixed_keypoints=dataset.fixed_keypoints, 
+                                   max_fake_atom_frac=dataset.max_fake_atom_frac, fake_atom_idx=len(dataset.lig_elements))
+    else:
+        batch_collate_fn = collate_fn
+    return GraphDataLoader(dataset, batch_size=batch_size, drop_last=False, num_workers=num_workers, collate_fn=batch_collate_fn, **kwargs)
+
+
+class DevicePrefetcher:
+    """Wraps a dataloader of complex graphs and interface points and moves the next n_prefetch batches to the device in a background thread, 
+    so that loading and transferring batches overlaps with the forward/backward pass. 
+
+    On cuda devices, batches are copied on a separate stream with non-blocking copies, which only overlap with compute if the host tensors are 
+    pinned (e.g. pin_memory=True in the dataloader). Interface points are pinned and copied in a single transfer. On other devices the background 
+    thread only stages batches. If n_prefetch is 0, batches are moved to the device synchronously when they are requested. 
+    If move_interface_points is False, interface points are left on the host."""
+
+    # markers put on the queue by the staging thread
+    end_of_data = object()
+
+    def __init__(self, dataloader: GraphDataLoader, device: torch.device, n_prefetch: int = 2, move_interface_points: bool = True):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.n_prefetch = n_prefetch
+        self.move_interface_points = move_interface_points
+        self.use_cuda_stream = self.device.type == 'cuda'
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    @property
+    def batch_sampler(self):
+        return self.dataloader.batch_sampler
+
+    def to_device(self, complex_graphs: dgl.DGLHeteroGraph, interface_points: List[torch.Tensor]):
+        complex_graphs = complex_graphs.to(self.device, non_blocking=True)
+        if not self.move_interface_points:
+            return complex_graphs, interface_points
+
+        # interface points are concatenated so they are copied in one transfer, then split back out into per-complex tensors on the device
+        n_interface_points = [ arr.shape[0] for arr in interface_points ]
+        interface_points = torch.cat(interface_points, dim=0)
+        if self.use_cuda_stream:
+            interface_points = interface_points.pin_memory()
+        interface_points = torch.split(interface_points.to(self.device, non_blocking=True), n_interface_points)
+        return complex_graphs, interface_points
+
+    def put(self, batch_queue: queue.Queue, item, stop: threading.Event) -> bool:
+        # returns False if iteration was stopped while waiting for space in the queue
+        while not stop.is_set():
+            try:
+                batch_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def stage_batches(self, batch_queue: queue.Queue, stop: threading.Event):
+        stream = torch.cuda.Stream(device=self.device) if self.use_cuda_stream else None
+        try:
+            for complex_graphs, interface_points in self.dataloader:
+                if stream is None:
+                    item = (self.to_device(complex_graphs, interface_points), None)
+                else:
+                    with torch.cuda.stream(stream):
+                        batch = self.to_device(complex_graphs, interface_points)
+                        ready = torch.cuda.Event()
+                        ready.record(stream)
+                    item = (batch, ready)
+                if not self.put(batch_queue, item, stop):
+                    return
+            self.put(batch_queue, self.end_of_data, stop)
+        except Exception as e:
+            # exceptions are raised again in the thread that iterates over the prefetcher
+            self.put(batch_queue, e, stop)
+
+    def __iter__(self):
+        if self.n_prefetch == 0:
+            for complex_graphs, interface_points in self.dataloader:
+                yield self.to_device(complex_graphs, interface_points)
+            return
+
+        batch_queue = queue.Queue(maxsize=self.n_prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.stage_batches, args=(batch_queue, stop), daemon=True)
+        thread.start()
+
+        # tensors copied on the staging stream may only be freed once the compute stream has finished using them, otherwise the staging 
+        # stream could reuse their memory too early. batches that have been handed out are kept alive until an event recorded on the 
+        # compute stream after they were used has completed.
+        in_use = deque()
+        prev_batch = None
+        try:
+            while True:
+                item = batch_queue.get()
+                if item is self.end_of_data:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                batch, ready = item
+                if ready is not None:
+                    compute_stream = torch.cuda.current_stream(self.device)
+                    compute_stream.wait_event(ready)
+                    if prev_batch is not None:
+                        done = torch.cuda.Event()
+                        done.record(compute_stream)
+                        in_use.append((prev_batch, done))
+                    while in_use and in_use[0][1].query():
+                        in_use.popleft()
+                    prev_batch = batch
+
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+            if self.use_cuda_stream:
+                torch.cuda.current_stream(self.device).synchronize()
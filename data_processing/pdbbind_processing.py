@@ -9,7 +9,9 @@ from scipy import spatial as spa
 import dgl
 from torch_cluster import radius, radius_graph
 
-from typing import Iterable, Union, List, Dict
+from typing import Iterable, Union, List, Dict, Tuple
+
+from utils import BatchLayout
 
 class Unparsable(Exception):
     pass
@@ -218,13 +220,32 @@ def build_receptor_graph(atom_positions: torch.Tensor, atom_features: torch.Tens
     g.ndata['h_0'] = atom_features
     return g
 
-def build_initial_complex_graph(rec_atom_positions: torch.Tensor, rec_atom_features: torch.Tensor, pocket_res_idx: torch.Tensor, n_keypoints: int, cutoffs: dict, lig_atom_positions: torch.Tensor = None, lig_atom_features: torch.Tensor = None):
+def compute_rr_edges(rec_atom_positions: torch.Tensor, pocket_res_idx: torch.Tensor, rr_cutoff: float) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Returns the rec atom -> rec atom edges of a pocket, with shape (2, n_edges), and whether the two atoms of every edge are in the same residue."""
+    rr_edges = radius_graph(rec_atom_positions, r=rr_cutoff, max_num_neighbors=100)
+    same_res_edge = pocket_res_idx[rr_edges[0]] == pocket_res_idx[rr_edges[1]]
+    return rr_edges, same_res_edge
+
+def build_initial_complex_graph(rec_atom_positions: torch.Tensor, rec_atom_features: torch.Tensor, pocket_res_idx: torch.Tensor, n_keypoints: int, cutoffs: dict, lig_atom_positions: torch.Tensor = None, lig_atom_features: torch.Tensor = None,
+                                fixed_keypoints: bool = False, rr_edges: torch.Tensor = None, same_res_edge: torch.Tensor = None):
+    """Builds the receptor/keypoint/ligand graph for a single complex.
+
+    If fixed_keypoints is True, the graph is built as the fixed receptor encoder would leave it: the receptor atoms are stored as keypoints 
+    with kk edges in place of rr edges, there are no receptor nodes, and n_keypoints is ignored.
+    rr_edges and same_res_edge can be passed if they have been precomputed with compute_rr_edges using cutoffs['rr'].
+    """
 
     if (lig_atom_positions is not None) ^ (lig_atom_features is not None):
         raise ValueError('ligand position and features must be either be both supplied or both left as None')
 
     n_rec_atoms = rec_atom_positions.shape[0]
 
+    if fixed_keypoints:
+        n_keypoints = n_rec_atoms
+        n_rec_nodes = 0
+    else:
+        n_rec_nodes = n_rec_atoms
+
     if lig_atom_positions is None:
         n_lig_atoms = 0
     else:
@@ -242,20 +263,21 @@ def build_initial_complex_graph(rec_atom_positions: torch.Tensor, rec_atom_featu
         ('lig', 'lk', 'kp'): no_edges
     }
 
-    # compute rec atom -> rec atom edges
-    rr_edges = radius_graph(rec_atom_positions, r=cutoffs['rr'], max_num_neighbors=100)
-    graph_data[('rec', 'rr', 'rec')] = (rr_edges[0], rr_edges[1])
+    # compute rec atom -> rec atom edges and the "same residue" feature for every rr edge
+    if rr_edges is None:
+        rr_edges, same_res_edge = compute_rr_edges(rec_atom_positions, pocket_res_idx, cutoffs['rr'])
 
-    # compute "same residue" feature ofr every rr edge
-    same_res_edge = pocket_res_idx[rr_edges[0]] == pocket_res_idx[rr_edges[1]]
+    # with fixed keypoints, keypoints are connected exactly like the receptor atoms they represent
+    if fixed_keypoints:
+        graph_data[('kp', 'kk', 'kp')] = (rr_edges[0], rr_edges[1])
+    else:
+        graph_data[('rec', 'rr', 'rec')] = (rr_edges[0], rr_edges[1])
 
-    # compute rec atom -> kp edges
-    rk_src_idx = torch.arange(n_rec_atoms).repeat(n_keypoints)
-    rk_dst_idx = torch.arange(n_keypoints).repeat_interleave(n_rec_atoms)
-    graph_data[('rec', 'rk', 'kp')] = (rk_src_idx, rk_dst_idx)
+    # rec atom -> kp edges are not stored. the receptor encoders compute keypoint positions with dense attention
+    # over all receptor atoms and then draw rk edges between keypoints and nearby receptor atoms
 
     num_nodes_dict = {
-        'rec': n_rec_atoms, 'kp': n_keypoints, 'lig': n_lig_atoms
+        'rec': n_rec_nodes, 'kp': n_keypoints, 'lig': n_lig_atoms
     }
 
     # create graph object
@@ -265,14 +287,83 @@ def build_initial_complex_graph(rec_atom_positions: torch.Tensor, rec_atom_featu
     if lig_atom_positions is not None:
         g.nodes['lig'].data['x_0'] = lig_atom_positions
         g.nodes['lig'].data['h_0'] = lig_atom_features
-    g.nodes['rec'].data['x_0'] = rec_atom_positions
-    g.nodes['rec'].data['h_0'] = rec_atom_features
+    if fixed_keypoints:
+        g.nodes['kp'].data['x_0'] = rec_atom_positions
+        g.nodes['kp'].data['h_0'] = rec_atom_features
+    g.nodes['rec'].data['x_0'] = rec_atom_positions[:n_rec_nodes]
+    g.nodes['rec'].data['h_0'] = rec_atom_features[:n_rec_nodes]
     
     # add edge data
-    g.edges['rr'].data['same_res'] = same_res_edge.view(-1, 1)
+    g.edges['rr'].data['same_res'] = same_res_edge[:g.num_edges('rr')].view(-1, 1)
 
     return g
 
+def build_complex_graph_batch(rec_atom_positions: torch.Tensor, rec_atom_features: torch.Tensor, pocket_res_idx: torch.Tensor, n_rec_atoms: torch.Tensor,
+                              lig_atom_positions: torch.Tensor, lig_atom_features: torch.Tensor, n_lig_atoms: torch.Tensor, 
+                              n_keypoints: int, cutoffs: dict, fixed_keypoints: bool = False, 
+                              rr_edges: torch.Tensor = None, same_res_edge: torch.Tensor = None, n_rr_edges: torch.Tensor = None) -> dgl.DGLHeteroGraph:
+    """Builds the batched graph of several complexes directly from their concatenated atoms. 
+    
+    The result is the same as calling build_initial_complex_graph on every complex and batching the graphs with dgl.batch, 
+    but the rr edges of all complexes are computed with one radius graph and the graph is created once. n_rec_atoms and n_lig_atoms 
+    are the number of atoms in every complex. Precomputed rr_edges hold indicies of receptor atoms within each complex, and n_rr_edges 
+    is the number of edges of every complex.
+    """
+    batch_size = n_rec_atoms.shape[0]
+    n_kp = n_rec_atoms if fixed_keypoints else torch.full_like(n_rec_atoms, n_keypoints)
+    rec_offsets = torch.cumsum(n_rec_atoms, dim=0) - n_rec_atoms
+
+    if rr_edges is None:
+        # edges are never drawn between atoms of different complexes, so one radius graph covers the whole batch
+        rec_batch_idx = torch.arange(batch_size).repeat_interleave(n_rec_atoms)
+        rr_edges = radius_graph(rec_atom_positions, r=cutoffs['rr'], batch=rec_batch_idx, max_num_neighbors=100)
+
+        # the edges of each complex have to be contiguous in a batched graph
+        edge_batch_idx = rec_batch_idx[rr_edges[1]]
+        rr_edges = rr_edges[:, torch.argsort(edge_batch_idx, stable=True)]
+        n_rr_edges = torch.bincount(edge_batch_idx, minlength=batch_size)
+        same_res_edge = pocket_res_idx[rr_edges[0]] == pocket_res_idx[rr_edges[1]]
+    else:
+        rr_edges = rr_edges + rec_offsets.repeat_interleave(n_rr_edges)
+
+    # with fixed keypoints, the receptor atoms are stored as keypoints and there are no receptor nodes
+    n_rec_nodes = torch.zeros_like(n_rec_atoms) if fixed_keypoints else n_rec_atoms
+
+    no_edges = ([], [])
+    graph_data = {
+        ('rec', 'rr', 'rec'): no_edges if fixed_keypoints else (rr_edges[0], rr_edges[1]),
+        ('rec', 'rk', 'kp'): no_edges,
+        ('kp', 'kk', 'kp'): (rr_edges[0], rr_edges[1]) if fixed_keypoints else no_edges,
+        ('kp', 'kl', 'lig'): no_edges,
+        ('lig', 'll', 'lig'): no_edges,
+        ('lig', 'lk', 'kp'): no_edges
+    }
+    num_nodes_dict = {
+        'rec': int(n_rec_nodes.sum()), 'kp': int(n_kp.sum()), 'lig': int(n_lig_atoms.sum())
+    }
+    g = dgl.heterograph(graph_data, num_nodes_dict=num_nodes_dict)
+
+    # add node and edge data
+    g.nodes['lig'].data['x_0'] = lig_atom_positions
+    g.nodes['lig'].data['h_0'] = lig_atom_features
+    if fixed_keypoints:
+        g.nodes['kp'].data['x_0'] = rec_atom_positions
+        g.nodes['kp'].data['h_0'] = rec_atom_features
+    n_rec_total = g.num_nodes('rec')
+    g.nodes['rec'].data['x_0'] = rec_atom_positions[:n_rec_total]
+    g.nodes['rec'].data['h_0'] = rec_atom_features[:n_rec_total]
+    g.edges['rr'].data['same_res'] = same_res_edge[:g.num_edges('rr')].view(-1, 1)
+
+    # record the number of nodes and edges of every complex
+    no_batch_edges = torch.zeros_like(n_rec_atoms)
+    num_edges = { etype: no_batch_edges for etype in g.canonical_etypes }
+    if fixed_keypoints:
+        num_edges[('kp', 'kk', 'kp')] = n_rr_edges
+    else:
+        num_edges[('rec', 'rr', 'rec')] = n_rr_edges
+    layout = BatchLayout(batch_size=batch_size, num_nodes={'rec': n_rec_nodes, 'kp': n_kp, 'lig': n_lig_atoms}, num_edges=num_edges)
+    return layout.apply(g)
+
 
 
 def get_ot_loss_weights(ligand: rdkit.Chem.rdchem.Mol, pdb_path: Path, pocket_atom_mask: torch.Tensor):
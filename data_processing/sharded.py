@@ -0,0 +1,106 @@
+import json
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+import torch
+
+from data_processing.columnar import STRING_COLUMNS, write_columnar
+
+# a sharded dataset is a directory containing an index file and one columnar dataset directory per shard. every shard is a
+# self-contained dataset: its segments start at zero and its pockets are only the pockets of its own examples. the index
+# records the name and number of examples of every shard, so a process only has to open the shards it reads.
+
+SHARD_FORMAT_VERSION = 1
+SHARD_INDEX_FILE = 'index.json'
+
+
+def sharded_dir(data_file: Path) -> Path:
+    """Returns the directory that the sharded version of a processed pickle file is written to."""
+    return Path(data_file).with_suffix('.shards')
+
+
+def gather_segments(data: dict, keys: List[str], segments: torch.Tensor, idxs: torch.Tensor) -> Tuple[torch.Tensor, Dict[str, torch.Tensor]]:
+    """Gathers the segments idxs of the columns in keys. Returns the segments of the gathered columns and the gathered columns."""
+    segments = torch.as_tensor(segments)
+    starts, ends = segments[idxs], segments[idxs+1]
+    sizes = ends - starts
+
+    # index of every element of the selected segments in the original columns
+    new_segments = torch.zeros(idxs.shape[0]+1, dtype=segments.dtype)
+    new_segments[1:] = torch.cumsum(sizes, dim=0)
+    element_idxs = torch.repeat_interleave(starts - new_segments[:-1], sizes) + torch.arange(int(new_segments[-1]))
+
+    gathered = { key: torch.as_tensor(data[key])[element_idxs] for key in keys }
+    return new_segments, gathered
+
+
+def select_examples(data: Dict[str, Union[torch.Tensor, list]], example_idxs: torch.Tensor) -> dict:
+    """Returns the processed data of the examples example_idxs, as stored in the pickle files written by process_bindingmoad.py."""
+    selected = {}
+
+    selected['lig_segments'], lig_columns = gather_segments(data, ['lig_pos', 'lig_feat'], data['lig_segments'], example_idxs)
+    selected['ip_segments'], ip_columns = gather_segments(data, ['interface_points'], data['ip_segments'], example_idxs)
+    selected.update(lig_columns)
+    selected.update(ip_columns)
+
+    # only the pockets of the selected examples are kept, and pocket indicies are renumbered accordingly
+    if 'pocket_idx' in data:
+        pocket_idxs, selected['pocket_idx'] = torch.unique(torch.as_tensor(data['pocket_idx'])[example_idxs], return_inverse=True)
+    else:
+        pocket_idxs = example_idxs
+    selected['rec_segments'], rec_columns = gather_segments(data, ['rec_pos', 'rec_feat', 'rec_res_idx'], data['rec_segments'], pocket_idxs)
+    selected.update(rec_columns)
+
+    if 'rr_cutoff' in data:
+        selected['rr_segments'], rr_columns = gather_segments(data, ['rr_edges', 'rr_same_res'], data['rr_segments'], pocket_idxs)
+        selected.update(rr_columns)
+        selected['rr_cutoff'] = data['rr_cutoff']
+
+    for key in STRING_COLUMNS:
+        strings = data.get(key, [])
+        selected[key] = [ strings[idx] for idx in example_idxs.tolist() ] if len(strings) > 0 else []
+
+    return selected
+
+
+def shard_example_order(n_examples: int, shuffle_seed: int = None) -> torch.Tensor:
+    """Returns the order in which examples are written to shards."""
+    if shuffle_seed is None:
+        return torch.arange(n_examples)
+    return torch.randperm(n_examples, generator=torch.Generator().manual_seed(shuffle_seed))
+
+
+def write_shards(data: Dict[str, Union[torch.Tensor, list]], output_dir: Path, examples_per_shard: int, shuffle_seed: int = None) -> dict:
+    """Writes processed data to a sharded dataset directory. If shuffle_seed is given, examples are shuffled before they are split into shards,
+    so that examples of the same protein, which are processed one after another, are spread over the shards. Returns the shard index."""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    n_examples = data['lig_segments'].shape[0] - 1
+    example_order = shard_example_order(n_examples, shuffle_seed)
+
+    shards = []
+    for shard_idx, example_idxs in enumerate(example_order.split(examples_per_shard)):
+        shard_name = f'shard_{shard_idx:05d}'
+        write_columnar(select_examples(data, example_idxs), output_dir / shard_name)
+        shards.append({ 'name': shard_name, 'n_examples': int(example_idxs.shape[0]) })
+
+    index = {
+        'format_version': SHARD_FORMAT_VERSION,
+        'n_examples': int(n_examples),
+        'shuffle_seed': shuffle_seed,
+        'shards': shards,
+    }
+    with open(output_dir / SHARD_INDEX_FILE, 'w') as f:
+        json.dump(index, f)
+    return index
+
+
+def read_shard_index(shard_dir: Path) -> dict:
+    """Reads the index of a sharded dataset directory. The index lists the name and number of examples of every shard."""
+    shard_dir = Path(shard_dir)
+    with open(shard_dir / SHARD_INDEX_FILE, 'r') as f:
+        index = json.load(f)
+    if index['format_version'] != SHARD_FORMAT_VERSION:
+        raise ValueError(f'sharded dataset {shard_dir} has format version {index["format_version"]}, expected {SHARD_FORMAT_VERSION}')
+    return index
@@ -0,0 +1,166 @@
+import argparse
+import json
+from pathlib import Path
+
+import dgl
+import torch
+import yaml
+from torch.export import Dim
+
+from data_processing.crossdocked.dataset import ProteinLigandDataset
+from model_setup import model_from_config
+from models.dense_gvp import DenseDenoisingStepGVP, DenseReceptorEncoderGVP
+from models.ligand_diffuser import KeypointDiffusion
+from utils import copy_graph, get_batch_idxs
+
+# files written to the artifact directory, read by run_exported_sampler.py
+ENCODER_FILE = 'rec_encoder.pt2'
+STEP_FILE = 'denoising_step.pt2'
+METADATA_FILE = 'metadata.json'
+
+
+def parse_arguments():
+    p = argparse.ArgumentParser(description='Export the receptor encoder and a single denoising step of a GVP model with torch.export so that ligands can be sampled without DGL or torch_cluster.')
+    p.add_argument('model_dir', type=Path, help='directory of training result for the model, e.g. trained_models/gvp_20kp')
+    p.add_argument('--output_dir', type=Path, default=None, help='directory the exported artifact is written to. defaults to model_dir/exported')
+    p.add_argument('--split', type=str, default='val', help='dataset split used to check the exported modules against the original model')
+    p.add_argument('--check_idx', type=int, default=0, help='index of the pocket used for the check')
+    p.add_argument('--check_batch_size', type=int, default=4)
+    p.add_argument('--check_lig_atoms', type=int, default=25)
+    p.add_argument('--max_rr_neighbors', type=int, default=64, help='maximum number of neighbors of each receptor atom in the receptor graph')
+    p.add_argument('--atol', type=float, default=1e-4)
+    p.add_argument('--seed', type=int, default=42)
+    args = p.parse_args()
+    return args
+
+
+@torch.no_grad()
+def check_encoder(model: KeypointDiffusion, dense_encoder: DenseReceptorEncoderGVP, ref_graph: dgl.DGLHeteroGraph, atol: float) -> dgl.DGLHeteroGraph:
+    """Compares keypoints computed by the dense encoder against the original receptor encoder. Returns the encoded graph."""
+    rec_pos, rec_feat = ref_graph.nodes['rec'].data['x_0'], ref_graph.nodes['rec'].data['h_0']
+    kp_pos, kp_feat, kp_vecs = dense_encoder(rec_pos, rec_feat)
+
+    g = model.encode_receptors(dgl.batch([ref_graph]))
+    ref_outputs = [ g.nodes['kp'].data['x_0'], g.nodes['kp'].data['h_0'], g.nodes['kp'].data['v_0'] ]
+    for name, ref_output, output in zip(['positions', 'scalars', 'vectors'], ref_outputs, [kp_pos, kp_feat, kp_vecs]):
+        max_diff = (ref_output - output).abs().max().item()
+        print(f'  keypoint {name}: max abs difference = {max_diff:.2e}')
+        assert max_diff < atol, f'keypoint {name} of the dense encoder do not match the receptor encoder'
+    return g
+
+
+@torch.no_grad()
+def check_step(model: KeypointDiffusion, dense_step: DenseDenoisingStepGVP, g_encoded: dgl.DGLHeteroGraph, batch_size: int, n_lig_atoms: int, atol: float):
+    """Compares one dense denoising step against KeypointDiffusion.sample_p_zs_given_zt, using the same noise for both."""
+    g = dgl.batch(copy_graph(g_encoded, n_copies=batch_size, lig_atoms_per_copy=torch.full((batch_size,), n_lig_atoms)))
+    g.nodes['lig'].data['x_0'] = torch.randn(g.num_nodes('lig'), 3)*2
+    g.nodes['lig'].data['h_0'] = torch.randn(g.num_nodes('lig'), dense_step.dynamics.n_lig_scalars)
+
+    step = torch.randint(0, model.n_timesteps, (batch_size,)).float()
+    inputs = (
+        g.nodes['lig'].data['x_0'].view(batch_size, n_lig_atoms, 3).clone(),
+        g.nodes['lig'].data['h_0'].view(batch_size, n_lig_atoms, -1).clone(),
+        g.nodes['kp'].data['x_0'].view(batch_size, -1, 3).clone(),
+        g.nodes['kp'].data['h_0'].view(batch_size, -1, g.nodes['kp'].data['h_0'].shape[1]).clone(),
+        g.nodes['kp'].data['v_0'].view(batch_size, -1, dense_step.dynamics.vector_size, 3).clone(),
+        step,
+    )
+
+    # sample_p_zs_given_zt draws position noise and then feature noise after the forward pass of the dynamics model
+    rng_state = torch.get_rng_state()
+    g = model.sample_p_zs_given_zt(step / model.n_timesteps, (step + 1) / model.n_timesteps, g, get_batch_idxs(g))
+    torch.set_rng_state(rng_state)
+    pos_noise = torch.randn(batch_size, n_lig_atoms, 3)
+    feat_noise = torch.randn(batch_size, n_lig_atoms, inputs[1].shape[2])
+
+    lig_pos, lig_feat, kp_pos = dense_step(*inputs, pos_noise, feat_noise)
+    ref_outputs = [ g.nodes['lig'].data['x_0'], g.nodes['lig'].data['h_0'], g.nodes['kp'].data['x_0'] ]
+    for name, ref_output, output in zip(['ligand positions', 'ligand features', 'keypoint positions'], ref_outputs, [lig_pos, lig_feat, kp_pos]):
+        max_diff = (ref_output - output.reshape(ref_output.shape)).abs().max().item()
+        print(f'  {name}: max abs difference = {max_diff:.2e}')
+        assert max_diff < atol, f'{name} of the dense denoising step do not match the original model'
+
+    return inputs + (pos_noise, feat_noise)
+
+
+def main():
+
+    args = parse_arguments()
+    output_dir = args.output_dir if args.output_dir is not None else args.model_dir / 'exported'
+    output_dir.mkdir(exist_ok=True, parents=True)
+
+    # load model configuration
+    with open(args.model_dir / 'config.yml', 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+
+    try:
+        rec_encoder_type = config['diffusion']['rec_encoder_type']
+    except KeyError:
+        rec_encoder_type = 'learned'
+
+    if rec_encoder_type != 'learned':
+        raise NotImplementedError('only models with a learned receptor encoder can be exported')
+    if config['dataset']['max_fake_atom_frac'] > 0:
+        raise NotImplementedError('exporting models trained with fake atoms is not supported')
+
+    # the exported artifact runs on cpu
+    device = torch.device('cpu')
+    torch.manual_seed(args.seed)
+
+    # create model and load weights
+    model: KeypointDiffusion = model_from_config(config).to(device)
+    model.load_state_dict(torch.load(args.model_dir / 'model.pt', map_location=device))
+    model.eval()
+
+    dense_encoder = DenseReceptorEncoderGVP(model.rec_encoder, max_rr_neighbors=args.max_rr_neighbors).eval()
+    dense_step = DenseDenoisingStepGVP(model).eval()
+
+    # check the dense modules against the original model on a pocket from the dataset
+    dataset_path = Path(config['dataset']['location'])
+    dataset = ProteinLigandDataset(name=args.split, processed_data_file=str(dataset_path / f'{args.split}.pkl'), **config['graph'], **config['dataset'])
+    ref_graph, _ = dataset[args.check_idx]
+    ref_graph = model.expand_element_features(ref_graph)
+
+    print('checking receptor encoder', flush=True)
+    encoder_inputs = (ref_graph.nodes['rec'].data['x_0'], ref_graph.nodes['rec'].data['h_0'])
+    g_encoded = check_encoder(model, dense_encoder, ref_graph, args.atol)
+    print('checking denoising step', flush=True)
+    step_inputs = check_step(model, dense_step, g_encoded, args.check_batch_size, args.check_lig_atoms, args.atol)
+
+    # export with a dynamic number of receptor atoms, complexes, and ligand atoms
+    n_rec = Dim('n_rec', min=2)
+    batch_size = Dim('batch_size', min=2)
+    n_lig = Dim('n_lig', min=2)
+    encoder_program = torch.export.export(dense_encoder, encoder_inputs, dynamic_shapes=({0: n_rec}, {0: n_rec}))
+    step_program = torch.export.export(dense_step, step_inputs, dynamic_shapes=(
+        {0: batch_size, 1: n_lig}, {0: batch_size, 1: n_lig}, {0: batch_size}, {0: batch_size}, {0: batch_size}, {0: batch_size},
+        {0: batch_size, 1: n_lig}, {0: batch_size, 1: n_lig}))
+
+    # the exported programs should reproduce the eager dense modules
+    with torch.no_grad():
+        for name, program, module, inputs in [('encoder', encoder_program, dense_encoder, encoder_inputs), ('step', step_program, dense_step, step_inputs)]:
+            max_diff = max( (ref - out).abs().max().item() for ref, out in zip(module(*inputs), program.module()(*inputs)) )
+            print(f'exported {name}: max abs difference = {max_diff:.2e}', flush=True)
+
+    torch.export.save(encoder_program, output_dir / ENCODER_FILE)
+    torch.export.save(step_program, output_dir / STEP_FILE)
+
+    # record everything the runtime driver needs to know about the model
+    metadata = {
+        'rec_elements': config['dataset']['rec_elements'],
+        'lig_elements': config['dataset']['lig_elements'],
+        'remove_hydrogen': config['dataset']['remove_hydrogen'],
+        'n_timesteps': model.n_timesteps,
+        'lig_feat_norm_constant': model.lig_feat_norm_constant,
+        'n_lig_feat': dense_step.dynamics.n_lig_scalars,
+        'n_keypoints': config['graph']['n_keypoints'],
+        'min_lig_atoms': 2,
+        'min_batch_size': 2,
+    }
+    with open(output_dir / METADATA_FILE, 'w') as f:
+        json.dump(metadata, f, indent=2)
+    print(f'exported sampler written to {output_dir}')
+
+
+if __name__ == "__main__":
+    main()
@@ -54,6 +54,7 @@ def model_from_config(config: dict):
     model = KeypointDiffusion(
         n_lig_feat, 
         n_kp_feat,
+        rec_atom_nf=n_rec_feat,
         processed_dataset_dir=Path(config['dataset']['location']),
         graph_config=config['graph'],
         dynamics_config=dynamics_config, 
@@ -0,0 +1,454 @@
+import time
+from math import ceil
+from typing import Dict, List, Tuple, Union
+
+import dgl
+import torch
+import torch.nn as nn
+import torch.nn.functional as fn
+
+from models.gvp import GVPEdgeConv, GVPMultiEdgeConv, _norm_no_nan, _rbf
+from models.ligand_diffuser import KeypointDiffusion, posterior_update
+from models.receptor_encoder_gvp import ReceptorEncoderGVP
+from utils import BatchLayout, to_dense_batch
+
+# the modules in this file re-implement the receptor encoder and a single denoising step of GVP models using only tensor operations
+# so that they can be exported with torch.export. every graph is stored densely: node features have shape (batch_size, n_nodes, ...)
+# and edges are (src_idx, dst_idx, weight) tensors over the flattened nodes whose size only depends on the input shapes.
+# candidate edges that do not satisfy the radius or knn criteria are kept with a weight of zero.
+
+Edges = Tuple[torch.Tensor, torch.Tensor, torch.Tensor]
+
+def _pair_distances(query_pos: torch.Tensor, cand_pos: torch.Tensor, exclude_self: bool, cand_mask: torch.Tensor = None) -> torch.Tensor:
+    # returns the distance between every query and candidate node in the same graph, shape (batch_size, n_query, n_cand)
+    # candidates where cand_mask is False, e.g. padding atoms, are unreachable
+    dists = torch.sqrt(torch.square(query_pos.unsqueeze(2) - cand_pos.unsqueeze(1)).sum(dim=-1))
+    if exclude_self:
+        self_mask = torch.eye(query_pos.shape[1], cand_pos.shape[1], dtype=torch.bool, device=query_pos.device)
+        dists = dists.masked_fill(self_mask, float('inf'))
+    if cand_mask is not None:
+        dists = dists.masked_fill(~cand_mask.unsqueeze(1), float('inf'))
+    return dists
+
+def _flat_idxs(batch_size: int, n_nodes: int, local_idxs: torch.Tensor) -> torch.Tensor:
+    # converts node indicies within each graph into indicies of the flattened nodes
+    offsets = torch.arange(batch_size, device=local_idxs.device).view(-1, *[1]*(local_idxs.dim()-1)) * n_nodes
+    return (local_idxs + offsets).reshape(-1)
+
+def radius_pairs(query_pos: torch.Tensor, cand_pos: torch.Tensor, r: float, exclude_self: bool = False, max_neighbors: int = None, 
+                 cand_mask: torch.Tensor = None) -> Edges:
+    """Finds candidate nodes within r of every query node. Returns flattened (query_idx, cand_idx, weight).
+
+    If max_neighbors is specified, only the max_neighbors closest candidates of each query node are considered, which keeps the number of
+    edges linear in the number of nodes. Otherwise every query-candidate pair is returned. Candidates where cand_mask is False are never neighbors."""
+    batch_size, n_query, n_cand = query_pos.shape[0], query_pos.shape[1], cand_pos.shape[1]
+    dists = _pair_distances(query_pos, cand_pos, exclude_self, cand_mask)
+
+    if max_neighbors is None:
+        cand_idxs = torch.arange(n_cand, device=dists.device).expand(batch_size, n_query, n_cand)
+    else:
+        # pad with unreachable candidates so that topk works for graphs with fewer than max_neighbors nodes
+        dists = torch.cat([dists, torch.full((batch_size, n_query, max_neighbors), float('inf'), device=dists.device)], dim=-1)
+        dists, cand_idxs = torch.topk(dists, k=max_neighbors, dim=-1, largest=False)
+        cand_idxs = cand_idxs.clamp(max=n_cand-1)
+
+    query_idxs = torch.arange(n_query, device=dists.device).view(1, -1, 1).expand_as(cand_idxs)
+    weight = (dists < r).reshape(-1)
+    return _flat_idxs(batch_size, n_query, query_idxs), _flat_idxs(batch_size, n_cand, cand_idxs), weight
+
+def knn_pairs(query_pos: torch.Tensor, cand_pos: torch.Tensor, k: int, exclude_self: bool = False, cand_mask: torch.Tensor = None) -> Edges:
+    """Finds the k closest candidate nodes to every query node. Returns flattened (query_idx, cand_idx, weight). 
+    Candidates where cand_mask is False are never neighbors."""
+    batch_size, n_query, n_cand = query_pos.shape[0], query_pos.shape[1], cand_pos.shape[1]
+    dists = _pair_distances(query_pos, cand_pos, exclude_self, cand_mask)
+
+    # pad with unreachable candidates so that topk works for graphs with fewer than k nodes
+    dists = torch.cat([dists, torch.full((batch_size, n_query, k), float('inf'), device=dists.device)], dim=-1)
+    dists, cand_idxs = torch.topk(dists, k=k, dim=-1, largest=False)
+    cand_idxs = cand_idxs.clamp(max=n_cand-1)
+
+    query_idxs = torch.arange(n_query, device=dists.device).view(1, -1, 1).expand_as(cand_idxs)
+    weight = torch.isfinite(dists).reshape(-1)
+    return _flat_idxs(batch_size, n_query, query_idxs), _flat_idxs(batch_size, n_cand, cand_idxs), weight
+
+def edge_geometry(src_pos: torch.Tensor, dst_pos: torch.Tensor, edges: Edges, rbf_dmax: float, rbf_dim: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Same as compute_edge_geometry for flattened node positions and dense edges."""
+    src_idx, dst_idx, _ = edges
+    x_diff = src_pos[src_idx] - dst_pos[dst_idx]
+    dij = _norm_no_nan(x_diff, keepdims=True) + 1e-8
+    x_diff = x_diff / dij
+    d = _rbf(dij.squeeze(1), D_max=rbf_dmax, D_count=rbf_dim)
+    return x_diff, d
+
+def aggregate_messages(scalar_msg: torch.Tensor, vec_msg: torch.Tensor, edges: Edges, n_dst: int, mean: bool) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Sums (or averages, if mean is True) the messages of every edge with non-zero weight onto its destination node."""
+    _, dst_idx, weight = edges
+    weight = weight.to(scalar_msg.dtype)
+    scalar_agg = scalar_msg.new_zeros((n_dst, scalar_msg.shape[1])).index_add(0, dst_idx, scalar_msg*weight.unsqueeze(-1))
+    vec_agg = vec_msg.new_zeros((n_dst, *vec_msg.shape[1:])).index_add(0, dst_idx, vec_msg*weight.view(-1, 1, 1))
+    if mean:
+        in_degree = weight.new_zeros(n_dst).index_add(0, dst_idx, weight).clamp(min=1).unsqueeze(-1)
+        scalar_agg = scalar_agg / in_degree
+        vec_agg = vec_agg / in_degree.unsqueeze(-1)
+    return scalar_agg, vec_agg
+
+def edges_per_graph(edges: Edges, batch_size: int, n_dst_per_graph: int) -> torch.Tensor:
+    """Counts the edges with non-zero weight in every graph of the batch."""
+    _, dst_idx, weight = edges
+    graph_idx = torch.div(dst_idx, n_dst_per_graph, rounding_mode='floor')
+    return weight.new_zeros(batch_size, dtype=torch.float32).index_add(0, graph_idx, weight.float())
+
+def dense_edge_conv(conv: GVPEdgeConv, src_feats: Tuple[torch.Tensor, torch.Tensor], dst_feats: Tuple[torch.Tensor, torch.Tensor],
+                    edges: Edges, geometry: Tuple[torch.Tensor, torch.Tensor], z: Union[float, torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Computes the same output as GVPEdgeConv.forward on dense edges. src_feats and dst_feats are (scalars, vectors) tuples."""
+    src_idx, dst_idx, _ = edges
+    src_scalars, src_vecs = src_feats
+    dst_scalars, dst_vecs = dst_feats
+    x_diff, d = geometry
+
+    # compute messages on every edge
+    vec_feats = [ x_diff.unsqueeze(1), src_vecs[src_idx] ]
+    scalar_feats = [ src_scalars[src_idx], d ]
+    if conv.use_dst_feats:
+        vec_feats.append(dst_vecs[dst_idx])
+        scalar_feats.append(dst_scalars[dst_idx])
+    scalar_msg, vec_msg = conv.edge_message((torch.cat(scalar_feats, dim=1), torch.cat(vec_feats, dim=1)))
+
+    # aggregate messages from every edge
+    scalar_msg, vec_msg = aggregate_messages(scalar_msg, vec_msg, edges, dst_scalars.shape[0], mean=conv.message_norm == 'mean')
+    scalar_msg = scalar_msg / z
+    if isinstance(z, torch.Tensor):
+        z = z.unsqueeze(-1)
+    vec_msg = vec_msg / z
+    scalar_msg, vec_msg = conv.dropout(scalar_msg, vec_msg)
+
+    # update scalar and vector features
+    scalar_feats, vec_feats = conv.message_layer_norm(dst_scalars + scalar_msg, dst_vecs + vec_msg)
+    scalar_residual, vec_residual = conv.node_update((scalar_feats, vec_feats))
+    scalar_residual, vec_residual = conv.dropout(scalar_residual, vec_residual)
+    return conv.update_layer_norm(scalar_feats + scalar_residual, vec_feats + vec_residual)
+
+def dense_multi_edge_conv(conv: GVPMultiEdgeConv, node_feats: Dict[str, Tuple[torch.Tensor, torch.Tensor, torch.Tensor]], edges: Dict[Tuple[str, str, str], Edges],
+                          geometry: Dict[Tuple[str, str, str], Tuple[torch.Tensor, torch.Tensor]], norm_values: Dict[str, Union[float, torch.Tensor]]):
+    """Computes the same output as GVPMultiEdgeConv.forward on dense edges."""
+
+    # compute messages for every edge type and sum them onto destination nodes
+    agg_msgs = {}
+    for etype in conv.etypes:
+        src_idx, _, _ = edges[etype]
+        x_diff, d = geometry[etype]
+        src_scalars, _, src_vecs = node_feats[etype[0]]
+        scalar_feats = torch.cat([src_scalars[src_idx], d], dim=1)
+        vec_feats = torch.cat([x_diff.unsqueeze(1), src_vecs[src_idx]], dim=1)
+        scalar_msg, vec_msg = conv.edge_message_fns['_'.join(etype)]((scalar_feats, vec_feats))
+
+        # with mean aggregation, messages are averaged within each edge type and then summed across edge types
+        n_dst = node_feats[etype[2]][0].shape[0]
+        scalar_msg, vec_msg = aggregate_messages(scalar_msg, vec_msg, edges[etype], n_dst, mean=conv.mean_agg)
+        if etype[2] in agg_msgs:
+            scalar_msg, vec_msg = agg_msgs[etype[2]][0] + scalar_msg, agg_msgs[etype[2]][1] + vec_msg
+        agg_msgs[etype[2]] = (scalar_msg, vec_msg)
+
+    # update features of destination nodes
+    output_feats = {}
+    for ntype in sorted(conv.dst_ntypes):
+        scalar_feats, pos_feats, vec_feats = node_feats[ntype]
+        scalar_feats, vec_feats = conv.update_node_feats(ntype, scalar_feats, vec_feats, *agg_msgs[ntype], norm_values[ntype])
+        output_feats[ntype] = (scalar_feats, pos_feats, vec_feats)
+    return output_feats
+
+
+class DenseReceptorEncoderGVP(nn.Module):
+
+    """Computes the same keypoints as ReceptorEncoderGVP for a single receptor given as (n_rec_atoms, 3) positions and (n_rec_atoms, n_rec_feat) features."""
+
+    def __init__(self, rec_encoder: ReceptorEncoderGVP, max_rr_neighbors: int = 64):
+        super().__init__()
+
+        if rec_encoder.use_sameres_feat:
+            raise NotImplementedError('exporting receptor encoders with same-residue edge features is not supported')
+
+        self.rec_encoder = rec_encoder
+        self.max_rr_neighbors = max_rr_neighbors
+
+    def forward(self, rec_pos: torch.Tensor, rec_feat: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        enc = self.rec_encoder
+        n_rec = rec_pos.shape[0]
+
+        # embed scalar features, initialize vector features
+        rec_scalars = enc.scalar_norm(enc.scalar_embed(rec_feat))
+        rec_vecs = rec_scalars.new_zeros((n_rec, enc.vector_size, 3))
+
+        # build rec-rec edges, receptor atoms receive messages from atoms within the rr cutoff
+        rec_edges = radius_pairs(rec_pos[None], rec_pos[None], r=enc.graph_cutoffs['rr'], exclude_self=True, max_neighbors=self.max_rr_neighbors)
+        rr_edges = (rec_edges[1], rec_edges[0], rec_edges[2])
+
+        # compute the normalization factor for the messages
+        if enc.message_norm == 'mean':
+            z = 1
+        elif enc.message_norm == 0:
+            z = (edges_per_graph(rr_edges, 1, n_rec) / n_rec).view(1, 1)
+        else:
+            z = enc.message_norm
+
+        # apply receptor-receptor convolutions
+        if enc.n_rr_convs > 0:
+            rr_conv = enc.rr_conv_layers[0]
+            rr_geometry = edge_geometry(rec_pos, rec_pos, rr_edges, rbf_dmax=rr_conv.rbf_dmax, rbf_dim=rr_conv.rbf_dim)
+        for rr_conv in enc.rr_conv_layers:
+            rec_scalars, rec_vecs = dense_edge_conv(rr_conv, (rec_scalars, rec_vecs), (rec_scalars, rec_vecs), rr_edges, rr_geometry, z)
+
+        # place keypoints with attention over receptor atoms, same as KeypointInitializer with a single head
+        kp_init = enc.keypoint_initializer
+        kp_embedding = kp_init.keypoint_embedding(rec_scalars.mean(dim=0, keepdim=True)).view(kp_init.n_keypoints, kp_init.scalar_size)
+        attention = kp_init.dst_net(kp_embedding) @ kp_init.src_net(rec_scalars).t() / kp_init.scalar_size**0.5
+        kp_pos = torch.softmax(attention, dim=-1) @ rec_pos
+        kp_scalars = rec_scalars.new_zeros((kp_init.n_keypoints, kp_init.scalar_size))
+        kp_vecs = rec_scalars.new_zeros((kp_init.n_keypoints, kp_init.vector_size, 3))
+
+        # build rec-kp edges, each keypoint receives messages from its closest receptor atoms
+        if enc.rk_graph_type == 'knn':
+            kp_edges = knn_pairs(kp_pos[None], rec_pos[None], k=enc.k_closest)
+        else:
+            kp_edges = radius_pairs(kp_pos[None], rec_pos[None], r=enc.kp_rad, max_neighbors=10)
+        rk_edges = (kp_edges[1], kp_edges[0], kp_edges[2])
+
+        if enc.message_norm == 0:
+            z = (edges_per_graph(rk_edges, 1, kp_init.n_keypoints) / kp_init.n_keypoints).view(1, 1)
+
+        # update keypoint features with rec-kp convolutions
+        if enc.n_rk_convs > 0:
+            rk_conv = enc.rk_conv_layers[0]
+            rk_geometry = edge_geometry(rec_pos, kp_pos, rk_edges, rbf_dmax=rk_conv.rbf_dmax, rbf_dim=rk_conv.rbf_dim)
+        for rk_conv in enc.rk_conv_layers:
+            kp_scalars, kp_vecs = dense_edge_conv(rk_conv, (rec_scalars, rec_vecs), (kp_scalars, kp_vecs), rk_edges, rk_geometry, z)
+
+        return kp_pos, kp_scalars, kp_vecs
+
+
+class DenseDenoisingStepGVP(nn.Module):
+
+    """Computes one step of KeypointDiffusion.sample_p_zs_given_zt for a batch of complexes that share the same number of ligand atoms.
+
+    Ligand and keypoint tensors have shape (batch_size, n_atoms, ...). step is the integer denoising step s of every complex,
+    given as a float tensor of shape (batch_size,). Noise is passed in so that sampling is reproducible.
+
+    Ligands with fewer atoms can be padded up to n_atoms: lig_mask of shape (batch_size, n_atoms) is False for padding atoms, which 
+    are excluded from all edges and from the ligand COM, and are returned as zeros.
+    """
+
+    def __init__(self, model: KeypointDiffusion):
+        super().__init__()
+
+        if model.architecture != 'gvp':
+            raise NotImplementedError('only GVP models can be exported')
+
+        self.dynamics = model.dynamics
+        self.gamma = model.gamma
+        self.n_timesteps = model.n_timesteps
+
+    def forward(self, lig_pos: torch.Tensor, lig_feat: torch.Tensor, kp_pos: torch.Tensor, kp_feat: torch.Tensor, kp_vecs: torch.Tensor,
+                step: torch.Tensor, pos_noise: torch.Tensor, feat_noise: torch.Tensor, lig_mask: torch.Tensor = None) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        dyn = self.dynamics
+        batch_size, n_lig, n_kp = lig_pos.shape[0], lig_pos.shape[1], kp_pos.shape[1]
+        if lig_mask is None:
+            lig_mask = torch.ones((batch_size, n_lig), dtype=torch.bool, device=lig_pos.device)
+
+        s = step / self.n_timesteps
+        t = (step + 1) / self.n_timesteps
+
+        # encode ligand and keypoint scalars together with the timestep
+        lig_x, kp_x = lig_pos.reshape(-1, 3), kp_pos.reshape(-1, 3)
+        lig_scalars = dyn.lig_encoder(torch.cat([lig_feat.reshape(batch_size*n_lig, -1), t.repeat_interleave(n_lig).unsqueeze(1)], dim=1))
+        kp_scalars = dyn.kp_encoder(torch.cat([kp_feat.reshape(batch_size*n_kp, -1), t.repeat_interleave(n_kp).unsqueeze(1)], dim=1))
+        node_data = {
+            'lig': (lig_scalars, lig_x, lig_scalars.new_zeros((batch_size*n_lig, dyn.vector_size, 3))),
+            'kp': (kp_scalars, kp_x, kp_vecs.reshape(batch_size*n_kp, dyn.vector_size, 3))
+        }
+
+        # build edges, same as LigRecDynamicsGVP.add_lig_edges and the kk edges drawn by the receptor encoder
+        if dyn.ll_k > 0:
+            ll_pairs = knn_pairs(lig_pos, lig_pos, k=dyn.ll_k, exclude_self=True, cand_mask=lig_mask)
+        else:
+            ll_pairs = radius_pairs(lig_pos, lig_pos, r=dyn.graph_cutoffs['ll'], exclude_self=True, cand_mask=lig_mask)
+        if dyn.kl_k > 0:
+            kl_pairs = knn_pairs(kp_pos, lig_pos, k=dyn.kl_k, cand_mask=lig_mask)
+        else:
+            kl_pairs = radius_pairs(kp_pos, lig_pos, r=dyn.graph_cutoffs['kl'], cand_mask=lig_mask)
+        kk_pairs = radius_pairs(kp_pos, kp_pos, r=dyn.graph_cutoffs['kk'], exclude_self=True)
+
+        # padding atoms can still be the query node of ligand edges, those edges are removed
+        flat_lig_mask = lig_mask.reshape(-1)
+        ll_pairs = (ll_pairs[0], ll_pairs[1], ll_pairs[2] & flat_lig_mask[ll_pairs[0]])
+        edges = {
+            ('lig', 'll', 'lig'): (ll_pairs[1], ll_pairs[0], ll_pairs[2]),
+            ('kp', 'kl', 'lig'): kl_pairs,
+            ('lig', 'lk', 'kp'): (kl_pairs[1], kl_pairs[0], kl_pairs[2]),
+            ('kp', 'kk', 'kp'): (kk_pairs[1], kk_pairs[0], kk_pairs[2]),
+        }
+        n_nodes_per_graph = {'lig': n_lig, 'kp': n_kp}
+        n_real_nodes = {'lig': lig_mask.sum(dim=1).clamp(min=1), 'kp': n_kp}
+
+        # node positions are not updated by the convolutions, so edge geometry is computed once
+        convs = dyn.noise_predictor.conv_layers
+        geometry = {}
+        for conv in convs:
+            for etype in conv.etypes:
+                if etype not in geometry:
+                    geometry[etype] = edge_geometry(node_data[etype[0]][1], node_data[etype[2]][1], edges[etype], rbf_dmax=conv.rbf_dmax, rbf_dim=conv.rbf_dim)
+
+        # do message passing between ligand atoms and keypoints
+        for conv in convs:
+            norm_values = {}
+            for ntype in conv.dst_ntypes:
+                if conv.norm_values[ntype] == 0:
+                    n_edges = sum( edges_per_graph(edges[etype], batch_size, n_nodes_per_graph[ntype]) for etype in conv.etypes if etype[2] == ntype )
+                    norm_values[ntype] = (n_edges / n_real_nodes[ntype] + 1).repeat_interleave(n_nodes_per_graph[ntype]).unsqueeze(1)
+                else:
+                    norm_values[ntype] = conv.norm_values[ntype]
+            node_data = dense_multi_edge_conv(conv, node_data, edges, geometry, norm_values)
+        eps_h, eps_x = dyn.noise_predictor.noise_predictor(node_data['lig'])
+
+        # compute the parameters of p(z_s | z_t), same as KeypointDiffusion.sigma_and_alpha_t_given_s
+        gamma_s, gamma_t = self.gamma(s), self.gamma(t)
+        sigma2_t_given_s = -torch.expm1(fn.softplus(gamma_s) - fn.softplus(gamma_t))
+        alpha_t_given_s = torch.exp(0.5 * (fn.logsigmoid(-gamma_t) - fn.logsigmoid(-gamma_s)))
+        sigma_t_given_s = torch.sqrt(sigma2_t_given_s)
+        sigma_s, sigma_t = torch.sqrt(torch.sigmoid(gamma_s)), torch.sqrt(torch.sigmoid(gamma_t))
+
+        var_terms = (sigma2_t_given_s / alpha_t_given_s / sigma_t).repeat_interleave(n_lig).unsqueeze(1)
+        sigma = (sigma_t_given_s * sigma_s / sigma_t).repeat_interleave(n_lig).unsqueeze(1)
+        alpha_t_given_s = alpha_t_given_s.repeat_interleave(n_lig).unsqueeze(1)
+
+        # sample z_s
+        lig_x, lig_h = posterior_update(lig_x, lig_feat.reshape(batch_size*n_lig, -1), eps_x, eps_h, alpha_t_given_s, var_terms, sigma,
+                                        pos_noise.reshape(-1, 3), feat_noise.reshape(batch_size*n_lig, -1))
+        atom_mask = lig_mask.unsqueeze(-1).to(lig_x.dtype)
+        lig_x = lig_x.view(batch_size, n_lig, 3) * atom_mask
+        lig_h = lig_h.view(batch_size, n_lig, -1) * atom_mask
+
+        # remove ligand COM from system
+        lig_com = lig_x.sum(dim=1, keepdim=True) / atom_mask.sum(dim=1, keepdim=True).clamp(min=1)
+        return (lig_x - lig_com) * atom_mask, lig_h, kp_pos - lig_com
+
+
+def _pad_to(x: torch.Tensor, shape: Tuple[int, ...]) -> torch.Tensor:
+    # pads x with zeros at the end of every dimension
+    padded = x.new_zeros(shape)
+    padded[tuple( slice(0, n) for n in x.shape )] = x
+    return padded
+
+def _time_step(step_fn, inputs: tuple, n_iters: int) -> float:
+    # returns the average time of step_fn(*inputs) in seconds
+    if inputs[0].is_cuda:
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(n_iters):
+        step_fn(*inputs)
+    if inputs[0].is_cuda:
+        torch.cuda.synchronize()
+    return (time.time() - start) / n_iters
+
+
+class CompiledDenseSampler:
+
+    """Runs the reverse chain of a GVP model with DenseDenoisingStepGVP compiled by torch.compile with static shapes.
+
+    The dense step needs every complex of a batch to have the same number of atoms, so complexes are padded up to a power of two 
+    and ligands up to a multiple of bucket_size atoms. Every (n_complexes, n_atoms) bucket is compiled the first time it is seen; 
+    warmup() compiles buckets ahead of time. This is a plain object rather than a module so that the dynamics model is not registered twice.
+    """
+
+    def __init__(self, model: KeypointDiffusion, bucket_size: int = 8):
+        self.step = DenseDenoisingStepGVP(model)
+        self.compiled_step = torch.compile(self.step, dynamic=False)
+        self.n_timesteps = model.n_timesteps
+        self.bucket_size = bucket_size
+        self.compiled_buckets = set()
+
+    def bucket(self, batch_size: int, n_atoms: int) -> Tuple[int, int]:
+        """Returns the padded number of complexes and ligand atoms for a batch."""
+        padded_batch_size = 1 << (batch_size - 1).bit_length()
+        padded_atoms = max(ceil(n_atoms / self.bucket_size), 1)*self.bucket_size
+        return padded_batch_size, padded_atoms
+
+    def supports(self, batch_idxs: BatchLayout) -> bool:
+        """Keypoints are not padded, so the dense step can only be used if every complex has the same number of keypoints."""
+        n_kp = batch_idxs.num_nodes['kp']
+        return bool((n_kp == n_kp[0]).all())
+
+    def run_step(self, *inputs: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        self.compiled_buckets.add(tuple(inputs[0].shape[:2]))
+
+        # every bucket is a separate static-shape graph of the same code, so the recompile limit is raised while the step runs
+        cache_size_limit = max(torch._dynamo.config.cache_size_limit, len(self.compiled_buckets))
+        with torch._dynamo.config.patch(cache_size_limit=cache_size_limit):
+            return self.compiled_step(*inputs)
+
+    @torch.no_grad()
+    def sample(self, g: dgl.DGLHeteroGraph, batch_idxs: BatchLayout) -> dgl.DGLHeteroGraph:
+        """Runs every denoising step on the ligands of g, in the frame of reference set up by KeypointDiffusion.sample_from_encoded_receptors. 
+        The denoised ligands and translated keypoints are written back into g."""
+        batch_size = g.batch_size
+        n_kp = g.num_nodes('kp') // batch_size
+        lig_pos, lig_mask = to_dense_batch(g.nodes['lig'].data['x_0'], batch_idxs['lig'], batch_size)
+        lig_feat, _ = to_dense_batch(g.nodes['lig'].data['h_0'], batch_idxs['lig'], batch_size)
+        kp_pos = g.nodes['kp'].data['x_0'].view(batch_size, n_kp, 3)
+        kp_feat = g.nodes['kp'].data['h_0'].view(batch_size, n_kp, -1)
+        kp_vecs = g.nodes['kp'].data['v_0'].view(batch_size, n_kp, -1, 3)
+
+        # pad complexes and ligand atoms up to their bucket. padding complexes have no ligand atoms
+        padded_batch_size, padded_atoms = self.bucket(batch_size, lig_pos.shape[1])
+        lig_pos = _pad_to(lig_pos, (padded_batch_size, padded_atoms, 3))
+        lig_feat = _pad_to(lig_feat, (padded_batch_size, padded_atoms, lig_feat.shape[2]))
+        lig_mask = _pad_to(lig_mask, (padded_batch_size, padded_atoms))
+        kp_pos = _pad_to(kp_pos, (padded_batch_size, *kp_pos.shape[1:]))
+        kp_feat = _pad_to(kp_feat, (padded_batch_size, *kp_feat.shape[1:]))
+        kp_vecs = _pad_to(kp_vecs, (padded_batch_size, *kp_vecs.shape[1:]))
+
+        for s in reversed(range(0, self.n_timesteps)):
+            step = torch.full((padded_batch_size,), float(s), device=g.device)
+            pos_noise = torch.randn_like(lig_pos)
+            feat_noise = torch.randn_like(lig_feat)
+            lig_pos, lig_feat, kp_pos = self.run_step(lig_pos, lig_feat, kp_pos, kp_feat, kp_vecs, step, pos_noise, feat_noise, lig_mask)
+
+        lig_mask = lig_mask[:batch_size]
+        g.nodes['lig'].data['x_0'] = lig_pos[:batch_size][lig_mask]
+        g.nodes['lig'].data['h_0'] = lig_feat[:batch_size][lig_mask]
+        g.nodes['kp'].data['x_0'] = kp_pos[:batch_size].reshape(-1, 3)
+        return g
+
+    @torch.no_grad()
+    def warmup(self, batch_sizes: List[int], max_atoms: int, device, n_iters: int = 10) -> Dict[Tuple[int, int], Tuple[float, float]]:
+        """Compiles the buckets of every batch size in batch_sizes for ligands of up to max_atoms atoms.
+        
+        Returns the average time in seconds of the eager and the compiled step for every bucket, measured on random inputs after compilation."""
+        dyn = self.step.dynamics
+        n_kp = dyn.n_keypoints
+        n_kp_feat = dyn.kp_encoder[0].in_features - 1
+        padded_batch_sizes = sorted(set( self.bucket(batch_size, 1)[0] for batch_size in batch_sizes ))
+        _, max_padded_atoms = self.bucket(1, max_atoms)
+
+        step_times = {}
+        for batch_size in padded_batch_sizes:
+            for n_atoms in range(self.bucket_size, max_padded_atoms+1, self.bucket_size):
+                inputs = (
+                    torch.randn(batch_size, n_atoms, 3, device=device),
+                    torch.randn(batch_size, n_atoms, dyn.n_lig_scalars, device=device),
+                    torch.randn(batch_size, n_kp, 3, device=device)*5,
+                    torch.randn(batch_size, n_kp, n_kp_feat, device=device),
+                    torch.randn(batch_size, n_kp, dyn.vector_size, 3, device=device),
+                    torch.randint(0, self.n_timesteps, (batch_size,), device=device).float(),
+                    torch.randn(batch_size, n_atoms, 3, device=device),
+                    torch.randn(batch_size, n_atoms, dyn.n_lig_scalars, device=device),
+                    torch.ones(batch_size, n_atoms, dtype=torch.bool, device=device),
+                )
+                self.run_step(*inputs)
+                step_times[(batch_size, n_atoms)] = (_time_step(self.step, inputs, n_iters), _time_step(self.run_step, inputs, n_iters))
+        return step_times
+
+
+def compile_for_sampling(model: KeypointDiffusion, bucket_size: int = 8) -> CompiledDenseSampler:
+    """Makes model sample with a compiled dense denoising step, see CompiledDenseSampler. Only GVP models are supported."""
+    model.dense_sampler = CompiledDenseSampler(model, bucket_size=bucket_size)
+    return model.dense_sampler
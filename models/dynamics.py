@@ -1,10 +1,11 @@
 import torch
 import torch.nn as nn
-from typing import Dict, List
+from typing import Dict, List, Tuple
 import dgl.function as fn
 import dgl
+from torch.utils.checkpoint import checkpoint
 from torch_cluster import radius, radius_graph, knn_graph, knn
-from utils import get_batch_info, get_edges_per_batch
+from utils import BatchLayout
 
 class LigRecConv(nn.Module):
 
@@ -12,7 +13,8 @@ class LigRecConv(nn.Module):
     # original code: https://github.com/dmlc/dgl/blob/76bb54044eb387e9e3009bc169e93d66aa004a74/python/dgl/nn/pytorch/conv/egnnconv.py
     # I have extended the EGNN graph conv layer to operate on heterogeneous graphs containing containing receptor and ligand nodes
 
-    def __init__(self, in_size, hidden_size, out_size, edge_feat_size=0, use_tanh=False, coords_range=10, update_kp_feat: bool = False, norm: bool = False):
+    def __init__(self, in_size, hidden_size, out_size, edge_feat_size=0, use_tanh=False, coords_range=10, update_kp_feat: bool = False, norm: bool = False,
+                 edge_chunk_size: int = None):
         super().__init__()
 
         self.in_size = in_size
@@ -24,6 +26,9 @@ class LigRecConv(nn.Module):
         self.update_kp_feat = update_kp_feat
         self.norm = norm
 
+        # if edge_chunk_size is specified, messages are computed for at most edge_chunk_size edges at a time. see chunked_aggregate
+        self.edge_chunk_size = edge_chunk_size
+
         self.coords_range = coords_range
 
         if self.update_kp_feat:
@@ -107,19 +112,25 @@ class LigRecConv(nn.Module):
         # get edge type
         edge_type = edges.canonical_etype[1]
 
+        msg_h, msg_x = self.compute_messages(edge_type, f, edges.data["x_diff"])
+        return {"msg_x": msg_x, "msg_h": msg_h}
+
+    def compute_messages(self, edge_type: str, f: torch.Tensor, x_diff: torch.Tensor):
+        """Computes feature and coordinate messages from the concatenated edge features f and unit displacement vectors x_diff."""
+
         # compute feature messages
         msg_h = self.edge_mlp[edge_type](f)
         msg_h = msg_h*self.soft_attention[edge_type](msg_h)
 
         # compute coordinate messages
         if edge_type[1] in ["kk", "lk"]:
-            msg_x = torch.zeros_like(edges.data["radial"])
+            msg_x = torch.zeros_like(x_diff)
         elif self.use_tanh:
-            msg_x = torch.tanh( self.coord_mlp[edge_type](f) )* edges.data["x_diff"] * self.coords_range
+            msg_x = torch.tanh( self.coord_mlp[edge_type](f) )* x_diff * self.coords_range
         else:
-            msg_x = self.coord_mlp[edge_type](f)*edges.data["x_diff"]
+            msg_x = self.coord_mlp[edge_type](f)*x_diff
 
-        return {"msg_x": msg_x, "msg_h": msg_h}
+        return msg_h, msg_x
 
     def forward(self, graph: dgl.DGLHeteroGraph, node_feat: Dict[str, torch.Tensor], coord_feat: Dict[str, torch.Tensor], z_dict: Dict[str, torch.Tensor], edge_feat=None):
         r"""
@@ -143,6 +154,10 @@ class LigRecConv(nn.Module):
         node_feat_out : Dict[str, torch.Tensor]
         coord_feat_out: Dict[str, torch.Tensor]
         """
+        if self.edge_chunk_size is not None:
+            h_neigh, x_neigh = self.chunked_aggregate(graph, node_feat, coord_feat)
+            return self.update_nodes(node_feat, coord_feat, h_neigh, x_neigh, z_dict)
+
         with graph.local_scope():
             # node feature
             graph.ndata["h"] = node_feat
@@ -184,28 +199,70 @@ class LigRecConv(nn.Module):
                 h_update_dict[etype] = (fn.copy_e("msg_h", "m"), fn.sum("m", "h_neigh"))
             graph.multi_update_all(h_update_dict, cross_reducer='sum')
 
-            # normalize messages
-            for key in graph.ndata['h_neigh']:
-                graph.ndata['h_neigh'][key] = graph.ndata['h_neigh'][key]/z_dict[key]
-
-            for key in graph.ndata['x_neigh']:
-                graph.ndata['x_neigh'][key] = graph.ndata['x_neigh'][key]/z_dict[key]
-
             # get aggregated messages
             h_neigh, x_neigh = graph.ndata["h_neigh"], graph.ndata["x_neigh"]
 
-            # compute updated features/coordinates
-            # note that updates for kp positions will always be 0
-            h = {}
-            x = {}
-            for ntype in self.updated_node_types:
-                node_mlp_input = torch.concatenate([ node_feat[ntype], h_neigh[ntype] ], dim=1)
-                new_node_feat = node_feat[ntype] + self.node_mlp[ntype](node_mlp_input)
-                new_node_feat = self.layer_norm[ntype](new_node_feat)
-                h[ntype] = new_node_feat
-                x[ntype] = coord_feat[ntype] + x_neigh[ntype]
+        return self.update_nodes(node_feat, coord_feat, h_neigh, x_neigh, z_dict)
 
-            return h, x
+    def update_nodes(self, node_feat: Dict[str, torch.Tensor], coord_feat: Dict[str, torch.Tensor], 
+                     h_neigh: Dict[str, torch.Tensor], x_neigh: Dict[str, torch.Tensor], z_dict: Dict[str, torch.Tensor]):
+
+        # normalize messages
+        h_neigh = { key: h_neigh[key]/z_dict[key] for key in h_neigh }
+        x_neigh = { key: x_neigh[key]/z_dict[key] for key in x_neigh }
+
+        # compute updated features/coordinates
+        # note that updates for kp positions will always be 0
+        h = {}
+        x = {}
+        for ntype in self.updated_node_types:
+            node_mlp_input = torch.concatenate([ node_feat[ntype], h_neigh[ntype] ], dim=1)
+            new_node_feat = node_feat[ntype] + self.node_mlp[ntype](node_mlp_input)
+            new_node_feat = self.layer_norm[ntype](new_node_feat)
+            h[ntype] = new_node_feat
+            x[ntype] = coord_feat[ntype] + x_neigh[ntype]
+
+        return h, x
+
+    def chunked_aggregate(self, graph: dgl.DGLHeteroGraph, node_feat: Dict[str, torch.Tensor], coord_feat: Dict[str, torch.Tensor]):
+        """Computes the same aggregated messages as the DGL message passing in forward, without materializing per-edge tensors for every edge at once.
+
+        Edges are processed in chunks of edge_chunk_size and their messages are summed onto destination nodes as they are computed, 
+        so peak memory is bounded by the chunk size rather than the number of edges. When gradients are required, the messages of each chunk
+        are recomputed during the backward pass instead of being stored."""
+
+        h_neigh, x_neigh = {}, {}
+        for etype in self.edge_types:
+            src_ntype, _, dst_ntype = graph.to_canonical_etype(etype)
+            if dst_ntype not in h_neigh:
+                n_dst = graph.num_nodes(dst_ntype)
+                h_neigh[dst_ntype] = node_feat[dst_ntype].new_zeros((n_dst, self.hidden_size))
+                x_neigh[dst_ntype] = coord_feat[dst_ntype].new_zeros((n_dst, 3))
+
+            src_idx, dst_idx = graph.edges(etype=etype)
+            for start_idx in range(0, src_idx.shape[0], self.edge_chunk_size):
+                chunk_src_idx = src_idx[start_idx:start_idx+self.edge_chunk_size]
+                chunk_dst_idx = dst_idx[start_idx:start_idx+self.edge_chunk_size]
+                chunk_inputs = (etype, node_feat[src_ntype], node_feat[dst_ntype], coord_feat[src_ntype], coord_feat[dst_ntype], chunk_src_idx, chunk_dst_idx)
+                if torch.is_grad_enabled():
+                    msg_h, msg_x = checkpoint(self.chunk_messages, *chunk_inputs, use_reentrant=False)
+                else:
+                    msg_h, msg_x = self.chunk_messages(*chunk_inputs)
+                h_neigh[dst_ntype].index_add_(0, chunk_dst_idx, msg_h)
+                x_neigh[dst_ntype].index_add_(0, chunk_dst_idx, msg_x)
+
+        return h_neigh, x_neigh
+
+    def chunk_messages(self, etype: str, src_h: torch.Tensor, dst_h: torch.Tensor, src_x: torch.Tensor, dst_x: torch.Tensor, 
+                       src_idx: torch.Tensor, dst_idx: torch.Tensor):
+
+        # compute normalized displacement vectors and distances, same as forward
+        x_diff = src_x[src_idx] - dst_x[dst_idx]
+        dij = torch.linalg.vector_norm(x_diff, dim=1).unsqueeze(-1)
+        x_diff = x_diff / (dij + 1)
+
+        f = torch.cat([src_h[src_idx], dst_h[dst_idx], dij], dim=-1)
+        return self.compute_messages(etype, f, x_diff)
 
     def compute_dij(self, edges):
         dij = torch.linalg.vector_norm(edges.data['x_diff'], dim=1).unsqueeze(-1)
@@ -220,7 +277,8 @@ class LigRecConv(nn.Module):
 
 class LigRecEGNN(nn.Module):
 
-    def __init__(self, n_layers, in_size, hidden_size, out_size, use_tanh=False, message_norm=1, update_kp_feat: bool = False, norm: bool = False):
+    def __init__(self, n_layers, in_size, hidden_size, out_size, use_tanh=False, message_norm=1, update_kp_feat: bool = False, norm: bool = False,
+                 edge_chunk_size: int = None):
         super().__init__()
 
         self.n_layers = n_layers
@@ -258,12 +316,13 @@ class LigRecEGNN(nn.Module):
                 layer_out_size = hidden_size
 
             self.conv_layers.append( 
-                LigRecConv(in_size=layer_in_size, hidden_size=layer_hidden_size, out_size=layer_out_size, use_tanh=use_tanh, update_kp_feat=update_kp_feat, norm=norm)
+                LigRecConv(in_size=layer_in_size, hidden_size=layer_hidden_size, out_size=layer_out_size, use_tanh=use_tanh, update_kp_feat=update_kp_feat, norm=norm,
+                           edge_chunk_size=edge_chunk_size)
             )
 
             self.conv_layers = nn.ModuleList(self.conv_layers)
 
-    def forward(self, graph: dgl.DGLHeteroGraph, lig_batch_idx, kp_batch_idx):
+    def forward(self, graph: dgl.DGLHeteroGraph, batch_layout: BatchLayout):
 
         h = {}
         x = {}
@@ -275,12 +334,11 @@ class LigRecEGNN(nn.Module):
         # compute z, the normalization factor for messages passed on the graph, for each node type that is updated
         # we choose z to be the average in-degree of nodes being update, across all node types that are updated.
         z_dict = {}
-        batch_dict = { 'lig': lig_batch_idx, 'kp': kp_batch_idx}
         for ntype in self.updated_node_types:
             # TODO: possibly faster to do one sum call with torch.sum
             if self.message_norm == 0:
-                z_dict[ntype] = torch.stack([graph.batch_num_edges(etype) for etype in self.edge_types if etype[-1] == ntype[0] ], dim=0).sum(dim=0) / graph.batch_num_nodes(ntype)
-                z_dict[ntype] = z_dict[ntype][ batch_dict[ntype] ].view(-1, 1) + 1
+                z_dict[ntype] = torch.stack([batch_layout.num_edges[graph.to_canonical_etype(etype)] for etype in self.edge_types if etype[-1] == ntype[0] ], dim=0).sum(dim=0) / batch_layout.num_nodes[ntype]
+                z_dict[ntype] = z_dict[ntype][ batch_layout[ntype] ].view(-1, 1) + 1
             else:
                 z_dict[ntype] = self.message_norm
 
@@ -299,7 +357,7 @@ class LigRecDynamics(nn.Module):
 
     def __init__(self, atom_nf, rec_nf, n_layers=4, hidden_nf=255, act_fn=nn.SiLU, use_tanh=False, message_norm=1, no_cg: bool = False,
                  n_keypoints: int = 20, graph_cutoffs: dict = {}, update_kp_feat: bool = False, norm: bool = False, 
-                 ll_k: int = 0, kl_k: int = 0):
+                 ll_k: int = 0, kl_k: int = 0, edge_chunk_size: int = None):
         super().__init__()
 
         self.no_cg = no_cg    
@@ -336,7 +394,8 @@ class LigRecDynamics(nn.Module):
         # we add +1 to the feature size for the timestep
         self.egnn = LigRecEGNN(n_layers=n_layers, in_size=hidden_nf+1, hidden_size=hidden_nf+1, 
                                out_size=hidden_nf+1, use_tanh=use_tanh, 
-                               message_norm=message_norm, update_kp_feat=update_kp_feat, norm=norm)
+                               message_norm=message_norm, update_kp_feat=update_kp_feat, norm=norm,
+                               edge_chunk_size=edge_chunk_size)
 
 
     def forward(self, g: dgl.DGLHeteroGraph, timestep: torch.Tensor, batch_idxs: Dict[str, torch.Tensor]):
@@ -367,10 +426,10 @@ class LigRecDynamics(nn.Module):
             g.nodes['kp'].data['h_0'] = kp_feat
 
             # add lig-lig and kp<->lig edges to graph
-            g = self.add_lig_edges(g, lig_batch_idx, kp_batch_idx)
+            g, lig_edge_layout = self.add_lig_edges(g, batch_idxs)
 
             # pass through convolutions and get updated h and x for the ligand
-            h, x = self.egnn(g, lig_batch_idx, kp_batch_idx)
+            h, x = self.egnn(g, lig_edge_layout)
 
             # slice off time dimension
             h = h[:, :-1]
@@ -380,14 +439,15 @@ class LigRecDynamics(nn.Module):
             eps_h = self.lig_decoder(h) 
             eps_x = x - g.nodes["lig"].data["x_0"]
 
-            self.remove_lig_edges(g)
+            self.remove_lig_edges(g, batch_idxs)
 
             return eps_h, eps_x
 
-    def add_lig_edges(self, g: dgl.DGLHeteroGraph, lig_batch_idx, kp_batch_idx) -> dgl.DGLHeteroGraph:
+    def add_lig_edges(self, g: dgl.DGLHeteroGraph, batch_layout: BatchLayout) -> Tuple[dgl.DGLHeteroGraph, BatchLayout]:
+        # returns the graph with ligand edges and its updated batch layout
 
-        batch_num_nodes, batch_num_edges = get_batch_info(g)
-        batch_size = g.batch_size
+        lig_batch_idx = batch_layout['lig']
+        kp_batch_idx = batch_layout['kp']
 
         # add lig-lig edges
         if self.ll_k > 0: # if ll_k is 0, we use radius graph, otherwise we use knn graphs with ll_k neighbors
@@ -404,39 +464,34 @@ class LigRecDynamics(nn.Module):
         g.add_edges(kl_idxs[0], kl_idxs[1], etype='kl')
 
         # compute batch information
-        batch_num_edges[('lig', 'll', 'lig')] = get_edges_per_batch(ll_idxs[0], batch_size, lig_batch_idx)
-        kl_edges_per_batch = get_edges_per_batch(kl_idxs[0], batch_size, kp_batch_idx)
-        batch_num_edges[('kp', 'kl', 'lig')] = kl_edges_per_batch
+        num_edges = {}
+        num_edges[('lig', 'll', 'lig')] = batch_layout.count('lig', ll_idxs[0])
+        kl_edges_per_batch = batch_layout.count('kp', kl_idxs[0])
+        num_edges[('kp', 'kl', 'lig')] = kl_edges_per_batch
 
         # add lig -> kp edges if necessary
         if self.update_kp_feat:
             g.add_edges(kl_idxs[1], kl_idxs[0], etype='lk')
-            batch_num_edges[('lig', 'lk', 'kp')] = kl_edges_per_batch
+            num_edges[('lig', 'lk', 'kp')] = kl_edges_per_batch
 
         # update the graph's batch information
-        g.set_batch_num_edges(batch_num_edges)
-        g.set_batch_num_nodes(batch_num_nodes)
+        batch_layout = batch_layout.with_num_edges(num_edges)
+        batch_layout.apply(g)
 
-        return g
+        return g, batch_layout
     
-    def remove_lig_edges(self, g: dgl.DGLHeteroGraph):
+    def remove_lig_edges(self, g: dgl.DGLHeteroGraph, batch_layout: BatchLayout):
+        # batch_layout is the layout of g from before ligand edges were added
 
         if self.update_kp_feat:
             etypes_to_remove = ['ll', 'kl', 'lk']
         else:
             etypes_to_remove = ['ll', 'kl']
         
-        batch_num_nodes, batch_num_edges = get_batch_info(g)
-
-        for canonical_etype in batch_num_edges:
-            if canonical_etype[1] in etypes_to_remove:
-                batch_num_edges[canonical_etype] = torch.zeros_like(batch_num_edges[canonical_etype])
-        
         for etype in etypes_to_remove:
             eids = g.edges(form='eid', etype=etype)
             g.remove_edges(eids, etype=etype)
         
-        g.set_batch_num_nodes(batch_num_nodes)
-        g.set_batch_num_edges(batch_num_edges)
+        batch_layout.apply(g)
 
         return g
\ No newline at end of file
@@ -3,9 +3,9 @@ import dgl
 import torch
 from typing import Dict, List, Tuple, Union
 
-from utils import get_batch_info, get_edges_per_batch
+from utils import BatchLayout
 from torch_cluster import radius_graph, knn_graph, knn, radius
-from .gvp import GVPMultiEdgeConv, GVP
+from .gvp import GVPMultiEdgeConv, GVP, GVPSequential, compute_edge_geometry
 
 class NoisePredictionBlock(nn.Module):
 
@@ -31,7 +31,7 @@ class NoisePredictionBlock(nn.Module):
                 dim_feats_out=dim_feats_out,
                 vectors_activation=vectors_activation
             ))
-        self.gvps = nn.Sequential(*self.gvps)
+        self.gvps = GVPSequential(*self.gvps)
 
         self.to_scalar_output = nn.Linear(intermediate_scalar_dim, out_scalar_dim)
 
@@ -56,7 +56,8 @@ class LigRecGVP(nn.Module):
         ]
 
     def __init__(self, in_scalar_dim: int, in_vector_dim: int, out_scalar_dim: int, update_kp: bool = False, n_convs: int = 4,
-                 n_message_gvps: int = 3, n_update_gvps: int = 2, message_norm: Union[float, str, Dict] = 10, n_noise_gvps: int = 3, dropout: float = 0.0):
+                 n_message_gvps: int = 3, n_update_gvps: int = 2, message_norm: Union[float, str, Dict] = 10, n_noise_gvps: int = 3, dropout: float = 0.0,
+                 packed_edges: bool = False, edge_chunk_size: int = None):
         super().__init__()
 
         self.update_kp = update_kp
@@ -80,7 +81,9 @@ class LigRecGVP(nn.Module):
                 n_message_gvps=n_message_gvps,
                 n_update_gvps=n_update_gvps,
                 message_norm=message_norm,
-                dropout=dropout
+                dropout=dropout,
+                packed=packed_edges,
+                edge_chunk_size=edge_chunk_size
             ))
 
         self.noise_predictor = NoisePredictionBlock(
@@ -92,9 +95,25 @@ class LigRecGVP(nn.Module):
 
     def forward(self, g: dgl.DGLHeteroGraph, node_data: Dict[str, Tuple[torch.Tensor, torch.Tensor, torch.Tensor]], batch_idxs: Dict[str, torch.Tensor]):
 
+        # node positions are not updated by the convolutions, so we compute edge geometry once and share it across layers
+        edge_geometry = {}
+        for conv_layer in self.conv_layers:
+            for etype in conv_layer.etypes:
+                if etype in edge_geometry:
+                    continue
+                src_pos, dst_pos = node_data[etype[0]][1], node_data[etype[2]][1]
+                edge_geometry[etype] = compute_edge_geometry(g, etype, src_pos, dst_pos, rbf_dmax=conv_layer.rbf_dmax, rbf_dim=conv_layer.rbf_dim)
+
+        # message normalization values only depend on the graph, so they are computed once for each set of edge types
+        norm_values = {}
+        for conv_layer in self.conv_layers:
+            etypes = tuple(conv_layer.etypes)
+            if etypes not in norm_values:
+                norm_values[etypes] = conv_layer.compute_norm_values(g, batch_idxs)
+
         # do message passing between ligand atoms and keypoints
         for conv_layer in self.conv_layers:
-            node_data = conv_layer(g, node_data, batch_idxs)
+            node_data = conv_layer(g, node_data, batch_idxs, edge_geometry=edge_geometry, norm_values=norm_values[tuple(conv_layer.etypes)])
 
         # predict noise on ligand atoms
         scalar_noise, vector_noise = self.noise_predictor(node_data['lig'])
@@ -105,7 +124,8 @@ class LigRecDynamicsGVP(nn.Module):
 
     def __init__(self, n_lig_scalars, n_kp_scalars, vector_size: int = 16, n_convs=4, n_hidden_scalars=128, act_fn=nn.SiLU,
                  message_norm=1, no_cg: bool = False, n_keypoints: int = 20, graph_cutoffs: dict = {}, update_kp: bool = False, 
-                 ll_k: int = 0, kl_k: int = 0, n_message_gvps: int = 3, n_update_gvps: int = 2, n_noise_gvps: int = 3, dropout: float = 0.0):
+                 ll_k: int = 0, kl_k: int = 0, n_message_gvps: int = 3, n_update_gvps: int = 2, n_noise_gvps: int = 3, dropout: float = 0.0,
+                 packed_edges: bool = False, edge_chunk_size: int = None):
         super().__init__()
 
         if no_cg:
@@ -143,7 +163,9 @@ class LigRecDynamicsGVP(nn.Module):
             n_update_gvps=n_update_gvps,
             n_noise_gvps=n_noise_gvps,
             message_norm=message_norm,
-            dropout=dropout
+            dropout=dropout,
+            packed_edges=packed_edges,
+            edge_chunk_size=edge_chunk_size
         )
 
     def forward(self, g: dgl.DGLHeteroGraph, timestep: torch.Tensor, batch_idxs: Dict[str, torch.Tensor]):
@@ -189,19 +211,20 @@ class LigRecDynamicsGVP(nn.Module):
             )
 
             # add lig-lig and kp<->lig edges to graph
-            g = self.add_lig_edges(g, lig_batch_idx, kp_batch_idx)
+            g, lig_edge_layout = self.add_lig_edges(g, batch_idxs)
 
             # predict noise
-            eps_h, eps_x = self.noise_predictor(g, node_data, batch_idxs)
+            eps_h, eps_x = self.noise_predictor(g, node_data, lig_edge_layout)
 
-            self.remove_lig_edges(g)
+            self.remove_lig_edges(g, batch_idxs)
 
         return eps_h, eps_x
 
-    def add_lig_edges(self, g: dgl.DGLHeteroGraph, lig_batch_idx, kp_batch_idx) -> dgl.DGLHeteroGraph:
+    def add_lig_edges(self, g: dgl.DGLHeteroGraph, batch_layout: BatchLayout) -> Tuple[dgl.DGLHeteroGraph, BatchLayout]:
+        # returns the graph with ligand edges and its updated batch layout
 
-        batch_num_nodes, batch_num_edges = get_batch_info(g)
-        batch_size = g.batch_size
+        lig_batch_idx = batch_layout['lig']
+        kp_batch_idx = batch_layout['kp']
 
         # add lig-lig edges
         if self.ll_k > 0: # if ll_k is 0, we use radius graph, otherwise we use knn graphs with ll_k neighbors
@@ -218,39 +241,34 @@ class LigRecDynamicsGVP(nn.Module):
         g.add_edges(kl_idxs[0], kl_idxs[1], etype='kl')
 
         # compute batch information
-        batch_num_edges[('lig', 'll', 'lig')] = get_edges_per_batch(ll_idxs[0], batch_size, lig_batch_idx)
-        kl_edges_per_batch = get_edges_per_batch(kl_idxs[0], batch_size, kp_batch_idx)
-        batch_num_edges[('kp', 'kl', 'lig')] = kl_edges_per_batch
+        num_edges = {}
+        num_edges[('lig', 'll', 'lig')] = batch_layout.count('lig', ll_idxs[0])
+        kl_edges_per_batch = batch_layout.count('kp', kl_idxs[0])
+        num_edges[('kp', 'kl', 'lig')] = kl_edges_per_batch
 
         # add lig -> kp edges if necessary
         if self.update_kp:
             g.add_edges(kl_idxs[1], kl_idxs[0], etype='lk')
-            batch_num_edges[('lig', 'lk', 'kp')] = kl_edges_per_batch
+            num_edges[('lig', 'lk', 'kp')] = kl_edges_per_batch
 
         # update the graph's batch information
-        g.set_batch_num_edges(batch_num_edges)
-        g.set_batch_num_nodes(batch_num_nodes)
+        batch_layout = batch_layout.with_num_edges(num_edges)
+        batch_layout.apply(g)
 
-        return g
+        return g, batch_layout
     
-    def remove_lig_edges(self, g: dgl.DGLHeteroGraph):
+    def remove_lig_edges(self, g: dgl.DGLHeteroGraph, batch_layout: BatchLayout):
+        # batch_layout is the layout of g from before ligand edges were added
 
         if self.update_kp:
             etypes_to_remove = ['ll', 'kl', 'lk']
         else:
             etypes_to_remove = ['ll', 'kl']
         
-        batch_num_nodes, batch_num_edges = get_batch_info(g)
-
-        for canonical_etype in batch_num_edges:
-            if canonical_etype[1] in etypes_to_remove:
-                batch_num_edges[canonical_etype] = torch.zeros_like(batch_num_edges[canonical_etype])
-        
         for etype in etypes_to_remove:
             eids = g.edges(form='eid', etype=etype)
             g.remove_edges(eids, etype=etype)
         
-        g.set_batch_num_nodes(batch_num_nodes)
-        g.set_batch_num_edges(batch_num_edges)
+        batch_layout.apply(g)
 
         return g
\ No newline at end of file
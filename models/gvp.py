@@ -4,6 +4,7 @@ import dgl
 import dgl.function as fn
 from typing import List, Tuple, Union, Dict
 import math
+from torch.utils.checkpoint import checkpoint
 
 # helper functions
 def exists(val):
@@ -40,6 +41,21 @@ def _rbf(D, D_min=0., D_max=20., D_count=16):
     RBF = torch.exp(-((D_expand - D_mu) / D_sigma) ** 2)
     return RBF
 
+def compute_edge_geometry(g: dgl.DGLHeteroGraph, etype: Tuple[str, str, str], src_pos: torch.Tensor, dst_pos: torch.Tensor, 
+                          rbf_dmax: float = 15, rbf_dim: int = 16) -> Tuple[torch.Tensor, torch.Tensor]:
+    '''
+    Computes the unit displacement vector (src - dst) and the rbf embedding of the distance for every edge of type `etype`.
+
+    Node positions are not updated by GVP convolutions, so a stack of convolutions can compute edge geometry
+    once with this function and pass it to every layer.
+    '''
+    src_idxs, dst_idxs = g.edges(etype=etype)
+    x_diff = src_pos[src_idxs] - dst_pos[dst_idxs]
+    dij = _norm_no_nan(x_diff, keepdims=True) + 1e-8
+    x_diff = x_diff / dij
+    d = _rbf(dij.squeeze(1), D_max=rbf_dmax, D_count=rbf_dim)
+    return x_diff, d
+
 class GVP(nn.Module):
     def __init__(
         self,
@@ -86,6 +102,10 @@ class GVP(nn.Module):
 
         # self.scalar_to_vector_gates = nn.Linear(dim_feats_out, dim_vectors_out) if vector_gating else None
 
+        # cached [Wh | Wh Wu] for fused_forward, see fused_weight()
+        self._fused_weight = None
+        self._fused_weight_key = None
+
     def forward(self, data):
         feats, vectors = data
         b, n, _, v, c  = *feats.shape, *vectors.shape
@@ -114,6 +134,111 @@ class GVP(nn.Module):
         #     raise ValueError("NaNs in GVP forward pass")
 
         return (feats_out, vectors_out)
+
+    def fused_weight(self) -> torch.Tensor:
+        '''
+        Returns [Wh | Wh Wu], the weight that `fused_forward` multiplies the input vectors by.
+
+        Outside of autograd the product is cached. The cache is rebuilt when Wh or Wu are modified in place (e.g. by an optimizer step
+        or `load_state_dict`) or replaced (e.g. when the module is moved to another device).
+        '''
+        # torch.compile traces the product into the graph it builds, so it does not need the cache (whose key would cause graph breaks)
+        if torch.compiler.is_compiling() or (torch.is_grad_enabled() and (self.Wh.requires_grad or self.Wu.requires_grad)):
+            return torch.cat((self.Wh, self.Wh @ self.Wu), dim=1)
+
+        key = (self.Wh._version, self.Wu._version, self.Wh.data_ptr(), self.Wu.data_ptr())
+        if self._fused_weight is None or self._fused_weight_key != key:
+            with torch.no_grad():
+                self._fused_weight = torch.cat((self.Wh, self.Wh @ self.Wu), dim=1)
+            self._fused_weight_key = key
+        return self._fused_weight
+
+    def clear_fused_weight(self):
+        self._fused_weight = None
+        self._fused_weight_key = None
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.clear_fused_weight()
+        super()._load_from_state_dict(*args, **kwargs)
+
+    def fused_forward(self, data):
+        '''
+        Computes the same outputs as `forward` with fewer intermediate tensors. 
+        
+        Vh and Vu are computed with a single matmul against [Wh | Wh Wu], the scalar linear layer is applied
+        to feats and the vector norms separately so that they are never concatenated.
+        Only GVPs with vector gating and a float scalar linear layer have a fused implementation; other GVPs 
+        (including GVPs whose linear layers have been quantized) fall back to `forward`.
+        '''
+        if not exists(self.scalar_to_vector_gates) or type(self.to_feats_out[0]) is not nn.Linear:
+            return self.forward(data)
+
+        feats, vectors = data
+        dim_h = self.Wh.shape[1]
+
+        # compute Vh and Vu with one matmul
+        V = einsum('b v c, v k -> b k c', vectors, self.fused_weight())
+        Vh, Vu = V[:, :dim_h], V[:, dim_h:]
+
+        # same as _norm_no_nan(Vh)
+        sh = torch.square(Vh).sum(dim=-1).clamp(min=1e-8).sqrt_()
+
+        # same as self.to_feats_out(torch.cat((feats, sh), dim=1))
+        feats_linear, feats_activation = self.to_feats_out
+        weight = feats_linear.weight
+        feats_out = torch.addmm(feats_linear.bias, feats, weight[:, :self.dim_feats_in].t())
+        feats_out = feats_out.addmm_(sh, weight[:, self.dim_feats_in:].t())
+        feats_out = feats_activation(feats_out)
+
+        gating = self.scalar_to_vector_gates(feats_out).unsqueeze(-1)
+        vectors_out = self.vectors_activation(gating) * Vu
+
+        return (feats_out, vectors_out)
+
+
+class GVPSequential(nn.Sequential):
+    '''
+    A chain of GVPs. When `fused` is True, every GVP in the chain is run with `GVP.fused_forward`.
+    Parameters are registered exactly as in `nn.Sequential`, so state dicts are interchangeable.
+    '''
+    def __init__(self, *gvps, fused: bool = False):
+        super().__init__(*gvps)
+        self.fused = fused
+
+    def forward(self, data):
+        if not self.fused:
+            return super().forward(data)
+
+        for gvp in self:
+            data = gvp.fused_forward(data)
+        return data
+
+def set_gvp_fusion(model: nn.Module, fused: bool = True):
+    '''Enables or disables fused execution for every GVP chain in `model`. The fused weights of every GVP in a chain are
+    computed when fusion is enabled and released when it is disabled.'''
+    for module in model.modules():
+        if isinstance(module, GVPSequential):
+            module.fused = fused
+            for gvp in module:
+                gvp.clear_fused_weight()
+                if fused:
+                    with torch.no_grad():
+                        gvp.fused_weight()
+    return model
+
+def set_packed_edges(model: nn.Module, packed: bool = True):
+    '''Enables or disables packed message passing for every GVPMultiEdgeConv in `model`.'''
+    for module in model.modules():
+        if isinstance(module, GVPMultiEdgeConv):
+            module.packed = packed
+    return model
+
+def set_edge_chunk_size(model: nn.Module, edge_chunk_size: int = None):
+    '''Sets the number of edges processed at a time by every graph convolution in `model` that supports chunked execution. None disables chunking.'''
+    for module in model.modules():
+        if hasattr(module, 'edge_chunk_size'):
+            module.edge_chunk_size = edge_chunk_size
+    return model
     
 class _VDropout(nn.Module):
     '''
@@ -221,7 +346,7 @@ class GVPEdgeConv(nn.Module):
                     vectors_activation=vector_activation(), 
                     vector_gating=True)
             )
-        self.edge_message = nn.Sequential(*message_gvps)
+        self.edge_message = GVPSequential(*message_gvps)
 
         # create update function
         update_gvps = []
@@ -235,7 +360,7 @@ class GVPEdgeConv(nn.Module):
                     vectors_activation=vector_activation(), 
                     vector_gating=True)
             )
-        self.node_update = nn.Sequential(*update_gvps)
+        self.node_update = GVPSequential(*update_gvps)
         
         self.dropout = GVPDropout(self.dropout_rate)
         self.message_layer_norm = GVPLayerNorm(self.scalar_size)
@@ -250,8 +375,10 @@ class GVPEdgeConv(nn.Module):
                 src_feats: Tuple[torch.Tensor, torch.Tensor, torch.Tensor], 
                 edge_feats: torch.Tensor = None, 
                 dst_feats: Union[Tuple[torch.Tensor, torch.Tensor, torch.Tensor], None] = None,
-                z: Union[float, torch.Tensor] = 1):
+                z: Union[float, torch.Tensor] = 1,
+                edge_geometry: Tuple[torch.Tensor, torch.Tensor] = None):
         # vec_feat has shape (n_nodes, n_vectors, 3)
+        # edge_geometry, if provided, is the output of compute_edge_geometry for this edge type
 
         with g.local_scope():
 
@@ -278,14 +405,11 @@ class GVPEdgeConv(nn.Module):
                 assert edge_feats is not None, "Edge features must be provided."
                 g.edges[self.edge_type].data["a"] = edge_feats
 
-            # get vectors between node positions
-            g.apply_edges(fn.u_sub_v("x", "x", "x_diff"), etype=self.edge_type)
-
-            # normalize x_diff and compute rbf embedding of edge distance
-            # dij = torch.norm(g.edges[self.edge_type].data['x_diff'], dim=-1, keepdim=True)
-            dij = _norm_no_nan(g.edges[self.edge_type].data['x_diff'], keepdims=True) + 1e-8
-            g.edges[self.edge_type].data['x_diff'] = g.edges[self.edge_type].data['x_diff'] / dij
-            g.edges[self.edge_type].data['d'] = _rbf(dij.squeeze(1), D_max=self.rbf_dmax, D_count=self.rbf_dim)
+            # get normalized vectors between node positions and rbf embedding of edge distance
+            if edge_geometry is None:
+                dst_pos = src_feats[1] if dst_feats is None else dst_feats[1]
+                edge_geometry = compute_edge_geometry(g, self.edge_type, src_feats[1], dst_pos, rbf_dmax=self.rbf_dmax, rbf_dim=self.rbf_dim)
+            g.edges[self.edge_type].data['x_diff'], g.edges[self.edge_type].data['d'] = edge_geometry
 
             # compute messages on every edge
             g.apply_edges(self.message, etype=self.edge_type)
@@ -348,11 +472,13 @@ class GVPMultiEdgeConv(nn.Module):
                   scalar_activation=nn.SiLU, vector_activation=nn.Sigmoid,
                   n_message_gvps: int = 1, n_update_gvps: int = 1,
                   rbf_dmax: float = 15, rbf_dim: int = 16,
-                  message_norm: Union[float, str, Dict] = 10, dropout: float = 0.0):
+                  message_norm: Union[float, str, Dict] = 10, dropout: float = 0.0, packed: bool = False, edge_chunk_size: int = None):
         
         super().__init__()
 
         self.etypes = etypes
+        self.packed = packed
+        self.edge_chunk_size = edge_chunk_size
         self.scalar_size = scalar_size
         self.vector_size = vector_size
         self.scalar_activation = scalar_activation
@@ -385,8 +511,10 @@ class GVPMultiEdgeConv(nn.Module):
         # set the aggregation function
         if isinstance(message_norm, (dict, int, float)):
             self.agg_func = fn.sum
+            self.mean_agg = False
         elif message_norm == 'mean':
             self.agg_func = fn.mean
+            self.mean_agg = True
 
         # create message functions for each edge type
         self.edge_message_fns = nn.ModuleDict()
@@ -412,7 +540,7 @@ class GVPMultiEdgeConv(nn.Module):
                 )
 
             key = '_'.join(etype)
-            self.edge_message_fns[key] = nn.Sequential(*edge_message_gvps)
+            self.edge_message_fns[key] = GVPSequential(*edge_message_gvps)
 
         # create node update functions for each node type
         self.node_update_fns = nn.ModuleDict()
@@ -430,7 +558,7 @@ class GVPMultiEdgeConv(nn.Module):
                         vectors_activation=vector_activation(), 
                         vector_gating=True)
                 )
-            self.node_update_fns[ntype] = nn.Sequential(*update_gvps)
+            self.node_update_fns[ntype] = GVPSequential(*update_gvps)
             self.message_layer_norms[ntype] = GVPLayerNorm(scalar_size)
             self.update_layer_norms[ntype] = GVPLayerNorm(scalar_size)
 
@@ -456,8 +584,20 @@ class GVPMultiEdgeConv(nn.Module):
         if invalid_message_norm:
             raise ValueError(f"message_norm values must be 'mean' or a positive number, got {message_norm}")
 
-    def forward(self, g: dgl.DGLHeteroGraph, node_feats: Dict[str, Tuple], batch_idxs: Dict[str, torch.Tensor]):
-        
+    def forward(self, g: dgl.DGLHeteroGraph, node_feats: Dict[str, Tuple], batch_idxs: Dict[str, torch.Tensor], 
+                edge_geometry: Dict[Tuple[str, str, str], Tuple[torch.Tensor, torch.Tensor]] = None,
+                norm_values: Dict[str, Union[float, torch.Tensor]] = None):
+        # edge_geometry, if provided, maps edge types to the output of compute_edge_geometry
+        # norm_values, if provided, is the output of compute_norm_values
+
+        if norm_values is None:
+            norm_values = self.compute_norm_values(g, batch_idxs)
+
+        if self.edge_chunk_size is not None:
+            return self.chunked_forward(g, node_feats, edge_geometry, norm_values)
+
+        if self.packed:
+            return self.packed_forward(g, node_feats, edge_geometry, norm_values)
 
         with g.local_scope():
 
@@ -468,17 +608,9 @@ class GVPMultiEdgeConv(nn.Module):
                 g.nodes[ntype].data['v'] = vec_feats
                 g.nodes[ntype].data['x'] = pos_feats
 
-            # get vectors between node positions and compute rbf embedding of edge distance
+            # get normalized vectors between node positions and compute rbf embedding of edge distance
             for etype in self.etypes:
-                # get vectors between node positions
-                g.apply_edges(fn.u_sub_v("x", "x", "x_diff"), etype=etype)
-
-                # normalize x_diff and compute rbf embedding of edge distance
-                # dij = torch.norm(g.edges[etype].data['x_diff'], dim=-1, keepdim=True)
-                dij = _norm_no_nan(g.edges[etype].data['x_diff'], keepdims=True) + 1e-8
-                g.edges[etype].data['x_diff'] = g.edges[etype].data['x_diff'] / dij
-                g.edges[etype].data['d'] = _rbf(dij.squeeze(1), D_max=self.rbf_dmax, D_count=self.rbf_dim)
-
+                g.edges[etype].data['x_diff'], g.edges[etype].data['d'] = self.get_edge_geometry(g, etype, node_feats, edge_geometry)
 
             # compute edge messages
             for etype in self.etypes:
@@ -499,43 +631,180 @@ class GVPMultiEdgeConv(nn.Module):
             # apply dropout, layernorm, and add to original features
             output_feats = {}
             for ntype in self.dst_ntypes:
+                scalar_feats, pos_feats, vec_feats = node_feats[ntype]
+                scalar_msg, vec_msg = g.nodes[ntype].data["scalar_msg"], g.nodes[ntype].data["vec_msg"]
+                scalar_feats, vec_feats = self.update_node_feats(ntype, scalar_feats, vec_feats, scalar_msg, vec_msg, norm_values[ntype])
+                output_feats[ntype] = (scalar_feats, pos_feats, vec_feats)
+
+        return output_feats    
+
+    def packed_forward(self, g: dgl.DGLHeteroGraph, node_feats: Dict[str, Tuple], 
+                       edge_geometry: Dict[Tuple[str, str, str], Tuple[torch.Tensor, torch.Tensor]], 
+                       norm_values: Dict[str, Union[float, torch.Tensor]]):
+        """Computes the same output as forward without DGL message passing. 
+        
+        The message function inputs of all edge types are packed into one contiguous buffer, ordered by destination node type. 
+        Each edge type's message GVPs are run on its slice of the buffer, and the scalar and vector messages are 
+        aggregated with a single scatter per destination node type."""
+
+        # pack message function inputs for all edge types, grouping edge types by destination node type
+        etypes = sorted(self.etypes, key=lambda etype: etype[2])
+        scalar_inputs, vec_inputs, dst_idxs, edge_weights = [], [], [], []
+        etype_slices = {}
+        n_edges = 0
+        for etype in etypes:
+            src_idx, dst_idx = g.edges(etype=etype)
+            x_diff, d = self.get_edge_geometry(g, etype, node_feats, edge_geometry)
+            src_scalars, _, src_vecs = node_feats[etype[0]]
+            scalar_inputs.append(torch.cat([src_scalars[src_idx], d], dim=1))
+            vec_inputs.append(torch.cat([x_diff.unsqueeze(1), src_vecs[src_idx]], dim=1))
+            dst_idxs.append(dst_idx)
+
+            # with mean aggregation, messages are averaged within each edge type and then summed across edge types
+            if self.mean_agg:
+                in_degrees = g.in_degrees(etype=etype).clamp(min=1)
+                edge_weights.append(1 / in_degrees[dst_idx])
+
+            etype_slices[etype] = (n_edges, n_edges + src_idx.shape[0])
+            n_edges += src_idx.shape[0]
+
+        scalar_inputs = torch.cat(scalar_inputs, dim=0)
+        vec_inputs = torch.cat(vec_inputs, dim=0)
+        dst_idxs = torch.cat(dst_idxs, dim=0)
+
+        # compute messages for each edge type, writing scalar and flattened vector messages into one buffer
+        messages = scalar_inputs.new_empty((n_edges, self.scalar_size + self.vector_size*3))
+        for etype, (start_idx, end_idx) in etype_slices.items():
+            key = '_'.join(etype)
+            scalar_msg, vec_msg = self.edge_message_fns[key]((scalar_inputs[start_idx:end_idx], vec_inputs[start_idx:end_idx]))
+            messages[start_idx:end_idx, :self.scalar_size] = scalar_msg
+            messages[start_idx:end_idx, self.scalar_size:] = vec_msg.flatten(1)
+
+        if self.mean_agg:
+            messages = messages * torch.cat(edge_weights, dim=0).unsqueeze(1)
+
+        # aggregate messages and update features for every destination node type
+        output_feats = {}
+        for ntype in self.dst_ntypes:
+            scalar_feats, pos_feats, vec_feats = node_feats[ntype]
+
+            ntype_etypes = [ etype for etype in etypes if etype[2] == ntype ]
+            start_idx, end_idx = etype_slices[ntype_etypes[0]][0], etype_slices[ntype_etypes[-1]][1]
+            agg_msg = messages.new_zeros((scalar_feats.shape[0], messages.shape[1]))
+            agg_msg = agg_msg.index_add_(0, dst_idxs[start_idx:end_idx], messages[start_idx:end_idx])
+
+            scalar_msg = agg_msg[:, :self.scalar_size]
+            vec_msg = agg_msg[:, self.scalar_size:].view(-1, self.vector_size, 3)
+            scalar_feats, vec_feats = self.update_node_feats(ntype, scalar_feats, vec_feats, scalar_msg, vec_msg, norm_values[ntype])
+            output_feats[ntype] = (scalar_feats, pos_feats, vec_feats)
+
+        return output_feats
 
-                # get the normalization value for this node type
-                if self.norm_values[ntype] == 0:
-                    # the norm_value needs to be the average number of edges per node - this means a separate normalization value for every graph in the batch
-                    norm_value = torch.stack([g.batch_num_edges(etype) for etype in self.etypes if etype[-1] == ntype ], dim=0).sum(dim=0) / g.batch_num_nodes(ntype) + 1
-                    norm_value = norm_value[ batch_idxs[ntype] ].unsqueeze(1)
+    def chunked_forward(self, g: dgl.DGLHeteroGraph, node_feats: Dict[str, Tuple], 
+                        edge_geometry: Dict[Tuple[str, str, str], Tuple[torch.Tensor, torch.Tensor]], 
+                        norm_values: Dict[str, Union[float, torch.Tensor]]):
+        """Computes the same output as forward while computing messages for at most edge_chunk_size edges at a time.
+
+        Messages of each chunk are summed onto destination nodes as soon as they are computed, so peak memory is bounded by 
+        the chunk size rather than the number of edges. When gradients are required, the messages of each chunk are 
+        recomputed during the backward pass instead of being stored."""
+
+        # aggregated messages for every destination node type
+        scalar_agg, vec_agg = {}, {}
+        for ntype in self.dst_ntypes:
+            n_dst = node_feats[ntype][0].shape[0]
+            scalar_agg[ntype] = node_feats[ntype][0].new_zeros((n_dst, self.scalar_size))
+            vec_agg[ntype] = node_feats[ntype][2].new_zeros((n_dst, self.vector_size, 3))
+
+        for etype in self.etypes:
+            key = '_'.join(etype)
+            src_idx, dst_idx = g.edges(etype=etype)
+            x_diff, d = self.get_edge_geometry(g, etype, node_feats, edge_geometry)
+            src_scalars, _, src_vecs = node_feats[etype[0]]
+
+            # with mean aggregation, messages are averaged within each edge type and then summed across edge types
+            if self.mean_agg:
+                in_degrees = g.in_degrees(etype=etype).clamp(min=1)
+                edge_weights = 1 / in_degrees[dst_idx]
+
+            for start_idx in range(0, src_idx.shape[0], self.edge_chunk_size):
+                chunk = slice(start_idx, start_idx + self.edge_chunk_size)
+                chunk_inputs = (key, src_scalars, src_vecs, src_idx[chunk], x_diff[chunk], d[chunk])
+                if torch.is_grad_enabled():
+                    scalar_msg, vec_msg = checkpoint(self.chunk_messages, *chunk_inputs, use_reentrant=False)
                 else:
-                    norm_value = self.norm_values[ntype]
+                    scalar_msg, vec_msg = self.chunk_messages(*chunk_inputs)
 
-                scalar_feats, vec_feats = g.nodes[ntype].data["h"], g.nodes[ntype].data["v"]
-                scalar_msg = g.nodes[ntype].data["scalar_msg"] / norm_value
+                if self.mean_agg:
+                    scalar_msg = scalar_msg * edge_weights[chunk].unsqueeze(1)
+                    vec_msg = vec_msg * edge_weights[chunk].view(-1, 1, 1)
 
-                if isinstance(norm_value, torch.Tensor):
-                    norm_value = norm_value.unsqueeze(-1)
-                    
-                vec_msg = g.nodes[ntype].data["vec_msg"] / norm_value
-                scalar_msg, vec_msg = self.dropout(scalar_msg, vec_msg)
-                scalar_feats = scalar_feats + scalar_msg
-                vec_feats = vec_feats + vec_msg
-                scalar_feats, vec_feats = self.message_layer_norms[ntype](scalar_feats, vec_feats)
+                scalar_agg[etype[2]].index_add_(0, dst_idx[chunk], scalar_msg)
+                vec_agg[etype[2]].index_add_(0, dst_idx[chunk], vec_msg)
 
-                # apply node update function
-                scalar_res, vec_res = self.node_update_fns[ntype]((scalar_feats, vec_feats))
+        # update features for every destination node type
+        output_feats = {}
+        for ntype in self.dst_ntypes:
+            scalar_feats, pos_feats, vec_feats = node_feats[ntype]
+            scalar_feats, vec_feats = self.update_node_feats(ntype, scalar_feats, vec_feats, scalar_agg[ntype], vec_agg[ntype], norm_values[ntype])
+            output_feats[ntype] = (scalar_feats, pos_feats, vec_feats)
+
+        return output_feats
+
+    def chunk_messages(self, key: str, src_scalars: torch.Tensor, src_vecs: torch.Tensor, src_idx: torch.Tensor, 
+                       x_diff: torch.Tensor, d: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        scalar_feats = torch.cat([src_scalars[src_idx], d], dim=1)
+        vec_feats = torch.cat([x_diff.unsqueeze(1), src_vecs[src_idx]], dim=1)
+        return self.edge_message_fns[key]((scalar_feats, vec_feats))
+
+    def get_edge_geometry(self, g: dgl.DGLHeteroGraph, etype: Tuple[str, str, str], node_feats: Dict[str, Tuple], 
+                          edge_geometry: Dict[Tuple[str, str, str], Tuple[torch.Tensor, torch.Tensor]] = None):
+        if edge_geometry is not None and etype in edge_geometry:
+            return edge_geometry[etype]
+        src_pos, dst_pos = node_feats[etype[0]][1], node_feats[etype[2]][1]
+        return compute_edge_geometry(g, etype, src_pos, dst_pos, rbf_dmax=self.rbf_dmax, rbf_dim=self.rbf_dim)
+
+    def compute_norm_values(self, g: dgl.DGLHeteroGraph, batch_idxs: Dict[str, torch.Tensor]) -> Dict[str, Union[float, torch.Tensor]]:
+        """Computes the value that aggregated messages are divided by for every destination node type. 
+        
+        This only depends on the number of edges in the graph, so it can be computed once and reused by every layer with the same edge types."""
+        norm_values = {}
+        for ntype in self.dst_ntypes:
+            if self.norm_values[ntype] == 0:
+                # the norm_value needs to be the average number of edges per node - this means a separate normalization value for every graph in the batch
+                norm_value = torch.stack([batch_idxs.num_edges[etype] for etype in self.etypes if etype[-1] == ntype ], dim=0).sum(dim=0) / batch_idxs.num_nodes[ntype] + 1
+                norm_values[ntype] = norm_value[ batch_idxs[ntype] ].unsqueeze(1)
+            else:
+                norm_values[ntype] = self.norm_values[ntype]
+        return norm_values
 
-                # if torch.isnan(scalar_res).any() or torch.isnan(vec_res).any():
-                #     raise ValueError("NaNs in node update function")
+    def update_node_feats(self, ntype: str, scalar_feats: torch.Tensor, vec_feats: torch.Tensor, 
+                          scalar_msg: torch.Tensor, vec_msg: torch.Tensor, norm_value: Union[float, torch.Tensor]):
+        """Normalizes aggregated messages, adds them to node features, and applies the node update function."""
 
-                scalar_res, vec_res = self.dropout(scalar_res, vec_res)
-                scalar_feats = scalar_feats + scalar_res
-                vec_feats = vec_feats + vec_res
-                scalar_feats, vec_feats = self.update_layer_norms[ntype](scalar_feats, vec_feats)
+        scalar_msg = scalar_msg / norm_value
 
-                pos_feats = g.nodes[ntype].data["x"]
+        if isinstance(norm_value, torch.Tensor):
+            norm_value = norm_value.unsqueeze(-1)
+            
+        vec_msg = vec_msg / norm_value
+        scalar_msg, vec_msg = self.dropout(scalar_msg, vec_msg)
+        scalar_feats = scalar_feats + scalar_msg
+        vec_feats = vec_feats + vec_msg
+        scalar_feats, vec_feats = self.message_layer_norms[ntype](scalar_feats, vec_feats)
 
-                output_feats[ntype] = (scalar_feats, pos_feats, vec_feats)
+        # apply node update function
+        scalar_res, vec_res = self.node_update_fns[ntype]((scalar_feats, vec_feats))
 
-        return output_feats    
+        # if torch.isnan(scalar_res).any() or torch.isnan(vec_res).any():
+        #     raise ValueError("NaNs in node update function")
+
+        scalar_res, vec_res = self.dropout(scalar_res, vec_res)
+        scalar_feats = scalar_feats + scalar_res
+        vec_feats = vec_feats + vec_res
+        scalar_feats, vec_feats = self.update_layer_norms[ntype](scalar_feats, vec_feats)
+
+        return scalar_feats, vec_feats
 
     def message(self, edges):
 
@@ -1,6 +1,7 @@
+from collections import defaultdict
 from math import ceil
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, List, Tuple, Union
 
 import dgl
 import dgl.function as dglfn
@@ -8,7 +9,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as fn
-from torch_scatter import segment_coo, segment_csr
+from torch_scatter import segment_coo
 
 from losses.rec_encoder_loss import ReceptorEncoderLoss
 from losses.dist_hinge_loss import DistanceHingeLoss
@@ -18,24 +19,34 @@ from models.receptor_encoder import ReceptorEncoder
 from models.receptor_encoder_gvp import ReceptorEncoderGVP
 from models.receptor_encoder_fixed import FixedReceptorEncoder
 from models.n_nodes_dist import LigandSizeDistribution
-from utils import get_batch_info, get_nodes_per_batch, copy_graph, get_batch_idxs
-from torch_scatter import segment_csr
+from models.sampling_graphs import build_keypoint_graph, pool_keypoints
+from utils import BatchLayout, PackedLigands, copy_graph, get_batch_idxs, n_receptor_atoms, select_graphs
 
 class KeypointDiffusion(nn.Module):
 
     def __init__(self, atom_nf, rec_nf, processed_dataset_dir: Path, n_timesteps: int = 1000, keypoint_centered=False, architecture: str = 'egnn', rec_encoder_type: str = 'learned',
-                 graph_config={}, dynamics_config = {}, rec_encoder_config = {}, rec_encoder_loss_config= {}, precision=1e-4, lig_feat_norm_constant=1, rl_dist_threshold=0, use_fake_atoms=False):
+                 graph_config={}, dynamics_config = {}, rec_encoder_config = {}, rec_encoder_loss_config= {}, precision=1e-4, lig_feat_norm_constant=1, rl_dist_threshold=0, use_fake_atoms=False, rec_atom_nf: int = None):
         super().__init__()
 
         # NOTE: keypoint_centered is deprecated. This flag no longer has any effect. It is kept as an argument for backwards compatibility with previously trained models.
 
         self.n_lig_features = atom_nf
         self.n_kp_feat = rec_nf
+        self.n_rec_features = rec_atom_nf # number of receptor atom features, needed to expand receptor element indicies to one-hot features
         self.n_timesteps = n_timesteps
         self.lig_feat_norm_constant = lig_feat_norm_constant
         self.use_fake_atoms = use_fake_atoms
         self.rec_encoder_type = rec_encoder_type
 
+        # running counts of samples that diverged during sampling, see check_divergence()
+        self.divergence_counts = defaultdict(int)
+
+        # running count of complexes that left the cropped region when sampling with crop_radius and fell back to all keypoints
+        self.crop_fallback_count = 0
+
+        # compiled dense sampler used in place of the graph-based reverse chain, see models.dense_gvp.compile_for_sampling
+        self.dense_sampler = None
+
         # check architecture
         if architecture not in ['egnn', 'gvp']:
             raise ValueError(f'Unsupported architecture: {architecture}')
@@ -91,7 +102,8 @@ class KeypointDiffusion(nn.Module):
         
         losses = {}
 
-        # normalize values
+        # expand element indicies to one-hot features and normalize values
+        complex_graphs = self.expand_element_features(complex_graphs)
         complex_graphs = self.normalize(complex_graphs)
 
         batch_size = complex_graphs.batch_size
@@ -99,12 +111,8 @@ class KeypointDiffusion(nn.Module):
 
         batch_idxs = get_batch_idxs(complex_graphs)
                 
-        # encode the receptor
-        complex_graphs = self.rec_encoder(complex_graphs, batch_idxs)
-
-        # if we are using a fixed receptor encoding we have to recompute the batch indicies after passing through the receptor encoder
-        if self.rec_encoder_type == 'fixed':
-            batch_idxs = get_batch_idxs(complex_graphs)
+        # encode the receptor, the receptor encoder returns the batch layout of the encoded graph
+        complex_graphs, batch_idxs = self.rec_encoder(complex_graphs, batch_idxs)
 
         # if we are applying the RL hinge loss, we will need to be able to put receptor atoms and the ligand into the same
         # referance frame. in order to do this, we need the initial COM of the keypoints
@@ -174,6 +182,18 @@ class KeypointDiffusion(nn.Module):
 
         return losses
     
+    def expand_element_features(self, g: dgl.DGLHeteroGraph) -> dgl.DGLHeteroGraph:
+        """Expands node features stored as element indicies, as in graphs from ProteinLigandDataset, to one-hot float features. 
+        Node types that already have one-hot features are left unchanged."""
+        n_features = {'lig': self.n_lig_features, 'rec': self.n_rec_features, 'kp': self.n_rec_features}
+        for ntype, n_feat in n_features.items():
+            if 'h_0' not in g.nodes[ntype].data or g.nodes[ntype].data['h_0'].dim() != 1:
+                continue
+            if n_feat is None:
+                raise ValueError(f'{ntype} features are element indicies but the number of {ntype} features is unknown')
+            g.nodes[ntype].data['h_0'] = fn.one_hot(g.nodes[ntype].data['h_0'].long(), num_classes=n_feat).float()
+        return g
+
     def normalize(self, complex_graphs: dgl.DGLHeteroGraph):
         complex_graphs.nodes['lig'].data['h_0'] = complex_graphs.nodes['lig'].data['h_0'] / self.lig_feat_norm_constant
         return complex_graphs
@@ -254,21 +274,16 @@ class KeypointDiffusion(nn.Module):
     def encode_receptors(self, g: dgl.DGLHeteroGraph) -> dgl.DGLHeteroGraph:
         # this function is used to encode receptors ONLY during sampling/
 
-        device = g.device
-
-        # get batch indicies of every ligand and keypoint - useful later
-        batch_idx = torch.arange(g.batch_size, device=device)
-        kp_batch_idx = batch_idx.repeat_interleave(g.batch_num_nodes('kp'))
-        batch_idxs = get_batch_idxs(g)
-
         # get keypoints positions/features
-        g = self.rec_encoder(g, batch_idxs)
+        g = self.expand_element_features(g)
+        g, _ = self.rec_encoder(g, get_batch_idxs(g))
 
         return g
 
     
     @torch.no_grad()
-    def _sample(self, ref_graphs: List[dgl.DGLHeteroGraph], n_lig_atoms: List[List[int]], rec_enc_batch_size: int = 32, diff_batch_size: int = 32, visualize=False, use_ref_lig_com: bool = False) -> List[List[Dict[str, torch.Tensor]]]:
+    def _sample(self, ref_graphs: List[dgl.DGLHeteroGraph], n_lig_atoms: List[List[int]], rec_enc_batch_size: int = 32, diff_batch_size: int = 32, visualize=False, use_ref_lig_com: bool = False,
+                divergence_check: bool = False, max_kp_com_dist: float = 30.0, max_restarts: int = 0, packed: bool = False, **sampling_kwargs) -> List[List[Dict[str, torch.Tensor]]]:
         """Sample multiple receptors with multiple ligands per receptor.
 
         Args:
@@ -276,6 +291,8 @@ class KeypointDiffusion(nn.Module):
             n_lig_atoms (List[List[int]]): A list that contains a list for each receptor. Each nested list contains integers that each specify the number of atoms in a ligand.
             rec_enc_batch_size (int, optional): Batch size for forward passes through receptor encoder. Defaults to 32.
             diff_batch_size (int, optional): Batch size for forward passes through denoising model. Defaults to 32.
+            packed (bool, optional): If True, all ligands are returned in a single PackedLigands. The pocket id of every ligand is the index of its receptor 
+                and the request id is its index in n_lig_atoms[pocket_id]. Defaults to False.
 
         Returns:
             List[Dict[str, torch.Tensor]]: A list of length len(receptors). Each element of this list is a dictionary with keys "positions" and "features". The values are lists of tensors, one tensor per ligand. 
@@ -284,6 +301,9 @@ class KeypointDiffusion(nn.Module):
         device = ref_graphs[0].device
         n_receptors = len(ref_graphs)
 
+        if packed and visualize:
+            raise ValueError('packed outputs are not supported when visualizing the sampling trajectory')
+
         # encode all the receptors
         ref_graphs_batched = dgl.batch(ref_graphs)
         ref_graphs_batched = self.encode_receptors(ref_graphs_batched)
@@ -298,10 +318,15 @@ class KeypointDiffusion(nn.Module):
 
             graphs.extend(g_copies)
 
+        # pocket and request id of every complex
+        pocket_ids = torch.arange(n_receptors).repeat_interleave(torch.tensor([ len(n) for n in n_lig_atoms ]))
+        request_ids = torch.cat([ torch.arange(len(n)) for n in n_lig_atoms ])
+
         # proceed to batched sampling
         n_complexes = len(graphs)
         n_complexes_sampled = 0
         lig_pos, lig_feat = [], []
+        packed_samples = []
         for batch_idx in range(ceil(n_complexes / diff_batch_size)):
 
             # determine number of complexes that will be in this batch
@@ -317,12 +342,25 @@ class KeypointDiffusion(nn.Module):
             else:
                 init_lig_pos = None
 
-            batch_lig_pos, batch_lig_feat = self.sample_from_encoded_receptors(batch_graphs, visualize=visualize, init_lig_pos=init_lig_pos)
+            if packed:
+                packed_samples.append(self.sample_from_encoded_receptors(batch_graphs, init_lig_pos=init_lig_pos,
+                                                                         divergence_check=divergence_check, max_kp_com_dist=max_kp_com_dist, max_restarts=max_restarts,
+                                                                         packed=True, pocket_ids=pocket_ids[start_idx:end_idx], request_ids=request_ids[start_idx:end_idx],
+                                                                         **sampling_kwargs))
+                n_complexes_sampled += n_samples_batch
+                continue
+
+            batch_lig_pos, batch_lig_feat = self.sample_from_encoded_receptors(batch_graphs, visualize=visualize, init_lig_pos=init_lig_pos,
+                                                                               divergence_check=divergence_check, max_kp_com_dist=max_kp_com_dist, max_restarts=max_restarts,
+                                                                               **sampling_kwargs)
             lig_pos.extend(batch_lig_pos)
             lig_feat.extend(batch_lig_feat)
 
             n_complexes_sampled += n_samples_batch
 
+        if packed:
+            return PackedLigands.cat(packed_samples)
+
         # group sampled ligands by receptor
         samples = []
         end_idx = 0
@@ -339,11 +377,44 @@ class KeypointDiffusion(nn.Module):
 
         return samples
 
-    def sample_from_encoded_receptors(self, g: dgl.DGLHeteroGraph, visualize=False, init_lig_pos: torch.Tensor = None) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+    def sample_from_encoded_receptors(self, g: dgl.DGLHeteroGraph, visualize=False, init_lig_pos: torch.Tensor = None,
+                                      divergence_check: bool = False, max_kp_com_dist: float = 30.0, max_restarts: int = 0,
+                                      coarse_kp_ratio: float = None, coarse_switch_step: int = 0, crop_radius: float = None,
+                                      packed: bool = False, pocket_ids: torch.Tensor = None, request_ids: torch.Tensor = None, keep_features: bool = False) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        """Sample ligands for a batch of receptors that have already been passed through the receptor encoder.
+
+        By default, lists containing the positions and features of every ligand are returned. If packed is True, the ligands are instead 
+        returned as a PackedLigands, with packed positions and element indicies on the cpu, and pocket_ids/request_ids of shape (batch_size,) are 
+        recorded for every ligand. Ligand features are only included in packed outputs if keep_features is True.
+
+        If divergence_check is True, every sample is checked for non-finite values and for ligand atoms that have drifted more than max_kp_com_dist
+        angstroms from the keypoint COM after each denoising step. Diverged samples are dropped from the batch for the rest of the reverse chain and
+        restarted from scratch up to max_restarts times. Samples that still diverge are returned as empty (zero-atom) tensors.
+
+        If coarse_kp_ratio is specified, the keypoints are pooled into roughly coarse_kp_ratio*n_keypoints clusters and the 
+        denoising steps s >= coarse_switch_step are performed with the pooled keypoints. The full set of keypoints is used for the remaining steps.
+
+        If crop_radius is specified, only keypoints within crop_radius + the kl cutoff of the initial ligand COM are used for sampling.
+        If a ligand atom moves further than crop_radius from the initial ligand COM, sampling falls back to the full set of keypoints for that complex.
+        """
 
         device = g.device
         batch_size = g.batch_size
 
+        # keep an untouched copy of the encoded receptors so that diverged samples can be restarted
+        restart_diverged = divergence_check and max_restarts > 0 and not visualize
+        if restart_diverged:
+            g_restart = copy_graph(g, n_copies=1, batched_graph=True)[0]
+
+        # diverged samples are dropped from the batch, so we keep track of the ids and batch index of the samples that are still being sampled
+        if divergence_check and visualize:
+            raise NotImplementedError('visualization is not supported when checking for divergence')
+        if pocket_ids is None:
+            pocket_ids = torch.zeros(batch_size, dtype=torch.long)
+        if request_ids is None:
+            request_ids = torch.arange(batch_size)
+        active_idxs = torch.arange(batch_size)
+
         # get initial keypoint center of mass
         init_kp_com = dgl.readout_nodes(g, feat='x_0', op='mean', ntype='kp')
         
@@ -366,8 +437,33 @@ class KeypointDiffusion(nn.Module):
         for feat in ['x_0', 'h_0']:
             g.nodes['lig'].data[feat] = torch.randn(g.nodes['lig'].data[feat].shape, device=device)
 
+        # graphs with a reduced set of keypoints can be sampled on in place of g. every time we swap in a reduced graph, 
+        # the graph it replaces is pushed onto reduced_graph_stack so that the ligands can later be moved back onto it
+        reduced_graph_stack = []
+        if (coarse_kp_ratio is not None or crop_radius is not None) and visualize:
+            raise NotImplementedError('visualization is not supported when sampling with coarse or cropped keypoints')
+
+        # if requested, drop keypoints that are far from the initial ligand position, which is currently the origin
+        crop_center = None
+        if crop_radius is not None:
+            crop_center = torch.zeros((batch_size, 3), device=device)
+            uncropped = torch.zeros(batch_size, dtype=torch.bool, device=device)
+            g, batch_idxs = self.push_reduced_graph(g, batch_idxs, 
+                self.build_cropped_graph(g, batch_idxs, crop_center, crop_radius + self.dynamics.graph_cutoffs['kl']), 
+                reduced_graph_stack, 'crop')
+
         # remove ligand com from every receptor/ligand complex
-        g = self.remove_com(g, lig_batch_idx, kp_batch_idx, com='ligand') 
+        if crop_center is not None:
+            kp_com = dgl.readout_nodes(g, feat='x_0', op='mean', ntype='kp')
+        g = self.remove_com(g, batch_idxs['lig'], batch_idxs['kp'], com='ligand') 
+        if crop_center is not None:
+            crop_center = crop_center + dgl.readout_nodes(g, feat='x_0', op='mean', ntype='kp') - kp_com
+
+        # if requested, swap in a graph with pooled keypoints for the early denoising steps
+        if coarse_kp_ratio is not None and coarse_switch_step < self.n_timesteps:
+            g, batch_idxs = self.push_reduced_graph(g, batch_idxs, 
+                self.build_coarse_graph(g, batch_idxs, coarse_kp_ratio), 
+                reduced_graph_stack, 'coarse')
 
         if visualize:
             
@@ -388,7 +484,7 @@ class KeypointDiffusion(nn.Module):
 
             # remove fake atoms
             if self.use_fake_atoms:
-                g_frame = self.remove_fake_atoms(g_frame, lig_batch_idx)
+                g_frame = self.remove_fake_atoms(g_frame, batch_idxs)
             
             lig_pos_frames = []
             lig_feat_frames = []
@@ -400,14 +496,63 @@ class KeypointDiffusion(nn.Module):
             lig_pos_frames.append(lig_pos)
             lig_feat_frames.append(lig_feat)
 
+        # if a compiled dense sampler is set up and none of the graph-based sampling options are used, it runs the whole reverse chain
+        use_dense_sampler = self.dense_sampler is not None and not visualize and not divergence_check and not reduced_graph_stack \
+            and crop_center is None and self.dense_sampler.supports(batch_idxs)
+        if use_dense_sampler:
+            g = self.dense_sampler.sample(g, batch_idxs)
+
         # Iteratively sample p(z_s | z_t) for t = 1, ..., T, with s = t - 1.
-        for s in reversed(range(0, self.n_timesteps)):
-            s_arr = torch.full(size=(batch_size,), fill_value=s, device=device)
+        diverged = torch.zeros(batch_size, dtype=torch.bool)
+        denoising_steps = [] if use_dense_sampler else reversed(range(0, self.n_timesteps))
+        for s in denoising_steps:
+
+            # switch from coarse to full keypoints
+            if reduced_graph_stack and reduced_graph_stack[-1][-1] == 'coarse' and s < coarse_switch_step:
+                g, batch_idxs = self.pop_reduced_graph(g, reduced_graph_stack)
+
+            s_arr = torch.full(size=(g.batch_size,), fill_value=s, device=device)
             t_arr = s_arr + 1
             s_arr = s_arr / self.n_timesteps
             t_arr = t_arr / self.n_timesteps
 
+            if crop_center is not None:
+                kp_com = dgl.readout_nodes(g, feat='x_0', op='mean', ntype='kp')
+
             g = self.sample_p_zs_given_zt(s_arr, t_arr, g, batch_idxs)
+
+            # keep track of the crop center as the system is translated. complexes whose ligand leaves the cropped region fall back to all keypoints
+            if crop_center is not None:
+                crop_center = crop_center + dgl.readout_nodes(g, feat='x_0', op='mean', ntype='kp') - kp_com
+                crop_dist = torch.linalg.vector_norm(g.nodes['lig'].data['x_0'] - crop_center[ batch_idxs['lig'] ], dim=1)
+                left_crop = torch.zeros_like(uncropped)
+                left_crop[ batch_idxs['lig'][crop_dist > crop_radius] ] = True
+                left_crop = left_crop & ~uncropped
+                if left_crop.any():
+                    uncropped = uncropped | left_crop
+                    self.crop_fallback_count += int(left_crop.sum())
+                    g, batch_idxs = self.rebuild_cropped_graph(g, reduced_graph_stack, crop_center, 
+                        torch.where(uncropped, float('inf'), crop_radius + self.dynamics.graph_cutoffs['kl']), coarse_kp_ratio=coarse_kp_ratio)
+                    if uncropped.all():
+                        crop_center = None
+
+            # drop diverged samples from the batch. if every remaining sample diverged, there is nothing left to sample
+            if divergence_check:
+                new_diverged = self.check_divergence(g, batch_idxs, max_kp_com_dist=max_kp_com_dist)
+                if new_diverged.any():
+                    new_diverged = new_diverged.cpu()
+                    diverged[active_idxs[new_diverged]] = True
+                    if new_diverged.all():
+                        break
+
+                    active_idxs = active_idxs[~new_diverged]
+                    keep_mask = (~new_diverged).to(device)
+                    g, batch_idxs = self.drop_graphs(g, keep_mask, reduced_graph_stack)
+                    init_kp_com = init_kp_com[keep_mask]
+                    if crop_center is not None:
+                        crop_center = crop_center[keep_mask]
+                        uncropped = uncropped[keep_mask]
+
             if visualize:
 
                 # make a copy of g
@@ -423,7 +568,7 @@ class KeypointDiffusion(nn.Module):
 
                 # remove fake atoms
                 if self.use_fake_atoms:
-                    g_frame = self.remove_fake_atoms(g_frame, lig_batch_idx)
+                    g_frame = self.remove_fake_atoms(g_frame, batch_idxs)
 
                 # convert graph to cpu and split out ligand positions and features
                 g_frame = g_frame.to('cpu')
@@ -434,8 +579,12 @@ class KeypointDiffusion(nn.Module):
                 lig_pos_frames.append(lig_pos)
                 lig_feat_frames.append(lig_feat)
 
+        # move the ligands back onto the graph with all keypoints
+        while reduced_graph_stack:
+            g, batch_idxs = self.pop_reduced_graph(g, reduced_graph_stack)
+
         # remove keypoint COM from system after generation
-        g = self.remove_com(g, lig_batch_idx, kp_batch_idx, com='receptor')
+        g = self.remove_com(g, batch_idxs['lig'], batch_idxs['kp'], com='receptor')
 
         # TODO: model P(x0 | x1)?
 
@@ -457,16 +606,179 @@ class KeypointDiffusion(nn.Module):
         
         # remove fake atoms if they were used
         if self.use_fake_atoms:
-            g = self.remove_fake_atoms(g, lig_batch_idx)
+            g = self.remove_fake_atoms(g, batch_idxs)
+
+        # pack the ligands directly from the graph and only move ligand data to the cpu
+        keep_features = keep_features or not packed
+        samples = PackedLigands.from_graph(g, pocket_ids=pocket_ids[active_idxs], request_ids=request_ids[active_idxs], keep_features=keep_features).to('cpu')
+
+        # samples dropped from the batch are added back as ligands with no atoms
+        dropped = torch.ones(batch_size, dtype=torch.bool)
+        dropped[active_idxs] = False
+        if dropped.any():
+            dropped_idxs = torch.where(dropped)[0]
+            dropped_samples = PackedLigands.empty(pocket_ids[dropped_idxs], request_ids[dropped_idxs], 
+                n_features=samples.features.shape[1] if keep_features else None)
+            order = torch.argsort(torch.cat([active_idxs, dropped_idxs]))
+            samples = PackedLigands.cat([samples, dropped_samples]).index_select(order)
+
+        # report diverged samples and restart them if requested
+        n_diverged = int(diverged.sum())
+        if n_diverged > 0:
+            samples = self.handle_diverged_samples(samples, diverged, 
+                g_restart=g_restart if restart_diverged else None, 
+                init_lig_pos=init_lig_pos, 
+                max_kp_com_dist=max_kp_com_dist, 
+                max_restarts=max_restarts,
+                coarse_kp_ratio=coarse_kp_ratio,
+                coarse_switch_step=coarse_switch_step,
+                crop_radius=crop_radius)
+
+        if packed:
+            return samples
+
+        return samples.split(features=True)
+
+    def build_coarse_graph(self, g: dgl.DGLHeteroGraph, batch_idxs: Dict[str, torch.Tensor], coarse_kp_ratio: float) -> dgl.DGLHeteroGraph:
+        """Builds a copy of g for sampling where the keypoints have been pooled into a smaller number of clusters."""
+        kp_data, kp_batch_idx = pool_keypoints(g, batch_idxs['kp'], ratio=coarse_kp_ratio)
+        lig_data = { feat: g.nodes['lig'].data[feat] for feat in ['x_0', 'h_0'] }
+        g_coarse = build_keypoint_graph(g, kp_data, kp_batch_idx, lig_data, batch_idxs['lig'], 
+            batch_size=g.batch_size, kk_cutoff=self.dynamics.graph_cutoffs.get('kk'))
+        return g_coarse
+
+    def build_cropped_graph(self, g: dgl.DGLHeteroGraph, batch_idxs: Dict[str, torch.Tensor], center: torch.Tensor, radius: Union[float, torch.Tensor]) -> dgl.DGLHeteroGraph:
+        """Builds a copy of g for sampling that only contains the keypoints within radius of center. radius is either a float or 
+        a tensor of shape (batch_size,) containing the radius for every graph.
+
+        Graphs that have no keypoints within radius of center keep all of their keypoints.
+        """
+        kp_batch_idx = batch_idxs['kp']
+        kp_dist = torch.linalg.vector_norm(g.nodes['kp'].data['x_0'] - center[kp_batch_idx], dim=1)
+        if torch.is_tensor(radius):
+            radius = radius[kp_batch_idx]
+        kp_mask = kp_dist < radius
+        n_kept = torch.bincount(kp_batch_idx[kp_mask], minlength=g.batch_size)
+        kp_mask = kp_mask | (n_kept == 0)[kp_batch_idx]
+
+        kp_data = { feat: val[kp_mask] for feat, val in g.nodes['kp'].data.items() }
+
+        # keep kk edges between retained keypoints
+        kk_src, kk_dst = g.edges(etype='kk')
+        kk_mask = kp_mask[kk_src] & kp_mask[kk_dst]
+        new_kp_idx = torch.cumsum(kp_mask.long(), dim=0) - 1
+        kk_idxs = (new_kp_idx[kk_src[kk_mask]], new_kp_idx[kk_dst[kk_mask]])
+
+        lig_data = { feat: g.nodes['lig'].data[feat] for feat in ['x_0', 'h_0'] }
+        g_cropped = build_keypoint_graph(g, kp_data, kp_batch_idx[kp_mask], lig_data, batch_idxs['lig'], 
+            batch_size=g.batch_size, kk_idxs=kk_idxs)
+        return g_cropped
+
+    def rebuild_cropped_graph(self, g: dgl.DGLHeteroGraph, reduced_graph_stack: list, center: torch.Tensor, radius: torch.Tensor, 
+                              coarse_kp_ratio: float = None) -> Tuple[dgl.DGLHeteroGraph, Dict[str, torch.Tensor]]:
+        """Replaces the cropped graph on reduced_graph_stack with one that is cropped with the per-graph radius, e.g. to give complexes 
+        that left the cropped region all of their keypoints. A coarse graph on top of the cropped graph is rebuilt as well. 
+        Returns the graph to sample on and its batch indicies."""
+        reasons = [ reason for *_, reason in reduced_graph_stack ]
+        while reduced_graph_stack[-1][-1] != 'crop':
+            g, batch_idxs = self.pop_reduced_graph(g, reduced_graph_stack)
+        g, batch_idxs = self.pop_reduced_graph(g, reduced_graph_stack)
+
+        # complexes with an infinite radius keep all keypoints, so the cropped graph is only needed if some complexes are still cropped
+        if torch.isfinite(radius).any():
+            g, batch_idxs = self.push_reduced_graph(g, batch_idxs, 
+                self.build_cropped_graph(g, batch_idxs, center, radius), 
+                reduced_graph_stack, 'crop')
+        if reasons[-1] == 'coarse':
+            g, batch_idxs = self.push_reduced_graph(g, batch_idxs, 
+                self.build_coarse_graph(g, batch_idxs, coarse_kp_ratio), 
+                reduced_graph_stack, 'coarse')
+        return g, batch_idxs
+
+    def push_reduced_graph(self, g: dgl.DGLHeteroGraph, batch_idxs: Dict[str, torch.Tensor], g_reduced: dgl.DGLHeteroGraph, 
+                           reduced_graph_stack: list, reason: str) -> Tuple[dgl.DGLHeteroGraph, Dict[str, torch.Tensor]]:
+        """Swaps g for g_reduced, a graph with the same ligands but fewer keypoints. Returns g_reduced and its batch indicies."""
+        reduced_kp_com = dgl.readout_nodes(g_reduced, feat='x_0', op='mean', ntype='kp')
+        reduced_graph_stack.append( (g, batch_idxs, reduced_kp_com, reason) )
+        return g_reduced, get_batch_idxs(g_reduced)
+
+    def pop_reduced_graph(self, g_reduced: dgl.DGLHeteroGraph, reduced_graph_stack: list) -> Tuple[dgl.DGLHeteroGraph, Dict[str, torch.Tensor]]:
+        """Transfers the ligands being sampled on g_reduced back onto the graph it replaced. Returns that graph and its batch indicies.
+
+        Any translation applied to g_reduced since it was swapped in (from removing the ligand COM) is applied to the keypoints of the 
+        parent graph so that both graphs share a frame of reference.
+        """
+        g, batch_idxs, reduced_kp_com, _ = reduced_graph_stack.pop()
+        delta = dgl.readout_nodes(g_reduced, feat='x_0', op='mean', ntype='kp') - reduced_kp_com
+        g.nodes['kp'].data['x_0'] = g.nodes['kp'].data['x_0'] + delta[ batch_idxs['kp'] ]
+        for feat in ['x_0', 'h_0']:
+            g.nodes['lig'].data[feat] = g_reduced.nodes['lig'].data[feat]
+        return g, batch_idxs
 
-        lig_pos = []
-        lig_feat = []
-        g = g.to('cpu')
-        for g_i in dgl.unbatch(g):
-            lig_pos.append(g_i.nodes['lig'].data['x_0'])
-            lig_feat.append(g_i.nodes['lig'].data['h_0'])
+    def check_divergence(self, g: dgl.DGLHeteroGraph, batch_idxs: Dict[str, torch.Tensor], max_kp_com_dist: float = 30.0) -> torch.Tensor:
+        """Flags samples whose ligand contains non-finite values or atoms far from the keypoint COM. 
+        
+        Returns a boolean mask of diverged samples, which has shape (batch_size,).
+        """
+        lig_batch_idx = batch_idxs['lig']
+        lig_pos = g.nodes['lig'].data['x_0']
+        lig_feat = g.nodes['lig'].data['h_0']
 
-        return lig_pos, lig_feat
+        # distance of every ligand atom from the keypoint COM of its complex
+        # note that comparisons against nan are always False, so non-finite positions fail the distance check
+        kp_com = dgl.readout_nodes(g, feat='x_0', op='mean', ntype='kp')
+        kp_com_dist = torch.linalg.vector_norm(lig_pos - kp_com[lig_batch_idx], dim=1)
+        atom_ok = (kp_com_dist < max_kp_com_dist) & torch.isfinite(lig_feat).all(dim=1)
+
+        diverged = torch.zeros(g.batch_size, dtype=torch.bool, device=g.device)
+        diverged[lig_batch_idx[~atom_ok]] = True
+        return diverged
+
+    def drop_graphs(self, g: dgl.DGLHeteroGraph, keep_mask: torch.Tensor, reduced_graph_stack: list) -> Tuple[dgl.DGLHeteroGraph, Dict[str, torch.Tensor]]:
+        """Removes the complexes where keep_mask is False from g and from every graph on reduced_graph_stack, which is updated in place. 
+        Returns the reduced batch of g and its batch indicies."""
+        for stack_idx, (g_parent, _, reduced_kp_com, reason) in enumerate(reduced_graph_stack):
+            g_parent, parent_batch_idxs = select_graphs(g_parent, keep_mask)
+            reduced_graph_stack[stack_idx] = (g_parent, parent_batch_idxs, reduced_kp_com[keep_mask], reason)
+        return select_graphs(g, keep_mask)
+
+    def handle_diverged_samples(self, samples: PackedLigands, diverged: torch.Tensor,
+                                g_restart: dgl.DGLHeteroGraph = None, init_lig_pos: torch.Tensor = None, 
+                                max_kp_com_dist: float = 30.0, max_restarts: int = 0, **sampling_kwargs) -> PackedLigands:
+        """Restarts diverged samples if possible, otherwise replaces them with empty tensors."""
+
+        diverged_idxs = torch.where(diverged)[0].tolist()
+        n_diverged = len(diverged_idxs)
+        self.divergence_counts['diverged'] += n_diverged
+
+        if g_restart is not None:
+            print(f'{n_diverged} of {diverged.shape[0]} samples diverged during sampling, restarting them', flush=True)
+            self.divergence_counts['restarted'] += n_diverged
+
+            # re-run the reverse chain on only the diverged samples
+            restart_graphs = dgl.unbatch(g_restart)
+            restart_graphs = dgl.batch([ restart_graphs[idx] for idx in diverged_idxs ])
+            if init_lig_pos is not None:
+                init_lig_pos = init_lig_pos[diverged.to(init_lig_pos.device)]
+
+            restart_samples = self.sample_from_encoded_receptors(restart_graphs, init_lig_pos=init_lig_pos, 
+                divergence_check=True, max_kp_com_dist=max_kp_com_dist, max_restarts=max_restarts-1, 
+                packed=True, pocket_ids=samples.pocket_ids[diverged], request_ids=samples.request_ids[diverged], keep_features=samples.features is not None,
+                **sampling_kwargs)
+
+            # swap the restarted ligands into the place of the diverged ones
+            n_samples = len(samples)
+            order = torch.arange(n_samples)
+            order[diverged] = n_samples + torch.arange(n_diverged)
+            samples = PackedLigands.cat([samples, restart_samples]).index_select(order)
+        else:
+            print(f'{n_diverged} of {diverged.shape[0]} samples diverged during sampling, discarding them', flush=True)
+            self.divergence_counts['failed'] += n_diverged
+
+            # diverged samples are returned as ligands with no atoms
+            samples = samples.clear_ligands(diverged)
+
+        return samples
 
 
     @torch.no_grad()
@@ -489,7 +801,7 @@ class KeypointDiffusion(nn.Module):
 
     @torch.no_grad()
     def sample_random_sizes(self, ref_graphs: List[dgl.DGLHeteroGraph], n_replicates: int = 10, rec_enc_batch_size: int = 32, diff_batch_size: int = 32):
-        n_nodes_rec = torch.tensor([ g.num_nodes('rec') for g in ref_graphs ])
+        n_nodes_rec = torch.tensor([ n_receptor_atoms(g) for g in ref_graphs ])
         n_lig_atoms = self.lig_size_dist.sample(n_nodes_rec, n_replicates)
         samples = self._sample(ref_graphs=ref_graphs, n_lig_atoms=n_lig_atoms, rec_enc_batch_size=rec_enc_batch_size, diff_batch_size=diff_batch_size)
         return samples
@@ -517,85 +829,73 @@ class KeypointDiffusion(nn.Module):
         # expand distribution parameters by batch assignment for every ligand atom
         alpha_t_given_s = alpha_t_given_s[lig_batch_idx].view(-1, 1)
         var_terms = var_terms[lig_batch_idx].view(-1, 1)
-
-        # compute the mean (mu) for positions/features of the distribution p(z_s | z_t)
-        mu_pos = g.nodes['lig'].data['x_0']/alpha_t_given_s - var_terms*eps_x
-        mu_feat = g.nodes['lig'].data['h_0']/alpha_t_given_s - var_terms*eps_h
         
         # Compute sigma for p(zs | zt)
         sigma = sigma_t_given_s * sigma_s / sigma_t
         sigma = sigma[lig_batch_idx].view(-1, 1)
 
-        # sample zs given the mu and sigma we just computed
+        # sample zs from p(z_s | z_t)
         pos_noise = torch.randn(g.nodes['lig'].data['x_0'].shape, device=device)
         feat_noise = torch.randn(g.nodes['lig'].data['h_0'].shape, device=device)
-        g.nodes['lig'].data['x_0'] = mu_pos + sigma*pos_noise
-        g.nodes['lig'].data['h_0'] = mu_feat + sigma*feat_noise
+        g.nodes['lig'].data['x_0'], g.nodes['lig'].data['h_0'] = posterior_update(
+            g.nodes['lig'].data['x_0'], g.nodes['lig'].data['h_0'], eps_x, eps_h, alpha_t_given_s, var_terms, sigma, pos_noise, feat_noise)
 
         # remove ligand COM from system
         g = self.remove_com(g, lig_batch_idx, kp_batch_idx, com='ligand')
 
         return g
 
-    def remove_fake_atoms(self, g: dgl.DGLHeteroGraph, lig_batch_idx):
+    def remove_fake_atoms(self, g: dgl.DGLHeteroGraph, batch_layout: BatchLayout) -> dgl.DGLHeteroGraph:
 
-        batch_size = g.batch_size
+        # the "no atom" type is the last ligand feature. ligand features of graphs from the dataset are element indicies
         lig_feat = g.nodes['lig'].data['h_0']
-        element_idxs = torch.argmax(lig_feat, dim=1)
-        fake_atom_mask = element_idxs == lig_feat.shape[1] - 1
+        element_idxs = lig_feat.long() if lig_feat.dim() == 1 else torch.argmax(lig_feat, dim=1)
+        fake_atom_mask = element_idxs == self.n_lig_features - 1
         nodes_to_remove = torch.where(fake_atom_mask)[0]
 
         # check if there are no fake atoms
         if nodes_to_remove.shape[0] == 0:
             return g
 
-        # find number of nodes that will be removed per batch
-        nodes_removed_per_batch = get_nodes_per_batch(nodes_to_remove, batch_size, lig_batch_idx)
-
-        # get batch idx of every node to be removed, convert to index pointer for segment_csr
-        rm_node_batches = lig_batch_idx[nodes_to_remove]
-        _, batch_segs = torch.unique_consecutive(rm_node_batches, return_counts=True)
-        batch_segs = torch.concatenate([torch.zeros(1, device=g.device),  batch_segs ], dim=0)
-        batch_segs = torch.cumsum(batch_segs)
-
-        # find number of edges that will be removed per batch
+        # count the edges that will be removed per batch. an edge is removed if either of its endpoints is a fake atom,
+        # and it is assigned to a batch by the batch index of its ligand endpoint. bincount is deterministic, unlike scatter.
         edges_removed_per_batch = {}
-        for etype in ['kl', 'lk', 'll']:
-            # for each edge type, count the number of those edges that each of the nodes to be remoevd is participating in
-            # this is the number of edges that will be removed for each of the nodes
-            # if we get the batch of each of the nodes, and then scatter_sum edges_removed_pernode by the batch assignment of every node, we get edges removed per batch
-            # the issue is that scatter is not deterministic, but segment_csr is!
-
-            edges_removed_per_node = torch.zeros_like(nodes_to_remove)
-            # if ligand is dst, count in-degree for this edge type
-            if etype[1] == 'l':
-                edges_removed_per_node  += g.in_degrees(nodes_to_remove, etype=etype)
-            # if ligand is src, count out-degree for this edge type
-            if etype[0] == 'l':
-                edges_removed_per_node += g.out_degrees(nodes_to_remove, etype=etype)
-
-            edges_removed_per_batch[etype] = segment_csr(src=edges_removed_per_node, indptr=batch_segs, reduce='sum')
-
-        batch_num_nodes, batch_num_edges = get_batch_info(g)
+        for canonical_etype in g.canonical_etypes:
+            src_type, _, dst_type = canonical_etype
+            if 'lig' not in (src_type, dst_type):
+                continue
+
+            src_idxs, dst_idxs = g.edges(etype=canonical_etype)
+            lig_idxs = dst_idxs if dst_type == 'lig' else src_idxs
+            edge_mask = fake_atom_mask[lig_idxs]
+            if src_type == 'lig' and dst_type == 'lig':
+                edge_mask = edge_mask | fake_atom_mask[src_idxs]
+            edges_removed_per_batch[canonical_etype] = batch_layout.count('lig', lig_idxs[edge_mask])
 
         # update batch information corresponding to node removal
-        batch_num_nodes['lig'] = batch_num_nodes['lig'] - nodes_removed_per_batch
+        num_edges = { etype: batch_layout.num_edges[etype] - n_removed for etype, n_removed in edges_removed_per_batch.items() }
+        new_layout = batch_layout.with_num_nodes(
+            {'lig': batch_layout.num_nodes['lig'] - batch_layout.count('lig', nodes_to_remove)},
+            batch_idxs={'lig': batch_layout['lig'][~fake_atom_mask]}).with_num_edges(num_edges)
 
-        for canonical_etype in batch_num_edges:
-            etype = canonical_etype[1]
-            if etype in edges_removed_per_batch:
-                batch_num_edges[canonical_etype] = batch_num_edges[canonical_etype] - edges_removed_per_batch[etype]
-        
-
-        # remove nodes
+        # remove nodes and add batch information back into the graph
         g.remove_nodes(nodes_to_remove, ntype='lig')
-
-        # add batch information back into the graph
-        g.set_batch_num_nodes(batch_num_nodes)
-        g.set_batch_num_edges(batch_num_edges)
+        g = new_layout.apply(g)
 
         return g
 
+def posterior_update(lig_pos: torch.Tensor, lig_feat: torch.Tensor, eps_x: torch.Tensor, eps_h: torch.Tensor, 
+                     alpha_t_given_s: torch.Tensor, var_terms: torch.Tensor, sigma: torch.Tensor, 
+                     pos_noise: torch.Tensor, feat_noise: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Samples ligand positions and features from p(z_s | z_t). Distribution parameters are given per ligand atom, with shape (n_atoms, 1)."""
+
+    # compute the mean (mu) for positions/features of the distribution p(z_s | z_t)
+    mu_pos = lig_pos/alpha_t_given_s - var_terms*eps_x
+    mu_feat = lig_feat/alpha_t_given_s - var_terms*eps_h
+
+    # sample zs given the mu and sigma we just computed
+    return mu_pos + sigma*pos_noise, mu_feat + sigma*feat_noise
+
 # noise schedules are taken from DiffSBDD: https://github.com/arneschneuing/DiffSBDD
 def cosine_beta_schedule(timesteps, s=0.008, raise_to_power: float = 1):
     """
@@ -0,0 +1,102 @@
+import copy
+from pathlib import Path
+from typing import Callable, Dict, List, Set
+
+import torch
+import torch.nn as nn
+import yaml
+from torch.ao.quantization import quantize_dynamic
+
+from models.dynamics import LigRecConv
+
+# name of the file, saved within a model directory, which records the layers selected by calibration
+QUANTIZATION_FILE = 'quantization.yml'
+
+def get_coordinate_heads(dynamics: nn.Module) -> Set[str]:
+    """Returns the names of linear layers whose outputs directly scale coordinate updates.
+
+    These layers are always kept in float32 so that coordinate updates remain precise. In the GVP dynamics model,
+    coordinate updates are produced by vector channel weights (GVP.Wh, GVP.Wu) which are not linear layers, so they are never quantized.
+    """
+    coord_heads = set()
+    for name, module in dynamics.named_modules():
+        if isinstance(module, LigRecConv):
+            for etype, coord_mlp in module.coord_mlp.items():
+                coord_heads.add(f'{name}.coord_mlp.{etype}.{len(coord_mlp)-1}')
+    return coord_heads
+
+def get_quantizable_layers(dynamics: nn.Module) -> List[str]:
+    """Returns the names of all float linear layers in the dynamics model that may be quantized."""
+    coord_heads = get_coordinate_heads(dynamics)
+    return [ name for name, module in dynamics.named_modules() if type(module) is nn.Linear and name not in coord_heads ]
+
+@torch.no_grad()
+def calibrate_quantization(dynamics: nn.Module, run_calibration: Callable[[], None], layer_names: List[str] = None, max_rows: int = 4096) -> Dict[str, float]:
+    """Measures the error introduced by int8 quantization of each linear layer in the dynamics model.
+
+    run_calibration is called once with hooks that record the inputs of every layer in layer_names. Each layer is then
+    quantized in isolation and applied to its recorded inputs. Returns the relative error, ||y_int8 - y_fp32|| / ||y_fp32||, of every layer.
+    """
+    if layer_names is None:
+        layer_names = get_quantizable_layers(dynamics)
+
+    modules = dict(dynamics.named_modules())
+
+    # record a random subset of the inputs to every layer
+    recorded_inputs = { name: [] for name in layer_names }
+    def record_input(module, args, output, name):
+        layer_input = args[0].reshape(-1, args[0].shape[-1])
+        row_idxs = torch.randperm(layer_input.shape[0], device=layer_input.device)[:max_rows]
+        recorded_inputs[name].append(layer_input[row_idxs].float().cpu())
+
+    hooks = [ modules[name].register_forward_hook(lambda m, a, o, name=name: record_input(m, a, o, name)) for name in layer_names ]
+    try:
+        run_calibration()
+    finally:
+        for hook in hooks:
+            hook.remove()
+
+    layer_errors = {}
+    for name in layer_names:
+
+        # layers that were never called during calibration (e.g. edge types that are never present) are not measured
+        if len(recorded_inputs[name]) == 0:
+            continue
+
+        layer_input = torch.cat(recorded_inputs[name], dim=0)
+        layer_input = layer_input[torch.randperm(layer_input.shape[0])[:max_rows]]
+
+        # quantize a cpu copy of the layer. quantize_dynamic only replaces child modules so the layer is wrapped in a container
+        fp32_layer = nn.Sequential(copy.deepcopy(modules[name]).cpu())
+        int8_layer = quantize_dynamic(copy.deepcopy(fp32_layer), qconfig_spec={nn.Linear}, dtype=torch.qint8)
+
+        fp32_output = fp32_layer(layer_input)
+        int8_output = int8_layer(layer_input)
+        layer_errors[name] = float(torch.norm(int8_output - fp32_output) / torch.norm(fp32_output).clamp(min=1e-12))
+
+    return layer_errors
+
+def quantize_dynamics(model: nn.Module, layer_names: List[str] = None) -> nn.Module:
+    """Replaces linear layers of the dynamics model of a KeypointDiffusion model with dynamically quantized int8 layers.
+
+    Weights are quantized ahead of time and activations are quantized on the fly, so the quantized layers only run on CPU.
+    If layer_names is None, every quantizable layer is quantized. The model is modified in place.
+    """
+    if next(model.parameters()).device.type != 'cpu':
+        raise ValueError('quantized models can only be run on CPU')
+
+    if layer_names is None:
+        layer_names = get_quantizable_layers(model.dynamics)
+
+    quantize_dynamic(model.dynamics, qconfig_spec=set(layer_names), dtype=torch.qint8, inplace=True)
+    return model
+
+def load_quantized_layers(model_dir: Path) -> List[str]:
+    """Returns the layers selected by quantize_model.py for the model in model_dir, or None if the model has not been calibrated."""
+    quantization_file = Path(model_dir) / QUANTIZATION_FILE
+    if not quantization_file.exists():
+        return None
+
+    with open(quantization_file, 'r') as f:
+        quantization_config = yaml.load(f, Loader=yaml.FullLoader)
+    return quantization_config['quantized_layers']
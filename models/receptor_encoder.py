@@ -1,4 +1,4 @@
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 import dgl
 import dgl.function as fn
@@ -7,9 +7,17 @@ import torch.nn as nn
 from dgl.nn.functional import edge_softmax
 from einops import rearrange
 from torch_cluster import radius_graph, radius, knn
-from torch_scatter import segment_csr
+from torch_scatter import segment_coo
 
-from utils import get_batch_info, get_edges_per_batch
+from utils import BatchLayout, get_batch_info, to_dense_batch
+
+def compute_rr_geometry(g: dgl.DGLHeteroGraph, coord_feat: torch.Tensor):
+    """Computes the normalized coordinate difference and the radial feature of every rec-rec edge."""
+    src_idxs, dst_idxs = g.edges(etype='rr')
+    x_diff = coord_feat[src_idxs] - coord_feat[dst_idxs]
+    radial = torch.norm(x_diff, dim=1).unsqueeze(-1)
+    x_diff = x_diff / (radial + 1)
+    return x_diff, radial
 
 class ReceptorConv(nn.Module):
     # this is adapted from the EGNN implementation in DGL
@@ -95,7 +103,7 @@ class ReceptorConv(nn.Module):
 
         return {"msg_x": msg_x, "msg_h": msg_h}
 
-    def forward(self, g: dgl.DGLHeteroGraph, node_feat: torch.Tensor, coord_feat: torch.Tensor, z: torch.Tensor, edge_feat: torch.Tensor=None):
+    def forward(self, g: dgl.DGLHeteroGraph, node_feat: torch.Tensor, coord_feat: torch.Tensor, z: torch.Tensor, edge_feat: torch.Tensor=None, edge_geometry=None):
         r"""
         Description
         -----------
@@ -114,6 +122,9 @@ class ReceptorConv(nn.Module):
         edge_feat : torch.Tensor, optional
             The edge feature of shape :math:`(M, h_e)`. :math:`M` is the number of
             edges, and :math:`h_e` must be the same as edge_feat_size.
+        edge_geometry : Tuple[torch.Tensor, torch.Tensor], optional
+            The output of compute_rr_geometry for coord_feat. If not provided, it is 
+            computed from coord_feat.
 
         Returns
         -------
@@ -133,13 +144,10 @@ class ReceptorConv(nn.Module):
             if self.edge_feat_size > 0:
                 assert edge_feat is not None, "Edge features must be provided."
                 g.edges['rr'].data["a"] = edge_feat
-            # get coordinate diff & radial features
-            g.apply_edges(fn.u_sub_v("x", "x", "x_diff"), etype='rr')
-            g.edges['rr'].data["radial"] = torch.norm(g.edges['rr'].data["x_diff"], dim=1).unsqueeze(-1)
-            # normalize coordinate difference
-            g.edges['rr'].data["x_diff"] = g.edges['rr'].data["x_diff"] / (
-                g.edges['rr'].data["radial"] + 1
-            )
+            # get normalized coordinate diff & radial features
+            if edge_geometry is None:
+                edge_geometry = compute_rr_geometry(g, coord_feat)
+            g.edges['rr'].data["x_diff"], g.edges['rr'].data["radial"] = edge_geometry
             g.apply_edges(self.message, etype='rr')
             g.update_all(fn.copy_e("msg_x", "m"), fn.sum("m", "x_neigh"), etype='rr')
             g.update_all(fn.copy_e("msg_h", "m"), fn.sum("m", "h_neigh"), etype='rr')
@@ -179,7 +187,11 @@ class RecKeyConv(nn.Module):
         else:
             self.layer_norm = nn.Identity()
 
-    def forward(self, g: dgl.DGLHeteroGraph, kp_batch_idx):
+    def forward(self, g: dgl.DGLHeteroGraph, batch_idxs: BatchLayout):
+
+        kp_batch_idx = batch_idxs['kp']
+        rec_batch_idx = batch_idxs['rec']
+        batch_size = g.batch_size
 
         with g.local_scope():
 
@@ -190,42 +202,35 @@ class RecKeyConv(nn.Module):
             ft_src = self.fc_src(h_src).view(-1, self.num_heads, self.out_feats) 
             ft_dst = self.fc_src(h_dst).view(-1, self.num_heads, self.out_feats)
 
-            # Assign features to nodes
-            g.srcdata['ft'] = {'rec': ft_src}
-            g.dstdata['ft'] = {'kp': ft_dst}
+            # arrange receptor atoms and keypoints of every graph into padded batches
+            ft_src, rec_mask = to_dense_batch(ft_src, rec_batch_idx, batch_size) # (batch_size, max_n_rec, num_heads, out_feats)
+            ft_dst, kp_mask = to_dense_batch(ft_dst, kp_batch_idx, batch_size) # (batch_size, n_keypoints, num_heads, out_feats)
 
-            # Step 1. dot product
-            g.apply_edges(fn.u_dot_v('ft', 'ft', 'a'), etype='rk')
+            # Step 1. dot product between every keypoint and every receptor atom in the same graph
+            a = torch.einsum('bkhd,bnhd->bhkn', ft_dst, ft_src) / self.out_feats**0.5
 
-            # Step 2. edge softmax to compute attention scores
-            a = g.edges['rk'].data['a'] / self.out_feats**0.5
-            a = torch.exp(a)
-
-            edges_per_kp = g.batch_num_nodes('rec')[kp_batch_idx] # (n_keypoints*batch_size) -> number of edges going to every keypoint
-            indptr = torch.zeros(edges_per_kp.shape[0]+1, dtype=int, device=g.device) # index pointer used for segmented sum
-            indptr[1:] = edges_per_kp
-            indptr = torch.cumsum(indptr, 0)
-            dst_node_denominators = segment_csr(src=a, indptr=indptr) # (n_kp_nodes, num_heads, 1), sum of incoming weights for each node
-            g.dstdata['denom'] = {'kp': 1/dst_node_denominators}
-            g.apply_edges(fn.v_mul_e('denom', 'a', 'sa'), etype='rk')
-
-            # Step 3. Broadcast softmax value to each edge, and aggregate dst node
+            # Step 2. softmax over receptor atoms to compute attention scores, padding atoms get no attention
+            a = a.masked_fill(~rec_mask[:, None, None, :], float('-inf'))
+            a = torch.softmax(a, dim=-1)
+
+            # Step 3. keypoint positions are the attention-weighted average of receptor positions, averaged over heads
             if self.fix_pos:
                 val_str = 'x_0'
             else:
                 val_str = 'x'
-            g.update_all(fn.u_mul_e(val_str, 'sa', 'attn'), fn.sum('attn', 'agg_u'), etype='rk')
+            rec_pos, _ = to_dense_batch(g.nodes['rec'].data[val_str], rec_batch_idx, batch_size) # (batch_size, max_n_rec, 3)
+            kp_pos = torch.einsum('bhkn,bnc->bkc', a, rec_pos) / self.num_heads
 
             # get keypoint positions
-            kp_pos = g.dstdata['agg_u']['kp'].mean(dim=1)
+            kp_pos = kp_pos[kp_mask]
             g.nodes['kp'].data['x_0'] = kp_pos
 
 
             # get keypoint features
             if self.k_closest != 0:
-                kp_feat = self.k_closest_feats(g)
+                kp_feat = self.k_closest_feats(g, batch_idxs)
             elif self.kp_rad != 0:
-                kp_feat = self.kp_rad_feats(g, kp_batch_idx=kp_batch_idx)
+                kp_feat = self.kp_rad_feats(g, batch_idxs)
             else:
                 raise NotImplementedError
 
@@ -235,70 +240,41 @@ class RecKeyConv(nn.Module):
 
         return kp_pos, kp_feat
     
-    def kp_rad_feats(self, g: dgl.DGLHeteroGraph, kp_batch_idx: torch.Tensor):
-
-        # we are going to remove and then add edges which destroy batch information. we have to record batch info before mutating
-        # graph topology and add it back afterwards
-        batch_num_nodes, batch_num_edges = get_batch_info(g)
+    def kp_rad_feats(self, g: dgl.DGLHeteroGraph, batch_idxs: BatchLayout):
 
         kp_pos = g.nodes['kp'].data['x_0']
-        batch_idxs = torch.arange(g.batch_size, device=g.device)
-        rec_atom_batch = batch_idxs.repeat_interleave(g.batch_num_nodes('rec'))
-        rad_idxs = radius(x=g.nodes['rec'].data['x_0'], y=kp_pos, batch_x=rec_atom_batch, batch_y=kp_batch_idx, r=self.kp_rad, max_num_neighbors=100) # shape (2, n_keypoints*?*batch_size)
-
-        # get number of edges corresponding to each batch
-        batch_num_edges[('rec', 'rk', 'kp')] = get_edges_per_batch(rad_idxs[0], g.batch_size, kp_batch_idx)
-
-        g.remove_edges(g.edges(form='eid', etype='rk'), etype='rk') # remove all receptor-keypoint edges
-        g.add_edges(rad_idxs[1], rad_idxs[0], etype='rk') # add back the edges identified by radius
+        kp_batch_idx = batch_idxs['kp']
+        rad_idxs = radius(x=g.nodes['rec'].data['x_0'], y=kp_pos, batch_x=batch_idxs['rec'], batch_y=kp_batch_idx, r=self.kp_rad, max_num_neighbors=100) # shape (2, n_keypoints*?*batch_size)
 
-        # reset batch info
-        g.set_batch_num_nodes(batch_num_nodes)
-        g.set_batch_num_edges(batch_num_edges)
+        # get number of receptor atoms within kp_rad of keypoints in each batch
+        edges_per_batch = batch_idxs.count('kp', rad_idxs[0])
 
-        # accumulate features from receptors in each keypoint's neighborhood
-        g.update_all(fn.copy_u('h', 'm'), fn.sum('m', 'h_m'), etype='rk')
-        z = g.batch_num_edges('rk') / g.batch_num_nodes('kp')
+        # accumulate features from receptors in each keypoint's neighborhood. radius returns pairs sorted by keypoint index
+        kp_feats = segment_coo(g.nodes['rec'].data['h'][rad_idxs[1]], rad_idxs[0], dim_size=kp_pos.shape[0], reduce='sum')
+        z = edges_per_batch / batch_idxs.num_nodes['kp']
         z = z[kp_batch_idx].view(-1, 1) + 1 
-        kp_feats = g.nodes['kp'].data['h_m']/z
+        kp_feats = kp_feats/z
         return kp_feats
 
-    def k_closest_feats(self, g: dgl.DGLHeteroGraph):
-        # get k edges having the lowest distance to each keypoint
+    def k_closest_feats(self, g: dgl.DGLHeteroGraph, batch_idxs: BatchLayout):
+        # get the k receptor atoms having the lowest distance to each keypoint
         kp_pos = g.nodes['kp'].data['x_0']
+        rec_pos = g.nodes['rec'].data['x_0']
+        knn_idxs = knn(x=rec_pos, y=kp_pos, batch_x=batch_idxs['rec'], batch_y=batch_idxs['kp'], k=self.k_closest) # shape (2, n_keypoints*k*batch_size)
 
-        batch_idxs = torch.arange(g.batch_size, device=g.device)
-        rec_atom_batch = batch_idxs.repeat_interleave(g.batch_num_nodes('rec'))
-        kp_batch = batch_idxs.repeat_interleave(g.batch_num_nodes('kp'))
-        knn_idxs = knn(x=g.nodes['rec'].data['x_0'], y=kp_pos, batch_x=rec_atom_batch, batch_y=kp_batch, k=self.k_closest) # shape (2, n_keypoints*k*batch_size)
+        # knn returns exactly k neighbors for every keypoint, grouped by keypoint and ordered by distance
+        knn_rec_idxs = knn_idxs[1].view(-1, self.k_closest) # (n_keypoints*batch_size, k)
 
+        # get mean rec feature on every keypoint
+        h_m = g.nodes['rec'].data['h'][knn_rec_idxs].mean(dim=1)
 
-        # we are going to remove and then add edges which destroy batch information. we have to record batch info before mutating
-        # graph topology and add it back afterwards
-        batch_num_nodes, batch_num_edges = get_batch_info(g)
-
-        # we have to change the number of rk edges per batch because we will be altering that
-        batch_num_edges[('rec', 'rk', 'kp')] = torch.ones(g.batch_size, device=g.device, dtype=int)*self.n_keypoints*self.k_closest
-
-        g.remove_edges(g.edges(form='eid', etype='rk'), etype='rk') # remove all receptor-keypoint edges
-        g.add_edges(knn_idxs[1], knn_idxs[0], etype='rk') # add back the edges identified by knn
-
-        # reset batch info
-        g.set_batch_num_nodes(batch_num_nodes)
-        g.set_batch_num_edges(batch_num_edges)
+        # get distance from every keypoint to its k closest receptor atoms
+        x_diff = rec_pos[knn_rec_idxs] - kp_pos.unsqueeze(1)
+        d_k = torch.norm(x_diff+1e-30, dim=-1) # (n_keypoints*batch_size, k)
 
-        # get mean rec feature on every keypoint
-        g.update_all(fn.copy_u('h', 'm'), fn.mean('m', 'h_m'), etype='rk')
-        g.apply_edges(fn.u_sub_v('x_0', 'x_0', 'x_diff'), etype='rk')
-        g.edges['rk'].data['d'] = torch.norm(g.edges['rk'].data['x_diff']+1e-30, dim=1)
-        g.update_all(fn.copy_e('d', 'd'), self.collect_dists, etype='rk')
-        
-        kp_feat = torch.concatenate([g.nodes['kp'].data['h_m'], g.nodes['kp'].data['d_k']], dim=1)
+        kp_feat = torch.concatenate([h_m, d_k], dim=1)
         return kp_feat
 
-    def collect_dists(self, nodes):
-        return {'d_k': nodes.mailbox['d']}
-
     
 class KeyKeyConv(nn.Module):
 
@@ -480,11 +456,11 @@ class ReceptorEncoder(nn.Module):
             self.kk_convs = nn.ModuleList(kk_convs)
 
 
-    def forward(self, g: dgl.DGLGraph, batch_idxs: Dict[str, torch.Tensor]):
+    def forward(self, g: dgl.DGLGraph, batch_idxs: BatchLayout) -> Tuple[dgl.DGLHeteroGraph, BatchLayout]:
+        # returns the encoded graph and its updated batch layout
 
         x = g.nodes['rec'].data['x_0']
         h = g.nodes['rec'].data['h_0']
-        batch_size = g.batch_size
         
 
         if self.use_sameres_feat:
@@ -500,14 +476,20 @@ class ReceptorEncoder(nn.Module):
 
         # compute normalization factor, z, for receptor-receptor message passing
         if self.message_norm == 0:
-            z_rr = g.batch_num_edges(etype='rr') / g.batch_num_nodes('rec')
+            z_rr = batch_idxs.num_edges[('rec', 'rr', 'rec')] / batch_idxs.num_nodes['rec']
             z_rr = z_rr[rec_batch_idx].view(-1, 1)
         else:
             z_rr = self.message_norm
 
+        # when receptor positions are fixed, edge geometry is the same for every layer so we only compute it once
+        if self.fix_pos:
+            rr_geometry = compute_rr_geometry(g, x)
+        else:
+            rr_geometry = None
+
         # do equivariant message passing over nodes
         for conv_layer in self.rec_convs:
-            h, x = conv_layer(g, node_feat=h, coord_feat=x, edge_feat=rec_edge_feat, z=z_rr)
+            h, x = conv_layer(g, node_feat=h, coord_feat=x, edge_feat=rec_edge_feat, z=z_rr, edge_geometry=rr_geometry)
 
         # record learned positions and features
         # TODO: is this necessary??
@@ -527,24 +509,19 @@ class ReceptorEncoder(nn.Module):
         g.nodes['kp'].data['h_0'] = rearrange(init_kp_features, 'b (k d) -> (b k) d', d=self.out_n_node_feat, k=self.n_keypoints)
 
         # apply rec->kp graph attention convolution
-        kp_pos, kp_feat = self.rec_kp_conv(g, kp_batch_idx)
+        kp_pos, kp_feat = self.rec_kp_conv(g, batch_idxs)
 
         # assign keypoint positions and features
         g.nodes['kp'].data['h_0'] = kp_feat
         g.nodes['kp'].data['x_0'] = kp_pos
 
-        # get batch info 
-        batch_num_nodes, batch_num_edges = get_batch_info(g)
-
         # add keypoint-keypoint edges
         kk_edges = radius_graph(x=kp_pos, r=self.graph_cutoffs['kk'], batch=kp_batch_idx, max_num_neighbors=100)
         g.add_edges(kk_edges[0], kk_edges[1], etype='kk')
 
-        # get number of keypoint-keypoint edges in each batch
-        batch_num_edges[('kp', 'kk', 'kp')] = get_edges_per_batch(kk_edges[0], batch_size, kp_batch_idx)
-
-        g.set_batch_num_nodes(batch_num_nodes)
-        g.set_batch_num_edges(batch_num_edges)
+        # record the number of keypoint-keypoint edges in each batch
+        batch_idxs = batch_idxs.with_num_edges({ ('kp', 'kk', 'kp'): batch_idxs.count('kp', kk_edges[0]) })
+        batch_idxs.apply(g)
         
         # do keypoint-keypoint convolutions if specified
         if self.n_kk_convs > 0:
@@ -552,7 +529,7 @@ class ReceptorEncoder(nn.Module):
                 kp_feat = conv(g)
                 g.nodes['kp'].data['h_0'] = kp_feat
 
-        return g
+        return g, batch_idxs
 
 
 
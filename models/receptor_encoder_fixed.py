@@ -2,9 +2,9 @@ import torch
 import torch.nn as nn
 import dgl
 import dgl.function as fn
-from typing import Dict
+from typing import Tuple
 
-from utils import get_batch_info
+from utils import BatchLayout
 
 class FixedReceptorEncoder(nn.Module):
 
@@ -12,16 +12,18 @@ class FixedReceptorEncoder(nn.Module):
         super().__init__()
         self.n_vec_feats = n_vec_feats
 
-    def forward(self, g: dgl.DGLHeteroGraph, batch_idxs: Dict[str, torch.Tensor]):
-
-        # we don't use the argument batch_idxs, but it is included for compatibility with
-        # the other receptor encoder classes
+    def forward(self, g: dgl.DGLHeteroGraph, batch_idxs: BatchLayout) -> Tuple[dgl.DGLHeteroGraph, BatchLayout]:
+        # returns the encoded graph and its updated batch layout
         
         device = g.device
         batch_size = g.batch_size
 
-        # get initial batch information
-        batch_num_nodes, batch_num_edges = get_batch_info(g)
+        # if the dataset already stored the receptor atoms as keypoints (fixed_keypoints=True), 
+        # the keypoint graph is ready and we only need to add vector features
+        if 'x_0' in g.nodes['kp'].data:
+            if self.n_vec_feats is not None:
+                g.nodes['kp'].data['v_0'] = torch.zeros((g.num_nodes('kp'), self.n_vec_feats, 3), device=device)
+            return g, batch_idxs
 
         # remove keypoint nodes
         g.remove_nodes(g.nodes('kp'), ntype='kp')
@@ -44,25 +46,23 @@ class FixedReceptorEncoder(nn.Module):
         )
 
 
-        # fix batch data for keypoints
-        batch_num_nodes['kp'] = batch_num_nodes['rec']
-        batch_num_edges[('kp', 'kk', 'kp')] = batch_num_edges[('rec', 'rr', 'rec')]
-
-        # fix batch data for rec nodes
-        batch_num_nodes['rec'] = torch.zeros_like(batch_num_nodes['rec'])
-        for etype in batch_num_edges:
-            if 'rec' in etype:
-                batch_num_edges[etype] = torch.zeros_like(batch_num_edges[etype])
+        # keypoints take the place of receptor atoms, and kp-kp edges take the place of rec-rec edges
+        rec_etypes = [ etype for etype in batch_idxs.num_edges if 'rec' in etype ]
+        num_edges = { etype: torch.zeros_like(batch_idxs.num_edges[etype]) for etype in rec_etypes }
+        num_edges[('kp', 'kk', 'kp')] = batch_idxs.num_edges[('rec', 'rr', 'rec')]
+        batch_idxs = batch_idxs.with_num_nodes(
+            { 'kp': batch_idxs.num_nodes['rec'], 'rec': torch.zeros_like(batch_idxs.num_nodes['rec']) }, 
+            batch_idxs={ 'kp': batch_idxs['rec'] }
+        ).with_num_edges(num_edges)
 
         # remove rec nodes
         g.remove_nodes(g.nodes('rec'), ntype='rec')
 
         # add batch information to graph
-        g.set_batch_num_nodes(batch_num_nodes)
-        g.set_batch_num_edges(batch_num_edges)
+        batch_idxs.apply(g)
 
         assert batch_size == g.batch_size # check that batch information was preserved
 
-        return g
+        return g, batch_idxs
 
 
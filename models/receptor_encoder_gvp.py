@@ -1,20 +1,18 @@
-from typing import Dict, Union
+from typing import Tuple, Union
 
 import dgl
-import dgl.function as fn
 import torch
 import torch.nn as nn
 from einops import rearrange
 from torch_cluster import knn, radius, radius_graph
-from torch_scatter import segment_csr
 
-from utils import get_batch_info, get_edges_per_batch
+from utils import BatchLayout, to_dense_batch
 
-from .gvp import GVPEdgeConv
+from .gvp import GVPEdgeConv, compute_edge_geometry
 
 class KeypointInitializer(nn.Module):
 
-    """Assigns initial positions and features to keypoint nodes. Also draws receptor -> keypoint edges."""
+    """Assigns initial positions and features to keypoint nodes."""
 
     def __init__(self, n_keypoints: int, scalar_size: int, vector_size: int):
         super().__init__()
@@ -37,7 +35,7 @@ class KeypointInitializer(nn.Module):
         self.norm = nn.LayerNorm(scalar_size)
 
 
-    def forward(self, g: dgl.DGLHeteroGraph, rec_scalar_feats: torch.Tensor, batch_idxs: Dict[str, torch.Tensor]):
+    def forward(self, g: dgl.DGLHeteroGraph, rec_scalar_feats: torch.Tensor, batch_idxs: BatchLayout):
 
         # get the device and batch size from the graph, g
         device = g.device
@@ -61,30 +59,23 @@ class KeypointInitializer(nn.Module):
             ft_src = self.src_net(rec_scalar_feats).view(-1, self.num_heads, self.scalar_size) 
             ft_dst = self.dst_net(keypoint_scalars).view(-1, self.num_heads, self.scalar_size)
 
-            # Assign features to nodes
-            g.srcdata['ft'] = {'rec': ft_src}
-            g.dstdata['ft'] = {'kp': ft_dst}
+            # arrange receptor atoms and keypoints of every graph into padded batches
+            ft_src, rec_mask = to_dense_batch(ft_src, batch_idxs['rec'], batch_size) # (batch_size, max_n_rec, num_heads, scalar_size)
+            ft_dst, kp_mask = to_dense_batch(ft_dst, batch_idxs['kp'], batch_size) # (batch_size, n_keypoints, num_heads, scalar_size)
 
-            # Step 1. dot product
-            g.apply_edges(fn.u_dot_v('ft', 'ft', 'a'), etype='rk')
+            # Step 1. dot product between every keypoint and every receptor atom in the same graph
+            a = torch.einsum('bkhd,bnhd->bhkn', ft_dst, ft_src) / self.scalar_size**0.5
 
-            # Step 2. edge softmax to compute attention scores
-            a = g.edges['rk'].data['a'] / self.scalar_size**0.5
-            a = torch.exp(a)
+            # Step 2. softmax over receptor atoms to compute attention scores, padding atoms get no attention
+            a = a.masked_fill(~rec_mask[:, None, None, :], float('-inf'))
+            a = torch.softmax(a, dim=-1)
 
-            edges_per_kp = g.batch_num_nodes('rec')[batch_idxs['kp']] # (n_keypoints*batch_size) -> number of edges going to every keypoint
-            indptr = torch.zeros(edges_per_kp.shape[0]+1, dtype=int, device=g.device) # index pointer used for segmented sum
-            indptr[1:] = edges_per_kp
-            indptr = torch.cumsum(indptr, 0)
-            dst_node_denominators = segment_csr(src=a, indptr=indptr) # (n_kp_nodes, num_heads, 1), sum of incoming weights for each node
-            g.dstdata['denom'] = {'kp': 1/dst_node_denominators}
-            g.apply_edges(fn.v_mul_e('denom', 'a', 'sa'), etype='rk')
-
-            # Step 3. Broadcast softmax value to each edge, and aggregate dst node
-            g.update_all(fn.u_mul_e('x_0', 'sa', 'attn'), fn.sum('attn', 'agg_u'), etype='rk')
+            # Step 3. keypoint positions are the attention-weighted average of receptor positions, averaged over heads
+            rec_pos, _ = to_dense_batch(g.nodes['rec'].data['x_0'], batch_idxs['rec'], batch_size) # (batch_size, max_n_rec, 3)
+            kp_pos = torch.einsum('bhkn,bnc->bkc', a, rec_pos) / self.num_heads
 
             # get keypoint positions
-            kp_pos = g.dstdata['agg_u']['kp'].mean(dim=1)
+            kp_pos = kp_pos[kp_mask]
 
         # for now intialize keypoint scalar and vector features to zero
         kp_scalars = torch.zeros(g.num_nodes('kp'), self.scalar_size, device=device, dtype=torch.float32)
@@ -209,10 +200,10 @@ class ReceptorEncoderGVP(nn.Module):
                 rbf_dmax=graph_cutoffs['rk']
             ))
 
-    def forward(self, g: dgl.DGLHeteroGraph, batch_idxs: Dict[str, torch.Tensor]):
+    def forward(self, g: dgl.DGLHeteroGraph, batch_idxs: BatchLayout) -> Tuple[dgl.DGLHeteroGraph, BatchLayout]:
+        # returns the encoded graph and its updated batch layout
 
         device = g.device
-        batch_size = g.batch_size
 
         # get scalar features
         rec_scalar_feat = g.nodes['rec'].data["h_0"]
@@ -242,16 +233,21 @@ class ReceptorEncoderGVP(nn.Module):
             z = 1
         elif self.message_norm == 0:
             # if messsage_norm is 0, we normalize by the average in-degree of the graph
-            z = g.batch_num_edges(etype='rr') / g.batch_num_nodes('rec')
+            z = batch_idxs.num_edges[('rec', 'rr', 'rec')] / batch_idxs.num_nodes['rec']
             z = z[rec_batch_idx].view(-1, 1)
         else:
             # otherwise, message_norm is a non-zero constant which we use as the normalization factor
             z = self.message_norm
 
+        # receptor positions are not updated by the convolutions, so rec-rec edge geometry is computed once and shared across layers
+        if self.n_rr_convs > 0:
+            rr_conv = self.rr_conv_layers[0]
+            rr_geometry = compute_edge_geometry(g, rr_conv.edge_type, rec_coord_feat, rec_coord_feat, rbf_dmax=rr_conv.rbf_dmax, rbf_dim=rr_conv.rbf_dim)
+
         # apply receptor-receptor convolutions
         for i in range(self.n_rr_convs):
             src_feats = (rec_scalar_feat, rec_coord_feat, rec_vec_feat)
-            rec_scalar_feat, rec_vec_feat = self.rr_conv_layers[i](g, src_feats=src_feats, edge_feats=edge_feat, z=z)
+            rec_scalar_feat, rec_vec_feat = self.rr_conv_layers[i](g, src_feats=src_feats, edge_feats=edge_feat, z=z, edge_geometry=rr_geometry)
 
         # get initial keypoint positions
         kp_pos, kp_scalars, kp_vecs = self.keypoint_initializer(g, rec_scalar_feat, batch_idxs)
@@ -260,41 +256,41 @@ class ReceptorEncoderGVP(nn.Module):
         g.nodes['kp'].data['x_0'] = kp_pos
 
         # update receptor-keypoint edges
-        g = self.update_rk_edges(g, batch_idxs)
+        g, batch_idxs = self.update_rk_edges(g, batch_idxs)
 
         # compute the normalization factor for the messages if necessary
         if self.message_norm == 0:
             # if messsage_norm is 0, we normalize by the average in-degree of the graph
-            z = g.batch_num_edges(etype='rk') / g.batch_num_nodes('kp')
+            z = batch_idxs.num_edges[('rec', 'rk', 'kp')] / batch_idxs.num_nodes['kp']
             z = z[batch_idxs['kp']].view(-1, 1)
 
+        # compute rec-kp edge geometry once for all rec-kp convolutions
+        if self.n_rk_convs > 0:
+            rk_conv = self.rk_conv_layers[0]
+            rk_geometry = compute_edge_geometry(g, rk_conv.edge_type, rec_coord_feat, kp_pos, rbf_dmax=rk_conv.rbf_dmax, rbf_dim=rk_conv.rbf_dim)
+
         # update scalar and vector features of the keypoint nodes
         for i in range(self.n_rk_convs):
             src_feats = (rec_scalar_feat, rec_coord_feat, rec_vec_feat)
             dst_feats = (kp_scalars, kp_pos, kp_vecs)
-            kp_scalars, kp_vecs = self.rk_conv_layers[i](g, src_feats=src_feats, dst_feats=dst_feats, z=z)
+            kp_scalars, kp_vecs = self.rk_conv_layers[i](g, src_feats=src_feats, dst_feats=dst_feats, z=z, edge_geometry=rk_geometry)
 
         # set keypoint scalars and vectors in the graph
         g.nodes['kp'].data['h_0'] = kp_scalars
         g.nodes['kp'].data['v_0'] = kp_vecs
 
-        # get batch info 
-        batch_num_nodes, batch_num_edges = get_batch_info(g)
-
         # add keypoint-keypoint edges
         kk_edges = radius_graph(x=kp_pos, r=self.graph_cutoffs['kk'], batch=batch_idxs['kp'], max_num_neighbors=100)
         g.add_edges(kk_edges[0], kk_edges[1], etype='kk')
 
-        # get number of keypoint-keypoint edges in each batch
-        batch_num_edges[('kp', 'kk', 'kp')] = get_edges_per_batch(kk_edges[0], batch_size, batch_idxs['kp'])
-
-        g.set_batch_num_nodes(batch_num_nodes)
-        g.set_batch_num_edges(batch_num_edges)
+        # record the number of keypoint-keypoint edges in each batch
+        batch_idxs = batch_idxs.with_num_edges({ ('kp', 'kk', 'kp'): batch_idxs.count('kp', kk_edges[0]) })
+        batch_idxs.apply(g)
 
-        return g
+        return g, batch_idxs
 
 
-    def update_rk_edges(self, g: dgl.DGLHeteroGraph, batch_idxs: Dict[str, torch.Tensor]):
+    def update_rk_edges(self, g: dgl.DGLHeteroGraph, batch_idxs: BatchLayout) -> Tuple[dgl.DGLHeteroGraph, BatchLayout]:
 
         kp_pos = g.nodes['kp'].data['x_0']
         rec_pos = g.nodes['rec'].data['x_0']
@@ -305,18 +301,13 @@ class ReceptorEncoderGVP(nn.Module):
         elif self.rk_graph_type == 'radius':
             rk_idxs = radius(x=rec_pos, y=kp_pos, r=self.kp_rad, batch_x=batch_idxs['rec'], batch_y=batch_idxs['kp'], max_num_neighbors=10)
 
-        # we are going to remove and then add edges which destroy batch information. 
-        # we have to record batch info before mutating graph topology and add it back afterwards
-        batch_num_nodes, batch_num_edges = get_batch_info(g)
-
         # get number of receptor-keypoint edges for each graph in the batch
-        batch_num_edges[('rec', 'rk', 'kp')] = get_edges_per_batch(rk_idxs[0], g.batch_size, batch_idxs['kp'])
+        batch_idxs = batch_idxs.with_num_edges({ ('rec', 'rk', 'kp'): batch_idxs.count('kp', rk_idxs[0]) })
 
         g.remove_edges(g.edges(form='eid', etype='rk'), etype='rk') # remove all receptor-keypoint edges
         g.add_edges(rk_idxs[1], rk_idxs[0], etype='rk') # add edges that we just computed
     
-        # reset batch info
-        g.set_batch_num_nodes(batch_num_nodes)
-        g.set_batch_num_edges(batch_num_edges)
+        # mutating graph topology destroys batch information, so we write it back from the layout
+        batch_idxs.apply(g)
 
-        return g
\ No newline at end of file
+        return g, batch_idxs
\ No newline at end of file
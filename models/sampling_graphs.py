@@ -0,0 +1,98 @@
+from typing import Dict, Tuple
+
+import dgl
+import torch
+from torch_cluster import fps, knn, radius_graph
+from torch_scatter import segment_coo
+
+from utils import get_edges_per_batch
+
+
+def build_keypoint_graph(template: dgl.DGLHeteroGraph, kp_data: Dict[str, torch.Tensor], kp_batch_idx: torch.Tensor,
+                         lig_data: Dict[str, torch.Tensor], lig_batch_idx: torch.Tensor, batch_size: int, 
+                         kk_cutoff: float = None, kk_idxs: Tuple[torch.Tensor, torch.Tensor] = None) -> dgl.DGLHeteroGraph:
+    """Builds a batched graph containing only keypoint and ligand nodes, for use during sampling.
+
+    The returned graph has the same node and edge types as template so that it can be passed directly to the dynamics model,
+    but it has no receptor nodes. kk edges are given by kk_idxs if specified. Otherwise, if kk_cutoff is specified, kk edges are built 
+    as a radius graph on the keypoint positions.
+    kp_batch_idx and lig_batch_idx must be sorted.
+    """
+    device = kp_batch_idx.device
+    n_kp = kp_batch_idx.shape[0]
+    n_lig = lig_batch_idx.shape[0]
+
+    # start with every edge type empty
+    empty_idxs = torch.zeros(0, dtype=torch.int64, device=device)
+    graph_data = { etype: (empty_idxs, empty_idxs) for etype in template.canonical_etypes }
+
+    # add kp-kp edges
+    kk_etype = ('kp', 'kk', 'kp')
+    if kk_etype in graph_data:
+        if kk_idxs is None and kk_cutoff is not None:
+            kk_idxs = radius_graph(kp_data['x_0'], r=kk_cutoff, batch=kp_batch_idx, max_num_neighbors=100)
+        if kk_idxs is not None:
+            graph_data[kk_etype] = (kk_idxs[0], kk_idxs[1])
+
+    num_nodes_dict = { ntype: 0 for ntype in template.ntypes }
+    num_nodes_dict['kp'] = n_kp
+    num_nodes_dict['lig'] = n_lig
+
+    g = dgl.heterograph(graph_data, num_nodes_dict=num_nodes_dict, device=device)
+
+    # set batch information
+    batch_num_nodes = { ntype: torch.zeros(batch_size, dtype=torch.int64, device=device) for ntype in template.ntypes }
+    batch_num_nodes['kp'] = torch.bincount(kp_batch_idx, minlength=batch_size)
+    batch_num_nodes['lig'] = torch.bincount(lig_batch_idx, minlength=batch_size)
+
+    batch_num_edges = { etype: torch.zeros(batch_size, dtype=torch.int64, device=device) for etype in template.canonical_etypes }
+    if g.num_edges(kk_etype) > 0:
+        batch_num_edges[kk_etype] = get_edges_per_batch(graph_data[kk_etype][0], batch_size, kp_batch_idx)
+
+    g.set_batch_num_nodes(batch_num_nodes)
+    g.set_batch_num_edges(batch_num_edges)
+
+    # set node features
+    for feat, val in kp_data.items():
+        g.nodes['kp'].data[feat] = val
+    for feat, val in lig_data.items():
+        g.nodes['lig'].data[feat] = val
+
+    return g
+
+
+def pool_keypoints(g: dgl.DGLHeteroGraph, kp_batch_idx: torch.Tensor, ratio: float) -> Tuple[Dict[str, torch.Tensor], torch.Tensor]:
+    """Pools the keypoints of every graph in a batch into a smaller set of clusters.
+
+    Cluster centers are selected by farthest point sampling on the keypoint positions; roughly ratio*n_keypoints centers are kept per graph.
+    Every keypoint is assigned to its nearest cluster center, and the features of the pooled keypoints (positions, scalars and vectors)
+    are the mean over the keypoints in each cluster. Returns the pooled keypoint features and the batch index of each pooled keypoint.
+    """
+    kp_pos = g.nodes['kp'].data['x_0']
+    n_kp = kp_pos.shape[0]
+
+    # select cluster centers
+    center_idxs = fps(kp_pos, batch=kp_batch_idx, ratio=ratio)
+    center_idxs, _ = torch.sort(center_idxs)
+    center_batch_idx = kp_batch_idx[center_idxs]
+
+    # assign every keypoint to its nearest cluster center
+    assign_idxs = knn(x=kp_pos[center_idxs], y=kp_pos, k=1, batch_x=center_batch_idx, batch_y=kp_batch_idx)
+    cluster_idx = torch.empty(n_kp, dtype=torch.int64, device=kp_pos.device)
+    cluster_idx[assign_idxs[0]] = assign_idxs[1]
+
+    # clusters can only be empty if keypoints are exactly overlapping. we remove empty clusters
+    # and re-label cluster indicies so that the pooled keypoints remain sorted by batch
+    cluster_sizes = torch.bincount(cluster_idx, minlength=center_idxs.shape[0])
+    nonempty_mask = cluster_sizes > 0
+    cluster_idx = (torch.cumsum(nonempty_mask.long(), dim=0) - 1)[cluster_idx]
+    pooled_batch_idx = center_batch_idx[nonempty_mask]
+
+    # average keypoint features within each cluster. segment_coo requires sorted indicies
+    cluster_idx, sort_idx = torch.sort(cluster_idx, stable=True)
+    n_clusters = pooled_batch_idx.shape[0]
+    pooled_data = {}
+    for feat, val in g.nodes['kp'].data.items():
+        pooled_data[feat] = segment_coo(val[sort_idx], cluster_idx, dim_size=n_clusters, reduce='mean')
+
+    return pooled_data, pooled_batch_idx
@@ -1,5 +1,6 @@
 from pathlib import Path
 from time import time
+import hashlib
 import random
 from collections import defaultdict
 import argparse
@@ -23,7 +24,8 @@ from constants import aa_to_idx
 import utils
 import pickle
 
-from data_processing.pdbbind_processing import rec_atom_featurizer, lig_atom_featurizer, Unparsable, build_receptor_graph, get_interface_points, InterfacePointException
+from data_processing.columnar import element_idxs
+from data_processing.pdbbind_processing import rec_atom_featurizer, lig_atom_featurizer, Unparsable, build_receptor_graph, get_interface_points, InterfacePointException, compute_rr_edges
 from utils import get_rec_atom_map
 
 
@@ -204,6 +206,14 @@ def process_ligand_and_pocket(pdb_struct, ligand_name, ligand_chain, ligand_resi
     return pocket_coords, pocket_atom_features, lig_coords, lig_atom_features, pocket_res_idx, interface_points
 
 
+def pocket_key(rec_pos: torch.Tensor, rec_feat: torch.Tensor, rec_res_idx: torch.Tensor) -> bytes:
+    # complexes whose pockets have identical atoms share one copy of the pocket in the processed data
+    h = hashlib.sha1()
+    for arr in [rec_pos, rec_feat, rec_res_idx]:
+        h.update(str(arr.dtype).encode())
+        h.update(np.ascontiguousarray(arr.numpy()).tobytes())
+    return h.digest()
+
 def compute_smiles(lig_pos, lig_feat, lig_decoder):
     atom_types = [ lig_decoder[x] for x in torch.argmax(lig_feat.int(), dim=1).tolist() ]
     mol = build_molecule(lig_pos, atom_types, sanitize=True)
@@ -282,6 +292,7 @@ if __name__ == '__main__':
     # parser.add_argument('--dist_cutoff', type=float, default=8.0)
     # parser.add_argument('--ca_only', action='store_true')
     parser.add_argument('--random_seed', type=int, default=42)
+    parser.add_argument('--precompute_rr_edges', action='store_true', help='store rec-rec edges and same-residue flags, computed with the rr cutoff in the config file, so they are not recomputed at training time')
     # parser.add_argument('--make_split', action='store_true')
 
 
@@ -302,6 +313,10 @@ if __name__ == '__main__':
     processed_dir = Path(dataset_config['location'])
     processed_dir.mkdir(exist_ok=True, parents=True)
 
+    # rr edges are stored along with the cutoff they were computed with. the dataset only uses them if its rr cutoff matches
+    if args.precompute_rr_edges:
+        rr_cutoff = config_dict['graph']['graph_cutoffs']['rr']
+
     # determine if we are using a Ca-only representation of the receptor
     try:
         ca_only: bool = dataset_config['ca_only']
@@ -351,6 +366,7 @@ if __name__ == '__main__':
         
 
         data = defaultdict(list)
+        pocket_idx_map = {} # maps pocket_key of every unique pocket to its index in the stored pockets
         lig_rec_size_counter = defaultdict(int)
         atom_type_counts = None
         smiles = set()
@@ -462,12 +478,24 @@ if __name__ == '__main__':
                             smiles.add(smi)
 
                         # add graphs, ligand positions, and ligand features to the dataset
+                        # atom features are stored as uint8 element indicies, they are expanded to one-hot features by the model
                         data['lig_pos'].append(lig_pos)
-                        data['lig_feat'].append(lig_feat)
-                        data['rec_pos'].append(rec_pos)
-                        data['rec_feat'].append(rec_feat)
-                        data['rec_res_idx'].append(rec_res_idx)
+                        data['lig_feat'].append(element_idxs(lig_feat))
                         data['interface_points'].append(interface_points)
+
+                        # pockets (and their rr edges) are only stored the first time they are seen, complexes reference them by pocket_idx
+                        rec_feat = element_idxs(rec_feat)
+                        key = pocket_key(rec_pos, rec_feat, rec_res_idx)
+                        if key not in pocket_idx_map:
+                            pocket_idx_map[key] = len(data['rec_pos'])
+                            data['rec_pos'].append(rec_pos)
+                            data['rec_feat'].append(rec_feat)
+                            data['rec_res_idx'].append(rec_res_idx)
+                            if args.precompute_rr_edges:
+                                rr_edges, same_res_edge = compute_rr_edges(rec_pos, rec_res_idx, rr_cutoff)
+                                data['rr_edges'].append(rr_edges.T)
+                                data['rr_same_res'].append(same_res_edge)
+                        data['pocket_idx'].append(pocket_idx_map[key])
                         if split in {'val', 'test'}:
                             data['rec_files'].append(str(pdb_file_out))
                             data['lig_files'].append(str(sdf_file))
@@ -488,22 +516,32 @@ if __name__ == '__main__':
 
         # concatenate data for this split and compute idx lookups so we can split data examples back out
 
+        # rec_segments and rr_segments index unique pockets, the other segments index complexes
         n_graphs = len(data['lig_pos'])
-        rec_segments = torch.zeros(n_graphs+1, dtype=int)
-        lig_segments = rec_segments.clone()
-        ip_segments = rec_segments.clone()
+        n_pockets = len(data['rec_pos'])
+        print(f'{n_graphs} complexes in {split} split share {n_pockets} unique pockets', flush=True)
+        rec_segments = torch.zeros(n_pockets+1, dtype=int)
+        lig_segments = torch.zeros(n_graphs+1, dtype=int)
+        ip_segments = lig_segments.clone()
         rec_segments[1:] = torch.tensor([ x.shape[0] for x in data['rec_pos'] ], dtype=int)
         lig_segments[1:] = torch.tensor([ x.shape[0] for x in data['lig_pos'] ], dtype=int)
         ip_segments[1:] = torch.tensor([ x.shape[0] for x in data['interface_points'] ], dtype=int)
+        if args.precompute_rr_edges:
+            rr_segments = rec_segments.clone()
+            rr_segments[1:] = torch.tensor([ x.shape[0] for x in data['rr_edges'] ], dtype=int)
 
+        data['pocket_idx'] = torch.tensor(data['pocket_idx'], dtype=int)
         for key in data:
-            if 'files' in key:
+            if 'files' in key or key == 'pocket_idx':
                 continue
             data[key] = torch.concatenate(data[key], dim=0)
 
         data['rec_segments'] = torch.cumsum(rec_segments, dim=0)
         data['lig_segments'] = torch.cumsum(lig_segments, dim=0)
         data['ip_segments'] = torch.cumsum(ip_segments, dim=0)
+        if args.precompute_rr_edges:
+            data['rr_segments'] = torch.cumsum(rr_segments, dim=0)
+            data['rr_cutoff'] = rr_cutoff
 
 
         # save data for this split
@@ -0,0 +1,117 @@
+import argparse
+import copy
+from pathlib import Path
+
+import torch
+import yaml
+
+from analysis.metrics import ModelAnalyzer
+from data_processing.crossdocked.dataset import ProteinLigandDataset, collate_fn
+from model_setup import model_from_config
+from models.ligand_diffuser import KeypointDiffusion
+from models.quantization import (QUANTIZATION_FILE, calibrate_quantization,
+                                 get_quantizable_layers, quantize_dynamics)
+
+
+def parse_arguments():
+    p = argparse.ArgumentParser(description='Calibrate int8 quantization of the dynamics model for CPU inference and compare sample quality against the fp32 model.')
+    p.add_argument('model_dir', type=Path, help='directory of training result for the model')
+    p.add_argument('--split', type=str, default='val')
+    p.add_argument('--n_calibration_pockets', type=int, default=8, help='number of pockets used to record layer inputs for calibration')
+    p.add_argument('--n_calibration_passes', type=int, default=4, help='number of forward passes, each at random timesteps, over the calibration pockets')
+    p.add_argument('--max_layer_error', type=float, default=0.02, help='layers whose relative output error after quantization exceeds this value are kept in fp32')
+    p.add_argument('--n_receptors', type=int, default=10, help='number of receptors sampled for the accuracy report')
+    p.add_argument('--n_replicates', type=int, default=10, help='number of ligands sampled per receptor for the accuracy report')
+    p.add_argument('--batch_size', type=int, default=64)
+    p.add_argument('--seed', type=int, default=42)
+    p.add_argument('--no_report', action='store_true', help='only calibrate, do not sample from the fp32 and int8 models')
+    args = p.parse_args()
+    return args
+
+
+def main():
+
+    args = parse_arguments()
+
+    # load model configuration
+    with open(args.model_dir / 'config.yml', 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+
+    # quantized layers only run on cpu
+    device = torch.device('cpu')
+    torch.manual_seed(args.seed)
+
+    # the fixed receptor encoder uses receptor atoms as keypoints, so we have the dataset build them directly into the graph
+    try:
+        rec_encoder_type = config['diffusion']['rec_encoder_type']
+    except KeyError:
+        rec_encoder_type = 'learned'
+
+    # create dataset
+    dataset_path = Path(config['dataset']['location'])
+    dataset = ProteinLigandDataset(name=args.split, processed_data_file=str(dataset_path / f'{args.split}.pkl'), fixed_keypoints=rec_encoder_type == 'fixed',
+                                   **config['graph'], **config['dataset'])
+
+    # create model and load weights
+    model: KeypointDiffusion = model_from_config(config).to(device)
+    model.load_state_dict(torch.load(args.model_dir / 'model.pt', map_location=device))
+    model.eval()
+
+    # record layer inputs by computing the training objective on a few pockets at random timesteps
+    calibration_idxs = torch.randperm(len(dataset))[:args.n_calibration_pockets]
+    def run_calibration():
+        with torch.no_grad():
+            for _ in range(args.n_calibration_passes):
+                # the forward pass modifies graphs in place so we rebuild them for every pass
+                complex_graphs, interface_points = collate_fn([ dataset[int(idx)] for idx in calibration_idxs ])
+                model(complex_graphs.to(device), interface_points)
+
+    # measure the quantization error of every layer and keep the accurate ones
+    candidate_layers = get_quantizable_layers(model.dynamics)
+    layer_errors = calibrate_quantization(model.dynamics, run_calibration, layer_names=candidate_layers)
+    quantized_layers = [ name for name, error in layer_errors.items() if error <= args.max_layer_error ]
+    print(f'quantizing {len(quantized_layers)} of {len(candidate_layers)} linear layers', flush=True)
+    for name, error in layer_errors.items():
+        if error > args.max_layer_error:
+            print(f'  keeping {name} in fp32, relative error = {error:.4f}')
+
+    quantization_config = {
+        'max_layer_error': args.max_layer_error,
+        'quantized_layers': quantized_layers,
+        'layer_errors': layer_errors,
+    }
+
+    if not args.no_report:
+
+        int8_model = quantize_dynamics(copy.deepcopy(model), layer_names=quantized_layers)
+
+        # sample the same receptors with the same noise from both models
+        results = {}
+        for model_name, sampling_model in [('fp32', model), ('int8', int8_model)]:
+            torch.manual_seed(args.seed)
+            analyzer = ModelAnalyzer(model=sampling_model, dataset=dataset, device=device)
+            metrics = analyzer.sample_and_analyze(
+                n_receptors=args.n_receptors,
+                n_replicates=args.n_replicates,
+                rec_enc_batch_size=args.batch_size,
+                diff_batch_size=args.batch_size)
+            results[model_name] = { k: float(v) for k, v in metrics.items() }
+
+        # report int8 metrics relative to the fp32 model
+        print('metric'.ljust(24) + 'fp32'.rjust(12) + 'int8'.rjust(12) + 'difference'.rjust(12))
+        for metric_name in results['fp32']:
+            fp32_val, int8_val = results['fp32'][metric_name], results['int8'][metric_name]
+            print(metric_name.ljust(24) + f'{fp32_val:12.3f}{int8_val:12.3f}{int8_val - fp32_val:12.3f}')
+        print(f'speedup = {results["fp32"]["sample_time"] / results["int8"]["sample_time"]:.2f}x', flush=True)
+
+        quantization_config['metrics'] = results
+
+    # save the selected layers so that test.py and byop.py can apply the same quantization
+    output_file = args.model_dir / QUANTIZATION_FILE
+    with open(output_file, 'w') as f:
+        yaml.dump(quantization_config, f)
+    print(f'quantization config written to {output_file}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import argparse
+import json
+from pathlib import Path
+
+import torch
+
+# this script only depends on torch so that it can be run wherever the artifact written by export_sampler.py is deployed
+
+
+def parse_arguments():
+    p = argparse.ArgumentParser(description='Sample ligands for a pocket with a sampler exported by export_sampler.py.')
+    p.add_argument('artifact_dir', type=Path, help='directory written by export_sampler.py')
+    p.add_argument('pocket_file', type=Path, help='PDB file containing only the atoms of the binding pocket')
+    p.add_argument('--n_lig_atoms', type=int, required=True, help='number of atoms in every sampled ligand')
+    p.add_argument('--n_mols', type=int, default=10, help='number of molecules to sample')
+    p.add_argument('--batch_size', type=int, default=32)
+    p.add_argument('--init_com', type=float, nargs=3, default=None, help='initial ligand center of mass. defaults to the center of mass of the pocket')
+    p.add_argument('--output_file', type=Path, default=Path('exported_samples.xyz'))
+    p.add_argument('--seed', type=int, default=None)
+    args = p.parse_args()
+    return args
+
+
+def read_pocket(pocket_file: Path, rec_elements: list, remove_hydrogen: bool):
+    """Returns the positions and one-hot element features of pocket atoms. Atoms whose element is not in rec_elements are dropped."""
+    element_idx = { element: idx for idx, element in enumerate(rec_elements) }
+
+    positions, element_idxs = [], []
+    with open(pocket_file, 'r') as f:
+        for line in f:
+            if not line.startswith(('ATOM', 'HETATM')):
+                continue
+
+            # use the element column if present, otherwise infer the element from the atom name
+            element = line[76:78].strip() or line[12:16].strip()[0]
+            element = element.capitalize()
+            if remove_hydrogen and element == 'H':
+                continue
+            if element not in element_idx:
+                continue
+
+            positions.append([ float(line[30:38]), float(line[38:46]), float(line[46:54]) ])
+            element_idxs.append(element_idx[element])
+
+    rec_pos = torch.tensor(positions, dtype=torch.float32)
+    rec_feat = torch.nn.functional.one_hot(torch.tensor(element_idxs), num_classes=len(rec_elements)).float()
+    return rec_pos, rec_feat
+
+
+def write_xyz(output_file: Path, lig_pos: torch.Tensor, lig_elements: list):
+    with open(output_file, 'w') as f:
+        for mol_pos, mol_elements in zip(lig_pos.tolist(), lig_elements):
+            f.write(f'{len(mol_elements)}\n\n')
+            for (x, y, z), element in zip(mol_pos, mol_elements):
+                f.write(f'{element} {x:.3f} {y:.3f} {z:.3f}\n')
+
+
+@torch.no_grad()
+def main():
+
+    args = parse_arguments()
+    if args.seed is not None:
+        torch.manual_seed(args.seed)
+
+    with open(args.artifact_dir / 'metadata.json', 'r') as f:
+        metadata = json.load(f)
+
+    if args.n_lig_atoms < metadata['min_lig_atoms']:
+        raise ValueError(f'the exported sampler requires at least {metadata["min_lig_atoms"]} ligand atoms')
+
+    rec_encoder = torch.export.load(args.artifact_dir / 'rec_encoder.pt2').module()
+    denoising_step = torch.export.load(args.artifact_dir / 'denoising_step.pt2').module()
+
+    # encode the pocket into keypoints
+    rec_pos, rec_feat = read_pocket(args.pocket_file, metadata['rec_elements'], metadata['remove_hydrogen'])
+    kp_pos, kp_feat, kp_vecs = rec_encoder(rec_pos, rec_feat)
+
+    # ligands are sampled in a frame centered on the initial ligand position and returned to the frame of the keypoints at the end
+    init_kp_com = kp_pos.mean(dim=0)
+    init_sampling_com = torch.tensor(args.init_com) if args.init_com is not None else rec_pos.mean(dim=0)
+
+    n_timesteps = metadata['n_timesteps']
+    lig_pos, lig_feat = [], []
+    n_sampled = 0
+    while n_sampled < args.n_mols:
+        n_samples = min(args.batch_size, args.n_mols - n_sampled)
+
+        # the exported step has a minimum batch size, extra samples are discarded
+        batch_size = max(n_samples, metadata['min_batch_size'])
+
+        batch_kp_pos = (kp_pos - init_sampling_com).expand(batch_size, -1, -1)
+        batch_kp_feat = kp_feat.expand(batch_size, -1, -1)
+        batch_kp_vecs = kp_vecs.expand(batch_size, -1, -1, -1)
+
+        # sample initial ligand positions and features, then remove the ligand COM from the system
+        batch_lig_pos = torch.randn(batch_size, args.n_lig_atoms, 3)
+        batch_lig_feat = torch.randn(batch_size, args.n_lig_atoms, metadata['n_lig_feat'])
+        lig_com = batch_lig_pos.mean(dim=1, keepdim=True)
+        batch_lig_pos, batch_kp_pos = batch_lig_pos - lig_com, batch_kp_pos - lig_com
+
+        for s in reversed(range(n_timesteps)):
+            step = torch.full((batch_size,), float(s))
+            pos_noise = torch.randn_like(batch_lig_pos)
+            feat_noise = torch.randn_like(batch_lig_feat)
+            batch_lig_pos, batch_lig_feat, batch_kp_pos = denoising_step(batch_lig_pos, batch_lig_feat, batch_kp_pos, batch_kp_feat, batch_kp_vecs,
+                                                                         step, pos_noise, feat_noise)
+
+        # move ligands back into the frame of the input pocket
+        batch_lig_pos = batch_lig_pos - batch_kp_pos.mean(dim=1, keepdim=True) + init_kp_com
+        batch_lig_feat = batch_lig_feat * metadata['lig_feat_norm_constant']
+
+        lig_pos.append(batch_lig_pos[:n_samples])
+        lig_feat.append(batch_lig_feat[:n_samples])
+        n_sampled += n_samples
+
+    lig_pos = torch.cat(lig_pos, dim=0)
+    lig_elements = [ [ metadata['lig_elements'][idx] for idx in mol_idxs ] for mol_idxs in torch.cat(lig_feat, dim=0).argmax(dim=-1).tolist() ]
+    write_xyz(args.output_file, lig_pos, lig_elements)
+    print(f'{lig_pos.shape[0]} ligands written to {args.output_file}')
+
+
+if __name__ == "__main__":
+    main()
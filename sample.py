@@ -122,10 +122,17 @@ def main():
     torch.manual_seed(cmd_args.seed)
     rng = np.random.default_rng(42)
 
+    # the fixed receptor encoder uses receptor atoms as keypoints, so we build its keypoints directly into the graph
+    try:
+        rec_encoder_type = args['diffusion']['rec_encoder_type']
+    except KeyError:
+        rec_encoder_type = 'learned'
+
     # create test dataset
     dataset_path = Path(args['dataset']['location']) 
     test_dataset_path = str(dataset_path / 'val.pkl')
-    test_dataset = ProteinLigandDataset(name='val', processed_data_file=test_dataset_path, **args['graph'], **args['dataset'])
+    test_dataset = ProteinLigandDataset(name='val', processed_data_file=test_dataset_path, fixed_keypoints=rec_encoder_type == 'fixed', 
+                                        **args['graph'], **args['dataset'])
 
 
     # get the model architecture
@@ -159,6 +166,7 @@ def main():
     model = KeypointDiffusion(
         n_lig_feat, 
         n_kp_feat,
+        rec_atom_nf=len(args['dataset']['rec_elements']),
         processed_dataset_dir=Path(args['dataset']['location']),
         graph_config=args['graph'],
         dynamics_config=dynamics_config, 
@@ -195,12 +203,9 @@ def main():
         # move data to correct device
         ref_graph = ref_graph.to(device)
 
-        # get batch_idxs
-        batch_idxs = get_batch_idxs(ref_graph)
-
         if use_fake_atoms:
-            ref_lig_batch_idx = torch.zeros(ref_graph.num_nodes('lig'), device=ref_graph.device)
-            ref_graph = model.remove_fake_atoms(ref_graph, ref_lig_batch_idx)
+            ref_graph = model.remove_fake_atoms(ref_graph, get_batch_idxs(ref_graph))
+
 
         # get array specifying the number of nodes in each ligand we sample
         n_nodes = torch.ones(size=(cmd_args.n_replicates,), dtype=int, device=device)*ref_graph.num_nodes('lig')
@@ -210,7 +215,7 @@ def main():
         # so for sampling this is not strictly necessary, but i would like to visualize the position of the keypoints
         ref_graph_copy = copy_graph(ref_graph, n_copies=1)[0]
         with ref_graph_copy.local_scope():
-            encoded_ref_graph = model.rec_encoder(ref_graph_copy, batch_idxs)
+            encoded_ref_graph = model.encode_receptors(ref_graph_copy)
             kp_pos = encoded_ref_graph.nodes['kp'].data['x_0']
 
         # sample ligands
@@ -1,5 +1,6 @@
 import argparse
 import math
+import os
 import pickle
 import shutil
 import sys
@@ -19,13 +20,14 @@ from dgl.dataloading import GraphDataLoader
 import wandb
 from model_setup import model_from_config
 from analysis.metrics import ModelAnalyzer
-from data_processing.crossdocked.dataset import (ProteinLigandDataset,
-                                                 get_dataloader)
+from data_processing.crossdocked.dataset import (DevicePrefetcher, ProteinLigandDataset,
+                                                 ShardedDataset, get_dataloader)
+from data_processing.sharded import sharded_dir
 from models.dynamics import LigRecDynamics
 from models.ligand_diffuser import KeypointDiffusion
 from models.receptor_encoder import ReceptorEncoder
 from models.scheduler import Scheduler
-from utils import save_model
+from utils import process_memory_usage, save_model, worker_memory_usage
 
 
 def parse_arguments():
@@ -318,10 +320,6 @@ def test_model(model, test_dataloader, args, device):
     for _ in range(args['training']['test_epochs']):
         for complex_graphs, interface_points in test_dataloader:
 
-            # set data type of atom features
-            for ntype in ['lig', 'rec']:
-                complex_graphs.nodes[ntype].data['h_0'] = complex_graphs.nodes[ntype].data['h_0'].float()
-
             complex_graphs = complex_graphs.to(device)
             if args['rec_encoder_loss']['use_interface_points']:
                 interface_points = [ arr.to(device) for arr in interface_points ]
@@ -402,23 +400,69 @@ def main():
     # get batch size
     batch_size = config['training']['batch_size']
 
+    # the fixed receptor encoder uses receptor atoms as keypoints, so we have the dataset build them directly into the graph
+    try:
+        rec_encoder_type = config['diffusion']['rec_encoder_type']
+    except KeyError:
+        rec_encoder_type = 'learned'
+
     # create datasets
     dataset_path = Path(config['dataset']['location']) 
     train_dataset_path = str(dataset_path / 'train.pkl') 
     test_dataset_path = str(dataset_path / 'test.pkl')
-    train_dataset = ProteinLigandDataset(name='train', processed_data_file=train_dataset_path, **config['graph'], **config['dataset'])
-    test_dataset = ProteinLigandDataset(name='test', processed_data_file=test_dataset_path, **config['graph'], **config['dataset'])
 
-    # compute number of iterations per epoch - necessary for deciding when to do test evaluations/saves/etc. 
-    iterations_per_epoch = len(train_dataset) / batch_size
+    # a sharded training set is streamed, and every process only reads the shards of its rank. rank and world size are read from the
+    # environment variables set by launchers like torchrun
+    try:
+        sharded_train_data = config['training']['sharded_train_data']
+    except KeyError:
+        sharded_train_data = False
+
+    if sharded_train_data:
+        try:
+            shuffle_buffer_size = config['training']['shuffle_buffer_size']
+        except KeyError:
+            shuffle_buffer_size = 1000
+        train_dataset = ShardedDataset(sharded_dir(train_dataset_path), rank=int(os.environ.get('RANK', 0)), world_size=int(os.environ.get('WORLD_SIZE', 1)), 
+                                       shuffle_buffer_size=shuffle_buffer_size, seed=42,
+                                       fixed_keypoints=rec_encoder_type == 'fixed', **config['graph'], **config['dataset'])
+    else:
+        train_dataset = ProteinLigandDataset(name='train', processed_data_file=train_dataset_path, fixed_keypoints=rec_encoder_type == 'fixed', **config['graph'], **config['dataset'])
+    test_dataset = ProteinLigandDataset(name='test', processed_data_file=test_dataset_path, fixed_keypoints=rec_encoder_type == 'fixed', **config['graph'], **config['dataset'])
+
+    # build one graph per batch in the collate function rather than one graph per example
+    try:
+        batched_collate = config['training']['batched_collate']
+    except KeyError:
+        batched_collate = False
+
+    # if a batch budget is specified, batches are formed from examples of similar size under a node/edge budget rather than with a fixed batch size
+    try:
+        batch_budget = config['training']['batch_budget']
+    except KeyError:
+        batch_budget = None
 
     # create dataloaders
-    train_dataloader = get_dataloader(train_dataset, batch_size=batch_size, num_workers=config['training']['num_workers'], shuffle=True, pin_memory=True)
-    test_dataloader = get_dataloader(test_dataset, batch_size=batch_size, num_workers=config['training']['num_workers'], pin_memory=True)
+    train_dataloader = get_dataloader(train_dataset, batch_size=batch_size, num_workers=config['training']['num_workers'], batched_collate=batched_collate, batch_budget=batch_budget, shuffle=True, pin_memory=True)
+    test_dataloader = get_dataloader(test_dataset, batch_size=batch_size, num_workers=config['training']['num_workers'], batched_collate=batched_collate, batch_budget=batch_budget, pin_memory=True)
+
+    # compute number of iterations per epoch - necessary for deciding when to do test evaluations/saves/etc. 
+    # with a batch budget, the number of batches per epoch is recomputed at the start of every epoch
+    if batch_budget is not None:
+        iterations_per_epoch = len(train_dataloader)
+    else:
+        iterations_per_epoch = len(train_dataset) / batch_size
 
     # determine if we are using interface points
     use_interface_points = config['rec_encoder_loss']['use_interface_points']
 
+    # training batches are moved to the device in a background thread, prefetch_batches batches ahead of the training loop
+    try:
+        prefetch_batches = config['training']['prefetch_batches']
+    except KeyError:
+        prefetch_batches = 2
+    train_batches = DevicePrefetcher(train_dataloader, device, n_prefetch=prefetch_batches, move_interface_points=use_interface_points)
+
     # create diffusion model
     model: KeypointDiffusion = model_from_config(config).to(device)
     
@@ -487,7 +531,16 @@ def main():
     n_epochs_ceil = math.ceil(n_epochs)
     for epoch_idx in range(n_epochs_ceil):
 
-        for iter_idx, iter_data in enumerate(train_dataloader):
+        # sharded training data is shuffled by the dataset itself, with an order determined by the epoch
+        if sharded_train_data:
+            train_dataset.set_epoch(epoch_idx)
+
+        # batches formed under a budget are reshuffled every epoch, which can change the number of batches
+        if batch_budget is not None:
+            train_dataloader.batch_sampler.set_epoch(epoch_idx)
+            iterations_per_epoch = len(train_dataloader)
+
+        for iter_idx, iter_data in enumerate(train_batches):
             complex_graphs, interface_points = iter_data
 
             current_epoch = epoch_idx + iter_idx/iterations_per_epoch
@@ -501,22 +554,6 @@ def main():
             scheduler.step_lr(current_epoch)
             rec_encoder_loss_weight = scheduler.get_rec_enc_weight(current_epoch)
 
-            # move data to the gpu
-            complex_graphs = complex_graphs.to(device)
-            if use_interface_points:
-
-                # get the number of interface points in every sample
-                n_interface_points = [ arr.shape[0] for arr in interface_points ]
-
-                # concatenate interface points into a single array
-                interface_points = torch.cat(interface_points, dim=0)
-
-                # move interface points to the gpu
-                interface_points = interface_points.to(device)
-
-                # split interface points back out into a list of arrays
-                interface_points = torch.split(interface_points, n_interface_points)
-
             optimizer.zero_grad()
             # TODO: add random translations to the complex positions??
 
@@ -619,6 +656,15 @@ def main():
                     'learning_rate': scheduler.get_lr()
                 })
 
+                # record memory usage of the main process and the dataloader workers. data shared between workers is counted in 
+                # rss_shared rather than rss_anon, so the rss_anon of each worker should stay flat as num_workers grows
+                if Path('/proc').exists():
+                    train_metrics_row['main_rss_anon_mb'] = process_memory_usage()['rss_anon']
+                    worker_usage = list(worker_memory_usage().values())
+                    if len(worker_usage) > 0:
+                        train_metrics_row['max_worker_rss_anon_mb'] = max( usage['rss_anon'] for usage in worker_usage )
+                        train_metrics_row['max_worker_rss_shared_mb'] = max( usage['rss_file'] + usage['rss_shmem'] for usage in worker_usage )
+
                 train_metrics.append(train_metrics_row)
                 with open(train_metrics_file, 'wb') as f:
                     pickle.dump(train_metrics, f)
@@ -3,8 +3,9 @@ import openbabel
 # from rdkit.Chem import rdDetermineBonds
 import tempfile
 import torch
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 import dgl
 
 # this is taken from DiffSBDD, minor modification to return the file contents without writing to disk if filename=None 
@@ -155,16 +156,252 @@ def copy_graph(g: dgl.DGLHeteroGraph, n_copies: int, lig_atoms_per_copy: torch.T
 
     return g_copies
 
-def get_batch_idxs(g: dgl.DGLHeteroGraph) -> Dict[str, torch.Tensor]:
-        
-    batch_size = g.batch_size
-    device = g.device
+def n_receptor_atoms(g: dgl.DGLHeteroGraph) -> int:
+    """Returns the number of receptor atoms in a complex graph that has not been encoded yet. Graphs built for the fixed receptor encoder 
+    (fixed_keypoints=True) store the receptor atoms as keypoints and have no receptor nodes."""
+    if g.num_nodes('rec') == 0 and 'x_0' in g.nodes['kp'].data:
+        return g.num_nodes('kp')
+    return g.num_nodes('rec')
+
+def select_graphs(g: dgl.DGLHeteroGraph, graph_mask: torch.Tensor) -> Tuple[dgl.DGLHeteroGraph, 'BatchLayout']:
+    """Returns a batched graph containing only the graphs of the batch g where graph_mask is True, along with its batch layout."""
+    layout = BatchLayout.from_graph(g)
+    node_masks = { ntype: graph_mask[layout[ntype]] for ntype in g.ntypes }
+    g_selected = dgl.node_subgraph(g, node_masks, store_ids=False)
+
+    selected_layout = BatchLayout(
+        batch_size=int(graph_mask.sum()),
+        num_nodes={ ntype: counts[graph_mask] for ntype, counts in layout.num_nodes.items() },
+        num_edges={ etype: counts[graph_mask] for etype, counts in layout.num_edges.items() })
+    return selected_layout.apply(g_selected), selected_layout
+
+@dataclass(frozen=True)
+class BatchLayout:
+    """Per-graph node and edge counts of a batched heterograph, along with the batch index and offset of every node type.
+
+    A layout is computed once per batch and passed through the model instead of recomputing batch information from the graph.
+    It can be indexed by node type to get the batch index of every node, like the dictionaries previously returned by get_batch_idxs.
+    Layouts are never modified: when nodes or edges are added or removed, with_num_nodes/with_num_edges return an updated layout and 
+    apply writes the batch information of a layout into a graph.
+    """
+    batch_size: int
+    num_nodes: Dict[str, torch.Tensor]
+    num_edges: Dict[Tuple[str, str, str], torch.Tensor]
+    batch_idxs: Dict[str, torch.Tensor] = field(default_factory=dict)
+    node_offsets: Dict[str, torch.Tensor] = field(default_factory=dict)
+
+    def __post_init__(self):
+        # fill in batch indicies and offsets for node types that were not given
+        batch_idx = None
+        for ntype, counts in self.num_nodes.items():
+            if ntype not in self.batch_idxs:
+                if batch_idx is None:
+                    batch_idx = torch.arange(self.batch_size, device=counts.device)
+                self.batch_idxs[ntype] = batch_idx.repeat_interleave(counts)
+            if ntype not in self.node_offsets:
+                self.node_offsets[ntype] = torch.cumsum(counts, dim=0) - counts
+
+    @classmethod
+    def from_graph(cls, g: dgl.DGLHeteroGraph) -> 'BatchLayout':
+        batch_num_nodes, batch_num_edges = get_batch_info(g)
+        return cls(batch_size=g.batch_size, num_nodes=batch_num_nodes, num_edges=batch_num_edges)
 
-    batch_idx = torch.arange(batch_size, device=device)
+    def __getitem__(self, ntype: str) -> torch.Tensor:
+        return self.batch_idxs[ntype]
 
-    # iterate over node types in complex_graphs
-    batch_idxs = {}
-    for ntype in g.ntypes:
-        batch_idxs[ntype] = batch_idx.repeat_interleave(g.batch_num_nodes(ntype))
+    def count(self, ntype: str, node_idxs: torch.Tensor) -> torch.Tensor:
+        """Counts the entries of node_idxs, which index nodes of type ntype, that belong to each graph in the batch. 
+        
+        Passing the source or destination nodes of a set of edges gives the number of edges in each graph."""
+        return torch.bincount(self.batch_idxs[ntype][node_idxs], minlength=self.batch_size)
+
+    def with_num_edges(self, num_edges: Dict[Tuple[str, str, str], torch.Tensor]) -> 'BatchLayout':
+        """Returns a copy of this layout where the per-graph edge counts of the given edge types are replaced."""
+        return BatchLayout(self.batch_size, self.num_nodes, {**self.num_edges, **num_edges}, self.batch_idxs, self.node_offsets)
 
-    return batch_idxs
\ No newline at end of file
+    def with_num_nodes(self, num_nodes: Dict[str, torch.Tensor], batch_idxs: Dict[str, torch.Tensor] = {}) -> 'BatchLayout':
+        """Returns a copy of this layout where the per-graph node counts of the given node types are replaced. 
+        
+        The batch indicies of the replaced node types are recomputed unless they are given in batch_idxs."""
+        kept_batch_idxs = { ntype: idx for ntype, idx in self.batch_idxs.items() if ntype not in num_nodes }
+        kept_offsets = { ntype: offsets for ntype, offsets in self.node_offsets.items() if ntype not in num_nodes }
+        return BatchLayout(self.batch_size, {**self.num_nodes, **num_nodes}, self.num_edges, {**kept_batch_idxs, **batch_idxs}, kept_offsets)
+
+    def apply(self, g: dgl.DGLHeteroGraph) -> dgl.DGLHeteroGraph:
+        """Sets the batch information of g to the node and edge counts of this layout."""
+        g.set_batch_num_nodes(self.num_nodes)
+        g.set_batch_num_edges(self.num_edges)
+        return g
+
+def get_batch_idxs(g: dgl.DGLHeteroGraph) -> BatchLayout:
+    """Returns the batch layout of g. The layout can be indexed by node type to get the batch index of every node."""
+    return BatchLayout.from_graph(g)
+
+@dataclass(frozen=True)
+class PackedLigands:
+    """Sampled ligands stored as packed tensors rather than one tensor per ligand.
+
+    The atoms of ligand i are positions[offsets[i]:offsets[i+1]] and element_idxs[offsets[i]:offsets[i+1]]. pocket_ids and request_ids 
+    identify the pocket each ligand was sampled for and the index of the ligand among the requests for that pocket. Ligands that diverged 
+    during sampling have no atoms. features holds the full ligand features and is only kept when they are needed, e.g. to return per-ligand features.
+    """
+    positions: torch.Tensor
+    element_idxs: torch.Tensor
+    offsets: torch.Tensor
+    pocket_ids: torch.Tensor
+    request_ids: torch.Tensor
+    features: Optional[torch.Tensor] = None
+
+    @classmethod
+    def from_graph(cls, g: dgl.DGLHeteroGraph, pocket_ids: torch.Tensor = None, request_ids: torch.Tensor = None, keep_features: bool = False) -> 'PackedLigands':
+        """Packs the ligands of a batched graph. Ligand features are converted to element indicies with an argmax."""
+        lig_feat = g.nodes['lig'].data['h_0']
+        n_atoms = g.batch_num_nodes('lig')
+        if pocket_ids is None:
+            pocket_ids = torch.zeros(g.batch_size, dtype=torch.long, device=g.device)
+        if request_ids is None:
+            request_ids = torch.arange(g.batch_size, device=g.device)
+        return cls(
+            positions=g.nodes['lig'].data['x_0'], 
+            element_idxs=lig_feat.argmax(dim=1), 
+            offsets=torch.cat([ n_atoms.new_zeros(1), torch.cumsum(n_atoms, dim=0) ]), 
+            pocket_ids=pocket_ids, 
+            request_ids=request_ids, 
+            features=lig_feat if keep_features else None)
+
+    @classmethod
+    def empty(cls, pocket_ids: torch.Tensor, request_ids: torch.Tensor, n_features: int = None) -> 'PackedLigands':
+        """Returns ligands with no atoms, e.g. for samples that diverged. Features are only included if n_features is given."""
+        return cls(
+            positions=torch.zeros((0, 3)),
+            element_idxs=torch.zeros(0, dtype=torch.long),
+            offsets=torch.zeros(pocket_ids.shape[0]+1, dtype=torch.long),
+            pocket_ids=pocket_ids,
+            request_ids=request_ids,
+            features=torch.zeros((0, n_features)) if n_features is not None else None)
+
+    @classmethod
+    def cat(cls, packed: List['PackedLigands']) -> 'PackedLigands':
+        """Concatenates the ligands of several PackedLigands."""
+        atom_offsets = torch.cumsum(torch.tensor([0] + [ p.positions.shape[0] for p in packed[:-1] ]), dim=0).tolist()
+        offsets = [packed[0].offsets[:1]] + [ p.offsets[1:] + atom_offset for p, atom_offset in zip(packed, atom_offsets) ]
+        features = None if any(p.features is None for p in packed) else torch.cat([ p.features for p in packed ], dim=0)
+        return cls(
+            positions=torch.cat([ p.positions for p in packed ], dim=0),
+            element_idxs=torch.cat([ p.element_idxs for p in packed ], dim=0),
+            offsets=torch.cat(offsets, dim=0),
+            pocket_ids=torch.cat([ p.pocket_ids for p in packed ], dim=0),
+            request_ids=torch.cat([ p.request_ids for p in packed ], dim=0),
+            features=features)
+
+    @property
+    def n_atoms(self) -> torch.Tensor:
+        return self.offsets[1:] - self.offsets[:-1]
+
+    def __len__(self) -> int:
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Returns views of the positions and element indicies of ligand idx."""
+        start, end = self.offsets[idx].item(), self.offsets[idx+1].item()
+        return self.positions[start:end], self.element_idxs[start:end]
+
+    def split(self, features: bool = False) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        """Returns lists of per-ligand views of the positions and element indicies, or of the positions and features if features is True."""
+        n_atoms = self.n_atoms.tolist()
+        atom_data = self.features if features else self.element_idxs
+        return list(torch.split(self.positions, n_atoms)), list(torch.split(atom_data, n_atoms))
+
+    def index_select(self, ligand_idxs: torch.Tensor) -> 'PackedLigands':
+        """Returns the ligands ligand_idxs, in that order."""
+        n_atoms = self.n_atoms[ligand_idxs]
+        new_offsets = torch.cat([ n_atoms.new_zeros(1), torch.cumsum(n_atoms, dim=0) ])
+
+        # index of every selected atom in the packed tensors
+        atom_ligand = torch.arange(ligand_idxs.shape[0], device=n_atoms.device).repeat_interleave(n_atoms)
+        atom_idxs = torch.arange(int(new_offsets[-1]), device=n_atoms.device) - new_offsets[atom_ligand] + self.offsets[ligand_idxs][atom_ligand]
+        return PackedLigands(
+            positions=self.positions[atom_idxs],
+            element_idxs=self.element_idxs[atom_idxs],
+            offsets=new_offsets,
+            pocket_ids=self.pocket_ids[ligand_idxs],
+            request_ids=self.request_ids[ligand_idxs],
+            features=self.features[atom_idxs] if self.features is not None else None)
+
+    def clear_ligands(self, ligand_mask: torch.Tensor) -> 'PackedLigands':
+        """Returns a copy where the ligands in ligand_mask have no atoms. The ids of cleared ligands are kept."""
+        atom_mask = ~ligand_mask.repeat_interleave(self.n_atoms)
+        n_atoms = self.n_atoms.masked_fill(ligand_mask, 0)
+        return PackedLigands(
+            positions=self.positions[atom_mask],
+            element_idxs=self.element_idxs[atom_mask],
+            offsets=torch.cat([ n_atoms.new_zeros(1), torch.cumsum(n_atoms, dim=0) ]),
+            pocket_ids=self.pocket_ids,
+            request_ids=self.request_ids,
+            features=self.features[atom_mask] if self.features is not None else None)
+
+    def to(self, device) -> 'PackedLigands':
+        return PackedLigands(**{ name: None if value is None else value.to(device) for name, value in self.__dict__.items() })
+
+def to_dense_batch(x: torch.Tensor, batch_idx: torch.Tensor, batch_size: int, fill_value: float = 0.0) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Converts node features x of shape (n_nodes, ...) into a padded tensor of shape (batch_size, max_nodes_per_graph, ...).
+
+    batch_idx must be sorted. Also returns a boolean mask of shape (batch_size, max_nodes_per_graph) which is True for real nodes.
+    """
+    device = x.device
+    nodes_per_graph = torch.bincount(batch_idx, minlength=batch_size)
+    max_nodes = int(nodes_per_graph.max()) if batch_size > 0 else 0
+
+    # compute the index of every node within its own graph
+    graph_offsets = torch.cumsum(nodes_per_graph, dim=0) - nodes_per_graph
+    node_idx = torch.arange(x.shape[0], device=device) - graph_offsets[batch_idx]
+
+    dense_x = x.new_full((batch_size, max_nodes, *x.shape[1:]), fill_value)
+    dense_x[batch_idx, node_idx] = x
+
+    mask = torch.zeros((batch_size, max_nodes), dtype=torch.bool, device=device)
+    mask[batch_idx, node_idx] = True
+
+    return dense_x, mask
+
+def process_memory_usage(pid: int = None) -> Dict[str, float]:
+    """Returns the resident memory of a process in MB, split into private (anon), file-backed and shared memory pages. Linux only.
+
+    Data that is shared between dataloader workers, through shared memory or memory-mapped files, shows up as file or shmem pages 
+    rather than as private pages of every worker. Fields that the kernel does not report are 0."""
+    status_file = Path('/proc') / (str(pid) if pid is not None else 'self') / 'status'
+    fields = {'VmRSS': 'rss', 'RssAnon': 'rss_anon', 'RssFile': 'rss_file', 'RssShmem': 'rss_shmem'}
+    status = {}
+    with open(status_file, 'r') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in fields:
+                status[key] = int(value.split()[0]) / 1024 # values are in kB
+    return { name: status.get(key, 0.0) for key, name in fields.items() }
+
+def child_pids() -> List[int]:
+    """Returns the pids of the child processes of this process. Children started from any thread of this process are included, 
+    e.g. the workers of a dataloader that is iterated in a prefetching thread. Returns an empty list if the kernel does not report children."""
+    pids = []
+    for children_file in Path('/proc/self/task').glob('*/children'):
+        try:
+            with open(children_file, 'r') as f:
+                pids.extend( int(pid) for pid in f.read().split() )
+        except FileNotFoundError:
+            # the thread exited while we were reading it
+            continue
+    return pids
+
+def worker_memory_usage(pids: List[int] = None) -> Dict[int, Dict[str, float]]:
+    """Returns the memory usage of the processes pids, e.g. the worker pids of a dataloader iterator, keyed by pid. 
+    If pids is not given, the memory usage of every child process of this process is returned."""
+    if pids is None:
+        pids = child_pids()
+    usage = {}
+    for pid in pids:
+        try:
+            usage[pid] = process_memory_usage(pid)
+        except (FileNotFoundError, ProcessLookupError):
+            # the process exited while we were reading it
+            continue
+    return usage